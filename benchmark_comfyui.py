@@ -0,0 +1,552 @@
+"""ComfyUI API 客户端离线基准测试
+
+在进程内启动模拟的 ComfyUI 服务器（/prompt、/upload/image、/history、/view、/queue、
+/object_info、/system_stats 以及 /ws 进度协议），用可配置的执行延迟代替GPU，
+测量 comfyui_img2img_api 客户端自身的开销：吞吐量（张/秒）、各阶段延迟分位数
+（来自客户端的阶段耗时记录）、峰值内存，以及命令行启动开销（导入耗时和从启动进程到
+第一次提交工作流的耗时）。
+
+用法:
+  python benchmark_comfyui.py [--images 数量] [--latency 秒] [--scenario all|single|batch|pool|startup]
+                              [--size 边长] [--json 结果文件] [--baseline 基准文件] [--tolerance 比例]
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import queue
+import base64
+import struct
+import hashlib
+import tempfile
+import statistics
+import subprocess
+import threading
+import contextlib
+import collections
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+SCENARIOS = ["single", "batch", "pool"]
+
+STARTUP_RUNS = 5
+
+def make_png(width, height, color):
+    """生成纯色PNG图像（不依赖PIL）"""
+    row = b"\x00" + bytes(color) * width
+    raw = row * height
+
+    def chunk(chunk_type, data):
+        body = chunk_type + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) +
+            chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+def ws_send(sock, payload, opcode=1):
+    """发送一个未分片的WebSocket帧（服务器端不加掩码）"""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    sock.sendall(header + payload)
+
+class FakeComfyUI:
+    """进程内模拟的 ComfyUI 服务器
+
+    按提交顺序逐个执行工作流（与单GPU一致），KSampler 节点耗时 latency 秒，
+    未变化的节点与上一个工作流一样视为缓存命中。
+    """
+
+    OBJECT_INFO = {
+        "CheckpointLoaderSimple": {"input": {"required": {"ckpt_name": [["bench.safetensors"]]}}},
+        "KSampler": {"input": {"required": {"sampler_name": [["euler"]]}}},
+        "SaveImageWebsocket": {"input": {"required": {"images": ["IMAGE"]}}},
+        "RepeatLatentBatch": {"input": {"required": {"samples": ["LATENT"]}}}
+    }
+
+    def __init__(self, latency=0.05, output_size=64):
+        self.latency = latency
+        self.output_png = make_png(output_size, output_size, (200, 60, 20))
+        self.lock = threading.Lock()
+        self.inputs = {}
+        self.outputs = {}
+        self.history = {}
+        self.pending = []  # [(prompt_id, 请求)]
+        self.running = None
+        self.work = queue.Queue()
+        self.sockets = {}  # client_id -> socket
+        self.last_signatures = {}
+        self.request_counts = collections.Counter()
+        self.first_prompt_at = None  # 第一次收到 /prompt 的时间 (time.time())
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.execute_loop, daemon=True).start()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send(self, client_id, payload, opcode=1):
+        with self.lock:
+            sock = self.sockets.get(client_id)
+        if sock:
+            try:
+                ws_send(sock, payload if opcode == 2 else json.dumps(payload), opcode)
+            except OSError:
+                pass
+
+    def broadcast_status(self):
+        with self.lock:
+            queue_remaining = len(self.pending) + (1 if self.running else 0)
+            client_ids = list(self.sockets)
+        for client_id in client_ids:
+            self.send(client_id, {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": queue_remaining}}}})
+
+    def execute_loop(self):
+        while True:
+            prompt_id = self.work.get()
+            with self.lock:
+                index = next(i for i, (pending_id, _) in enumerate(self.pending) if pending_id == prompt_id)
+                _, request = self.pending.pop(index)
+                self.running = prompt_id
+            self.execute(prompt_id, request)
+            with self.lock:
+                self.running = None
+            self.broadcast_status()
+
+    def execute(self, prompt_id, request):
+        client_id = request.get("client_id")
+        prompt = request["prompt"]
+        signatures = {}
+
+        def signature(node_id):
+            if node_id not in signatures:
+                node = prompt[node_id]
+                parts = [node.get("class_type"), json.dumps(node.get("inputs", {}), sort_keys=True)]
+                for value in node.get("inputs", {}).values():
+                    if isinstance(value, list) and len(value) == 2 and str(value[0]) in prompt:
+                        parts.append(signature(str(value[0])))
+                signatures[node_id] = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+            return signatures[node_id]
+
+        self.send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id}})
+        cached = [node_id for node_id in prompt
+                  if self.last_signatures.get(node_id) == signature(node_id) and
+                  prompt[node_id].get("class_type") not in ["SaveImage", "SaveImageWebsocket"]]
+        self.send(client_id, {"type": "execution_cached", "data": {"nodes": cached, "prompt_id": prompt_id}})
+
+        outputs = {}
+        for node_id, node in prompt.items():
+            if node_id in cached:
+                continue
+            self.send(client_id, {"type": "executing", "data": {"node": node_id, "prompt_id": prompt_id}})
+            class_type = node.get("class_type")
+            if class_type == "KSampler":
+                time.sleep(self.latency)
+                self.send(client_id, {"type": "progress", "data": {"value": 1, "max": 1, "prompt_id": prompt_id}})
+            elif class_type == "SaveImage":
+                filename = f"{node['inputs'].get('filename_prefix', 'output')}_{uuid.uuid4().hex[:8]}.png"
+                with self.lock:
+                    self.outputs[filename] = self.output_png
+                outputs[node_id] = {"images": [{"filename": filename, "subfolder": "", "type": "output"}]}
+                self.send(client_id, {"type": "executed", "data": {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id}})
+            elif class_type == "SaveImageWebsocket":
+                self.send(client_id, struct.pack(">II", 1, 2) + self.output_png, 2)
+
+        self.last_signatures = {node_id: signature(node_id) for node_id in prompt}
+        with self.lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, prompt, {}, []],
+                "outputs": outputs,
+                "status": {"status_str": "success", "completed": True}
+            }
+        self.send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+        self.send(client_id, {"type": "execution_success", "data": {"prompt_id": prompt_id}})
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 响应头和响应体分开发送，不关闭Nagle时每个请求都会多出约40ms的延迟确认等待
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data, status=200):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def do_GET(self, head=False):
+                url = urlparse(self.path)
+                fake.request_counts[f"GET {url.path.split('/')[1]}"] += 1
+                if url.path == "/ws":
+                    return self.websocket(parse_qs(url.query).get("clientId", [""])[0])
+                if url.path == "/system_stats":
+                    return self.send_json({"system": {"os": "benchmark"}, "devices": []})
+                if url.path == "/object_info":
+                    return self.send_json(fake.OBJECT_INFO)
+                if url.path == "/queue":
+                    with fake.lock:
+                        running = [[0, fake.running, {}, {}, []]] if fake.running else []
+                        pending = [[0, prompt_id, {}, {}, []] for prompt_id, _ in fake.pending]
+                    return self.send_json({"queue_running": running, "queue_pending": pending})
+                if url.path.startswith("/history/"):
+                    prompt_id = url.path.split("/")[2]
+                    with fake.lock:
+                        entry = fake.history.get(prompt_id)
+                    return self.send_json({prompt_id: entry} if entry else {})
+                if url.path == "/view":
+                    query = parse_qs(url.query)
+                    store = fake.inputs if query.get("type", ["output"])[0] == "input" else fake.outputs
+                    with fake.lock:
+                        data = store.get(query.get("filename", [""])[0])
+                    if data is None:
+                        self.send_response(404)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/png")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    if not head:
+                        self.wfile.write(data)
+                    return
+                self.send_json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                fake.request_counts[f"POST {url.path.split('/')[1]}"] += 1
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if url.path == "/prompt":
+                    request = json.loads(body)
+                    # 和 ComfyUI 一样在入队前校验 LoadImage 的输入文件
+                    with fake.lock:
+                        node_errors = {node_id: {"errors": [{"type": "value_not_in_list",
+                                                             "message": "Invalid image file"}]}
+                                       for node_id, node in request["prompt"].items()
+                                       if node.get("class_type") == "LoadImage" and
+                                       node["inputs"].get("image") not in fake.inputs}
+                    if node_errors:
+                        return self.send_json({"error": {"type": "prompt_outputs_failed_validation"},
+                                               "node_errors": node_errors}, 400)
+                    prompt_id = str(uuid.uuid4())
+                    with fake.lock:
+                        if fake.first_prompt_at is None:
+                            fake.first_prompt_at = time.time()
+                        fake.pending.append((prompt_id, request))
+                        number = len(fake.pending)
+                    fake.work.put(prompt_id)
+                    fake.broadcast_status()
+                    return self.send_json({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+                if url.path == "/upload/image":
+                    message = BytesParser(policy=email_policy).parsebytes(
+                        b"Content-Type: " + self.headers["Content-Type"].encode("utf-8") + b"\r\n\r\n" + body)
+                    name = None
+                    for part in message.iter_parts():
+                        if part.get_param("name", header="content-disposition") == "image":
+                            name = part.get_filename()
+                            with fake.lock:
+                                fake.inputs[name] = part.get_payload(decode=True)
+                    return self.send_json({"name": name, "subfolder": "", "type": "input"})
+                self.send_json({"error": "not found"}, 404)
+
+            def websocket(self, client_id):
+                key = self.headers["Sec-WebSocket-Key"]
+                accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode("utf-8")).digest()).decode("ascii")
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+                sock = self.connection
+                with fake.lock:
+                    fake.sockets[client_id] = sock
+                fake.broadcast_status()
+                try:
+                    # 读取并丢弃客户端帧，直到关闭
+                    while True:
+                        header = sock.recv(2)
+                        if not header or header[0] & 0x0f == 8:
+                            break
+                        length = header[1] & 0x7f
+                        if length == 126:
+                            length = struct.unpack("!H", sock.recv(2))[0]
+                        elif length == 127:
+                            length = struct.unpack("!Q", sock.recv(8))[0]
+                        sock.recv(4 + length)
+                except OSError:
+                    pass
+                with fake.lock:
+                    if fake.sockets.get(client_id) is sock:
+                        del fake.sockets[client_id]
+                self.close_connection = True
+
+        return Handler
+
+def get_peak_rss_mb():
+    """本进程（含模拟服务器）的峰值常驻内存（MB），不支持的平台返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为KB，macOS 为字节
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def prepare_workspace(api, root, image_count, image_size):
+    """在临时目录中准备输入图像，并让客户端的输出、缓存和工作流都使用该目录"""
+    input_folder = os.path.join(root, "input")
+    os.makedirs(input_folder, exist_ok=True)
+    images = []
+    for index in range(image_count):
+        path = os.path.join(input_folder, f"bench_{index:04d}.png")
+        with open(path, "wb") as f:
+            f.write(make_png(image_size, image_size, (index % 256, (index * 7) % 256, (index * 13) % 256)))
+        images.append(path)
+
+    api.CONFIG.update({
+        "input_folder": input_folder,
+        "output_folder": os.path.join(root, "output"),
+        "workflow_path": os.path.join(root, "workflow.json"),
+        "cache_folder": os.path.join(root, "cache"),
+        "debug": False,
+        "batch_journal": False,
+        "result_cache": False,
+        "history_poll_interval": 2
+    })
+    return images
+
+def run_scenario(api, name, images, latency):
+    """运行一个测试场景，返回结果字典"""
+    server_count = 2 if name == "pool" else 1
+    servers = [FakeComfyUI(latency).start() for _ in range(server_count)]
+    addresses = [server.address for server in servers]
+    api.CONFIG["server_address"] = addresses[0]
+    api.CONFIG["server_addresses"] = addresses
+    api.CONFIG["metrics_file"] = os.path.join(os.path.dirname(api.CONFIG["cache_folder"]), f"metrics_{name}.jsonl")
+    api.node_schema_cache.invalidate()
+
+    try:
+        with open(os.devnull, "w", encoding="utf-8") as devnull:
+            # 工作流在计时之外创建
+            with contextlib.redirect_stdout(devnull):
+                if not os.path.exists(api.CONFIG["workflow_path"]):
+                    api.create_default_workflow()
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(devnull):
+                if name == "single":
+                    for path in images:
+                        api.generate_image(path, "benchmark")
+                else:
+                    api.batch_process(images, "benchmark", addresses)
+            elapsed = time.perf_counter() - start
+    finally:
+        api.close_clients()
+        for server in servers:
+            server.stop()
+        output_folder = api.CONFIG["output_folder"]
+        output_count = len(os.listdir(output_folder)) if os.path.isdir(output_folder) else 0
+        if os.path.isdir(output_folder):
+            for filename in os.listdir(output_folder):
+                os.remove(os.path.join(output_folder, filename))
+
+    # 各阶段耗时来自客户端写入的指标文件
+    with open(api.CONFIG["metrics_file"], "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    requests_total = collections.Counter()
+    for server in servers:
+        requests_total.update(server.request_counts)
+    return {
+        "scenario": name,
+        "servers": server_count,
+        "images": len(images),
+        "outputs": output_count,
+        "seconds": elapsed,
+        "images_per_second": len(images) / elapsed if elapsed else 0,
+        # 理想情况（只有GPU耗时）下的吞吐量，用来衡量客户端开销
+        "ideal_images_per_second": server_count / latency if latency else None,
+        "stages": api.summarize_spans(records),
+        "requests": dict(requests_total)
+    }
+
+def measure_startup(api, root, script_folder, image, latency):
+    """在子进程中测量命令行启动开销，各取多次运行的中位数
+
+    import_seconds: 导入 comfyui_img2img_api 的耗时
+    first_submit_seconds: 从启动单图像命令到模拟服务器收到第一个工作流的耗时
+    process_seconds: 单图像命令的总耗时
+    """
+    env = dict(os.environ, PYTHONPATH=script_folder + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    import_code = ("import time; start = time.perf_counter(); import comfyui_img2img_api; "
+                   "print(time.perf_counter() - start)")
+    import_times = []
+    for _ in range(STARTUP_RUNS):
+        output = subprocess.run([sys.executable, "-c", import_code], cwd=root, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        import_times.append(float(output.strip().splitlines()[-1]))
+
+    first_submit_times = []
+    process_times = []
+    script = os.path.join(script_folder, "comfyui_img2img_api.py")
+    for _ in range(STARTUP_RUNS):
+        server = FakeComfyUI(latency).start()
+        try:
+            config = dict(api.CONFIG, server_address=server.address, server_addresses=[],
+                          workflow_path=os.path.abspath(api.CONFIG["workflow_path"]),
+                          metrics_file=os.path.join(root, "metrics_startup.jsonl"), metrics_port=0)
+            with open(os.path.join(root, "comfyui_api_config.json"), "w", encoding="utf-8") as f:
+                json.dump(config, f, ensure_ascii=False)
+            start = time.time()
+            subprocess.run([sys.executable, script, image, "benchmark"], cwd=root, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+            process_times.append(time.time() - start)
+            if server.first_prompt_at is not None:
+                first_submit_times.append(server.first_prompt_at - start)
+        finally:
+            server.stop()
+
+    return {
+        "runs": STARTUP_RUNS,
+        "import_seconds": statistics.median(import_times),
+        "first_submit_seconds": statistics.median(first_submit_times) if first_submit_times else None,
+        "process_seconds": statistics.median(process_times)
+    }
+
+def print_startup(startup):
+    print(f"\n== startup (子进程，{startup['runs']} 次中位数) ==")
+    print(f"导入耗时: {startup['import_seconds'] * 1000:.1f} ms")
+    if startup["first_submit_seconds"] is not None:
+        print(f"启动到第一次提交: {startup['first_submit_seconds'] * 1000:.1f} ms")
+    else:
+        print("启动到第一次提交: 未收到工作流")
+    print(f"单图像命令总耗时: {startup['process_seconds'] * 1000:.1f} ms")
+
+def print_result(result):
+    print(f"\n== {result['scenario']} (服务器 {result['servers']} 台) ==")
+    print(f"图像: {result['images']}，输出: {result['outputs']}，耗时: {result['seconds']:.2f}秒")
+    line = f"吞吐量: {result['images_per_second']:.2f} 张/秒"
+    if result["ideal_images_per_second"]:
+        efficiency = result["images_per_second"] / result["ideal_images_per_second"]
+        line += f" (理想值 {result['ideal_images_per_second']:.2f}，效率 {efficiency:.0%})"
+    print(line)
+    print(f"{'阶段':<12}{'次数':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for stage, stats in result["stages"].items():
+        print(f"{stage:<12}{stats['count']:>6}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    print(f"请求数: {', '.join(f'{name} {count}' for name, count in sorted(result['requests'].items()))}")
+
+def compare_with_baseline(report, baseline_path, tolerance):
+    """与基准结果比较吞吐量，任一场景低于 (1 - tolerance) 倍基准时返回 False"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {result["scenario"]: result for result in json.load(f)["results"]}
+    passed = True
+    for result in report["results"]:
+        reference = baseline.get(result["scenario"])
+        if not reference:
+            continue
+        ratio = result["images_per_second"] / reference["images_per_second"]
+        status = "正常" if ratio >= 1 - tolerance else "退化"
+        print(f"{result['scenario']}: {ratio:.0%} 基准吞吐量 ({status})")
+        passed = passed and ratio >= 1 - tolerance
+    return passed
+
+def main():
+    args = sys.argv[1:]
+    if "--help" in args or "-h" in args:
+        print(__doc__)
+        return 0
+
+    def option(name, default):
+        if name in args and args.index(name) + 1 < len(args):
+            return args[args.index(name) + 1]
+        return default
+
+    image_count = int(option("--images", 24))
+    latency = float(option("--latency", 0.05))
+    image_size = int(option("--size", 256))
+    scenario = option("--scenario", "all")
+    json_path = option("--json", None)
+    baseline_path = option("--baseline", None)
+    tolerance = float(option("--tolerance", 0.2))
+    scenarios = SCENARIOS if scenario == "all" else [name for name in SCENARIOS if name == scenario]
+    measure_startup_time = scenario in ["all", "startup"]
+
+    script_folder = os.path.dirname(os.path.abspath(__file__))
+    if json_path:
+        json_path = os.path.abspath(json_path)
+    if baseline_path:
+        baseline_path = os.path.abspath(baseline_path)
+
+    with tempfile.TemporaryDirectory(prefix="comfyui_bench_") as root:
+        # 在临时目录中运行，默认工作流等相对路径文件都写入该目录
+        os.chdir(root)
+        sys.path.insert(0, script_folder)
+        import comfyui_img2img_api as api
+
+        images = prepare_workspace(api, root, image_count, image_size)
+        report = {"images": image_count, "latency": latency, "image_size": image_size, "results": []}
+        for name in scenarios:
+            result = run_scenario(api, name, images, latency)
+            report["results"].append(result)
+            print_result(result)
+
+        if measure_startup_time:
+            if not os.path.exists(api.CONFIG["workflow_path"]):
+                with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+                    server = FakeComfyUI(latency).start()
+                    api.CONFIG["server_address"] = server.address
+                    api.create_default_workflow()
+                    server.stop()
+            report["startup"] = measure_startup(api, root, script_folder, images[0], latency)
+            print_startup(report["startup"])
+
+        report["peak_rss_mb"] = get_peak_rss_mb()
+        if report["peak_rss_mb"] is not None:
+            print(f"\n峰值内存: {report['peak_rss_mb']:.1f} MB")
+        os.chdir(script_folder)
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"结果已保存到 {json_path}")
+
+    if baseline_path and not compare_with_baseline(report, baseline_path, tolerance):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,45 @@
 import os
+import io
 import sys
+import glob
 import json
+import math
 import uuid
 import time
 import random
+import shutil
+import atexit
+import tempfile
+import mimetypes
 import base64
-import websocket
-import requests
+import hashlib
+import threading
+import itertools
+import contextlib
+import collections
+import importlib
+import importlib.util
 from datetime import datetime
-try:
-    from PIL import Image
-    PIL_AVAILABLE = True
-except ImportError:
-    PIL_AVAILABLE = False
-    print("警告: 未安装PIL库，部分图像处理功能将不可用")
+from concurrent.futures import ThreadPoolExecutor
+from file_utils import write_json_atomic
+
+class LazyModule:
+    """首次访问属性时才导入的模块，避免启动时加载 requests、websocket 和 PIL"""
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+requests = LazyModule("requests")
+websocket = LazyModule("websocket")
+Image = LazyModule("PIL.Image")
+ImageOps = LazyModule("PIL.ImageOps")
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
 
 # 配置文件路径
 CONFIG_FILE = "comfyui_api_config.json"
@@ -21,6 +47,7 @@ CONFIG_FILE = "comfyui_api_config.json"
 # 配置参数
 CONFIG = {
     "server_address": "127.0.0.1:8188",  # ComfyUI服务器地址
+    "server_addresses": [],  # 批处理使用的服务器池，为空时只使用 server_address
     "output_folder": r"E:\img",  # 输出文件夹路径
     "input_folder": r"E:\M72",  # 输入图片文件夹
     "workflow_path": "default_workflow.json",  # 工作流JSON文件路径，使用默认工作流
@@ -31,7 +58,36 @@ CONFIG = {
     "default_negative_prompt": "低质量, 模糊, 畸变, 扭曲, 低分辨率, 低细节",  # 默认负面提示词
     "timeout": 60,  # API请求超时时间（秒）
     "save_workflow": True,  # 是否保存修改后的工作流
-    "auto_convert_format": True  # 自动转换图像格式
+    "workflow_slots": {},  # 自定义工作流的命名参数，例如 {"strength": ["12", "strength"]}
+    "auto_convert_format": True,  # 自动转换图像格式
+    "max_in_flight": 2,  # 批处理时服务器上同时排队的工作流数量
+    "io_workers": 4,  # 批处理上传/下载线程数
+    "history_poll_interval": 10,  # 批处理时轮询历史记录的间隔（秒），用于补偿丢失的WebSocket消息
+    "queue_poll_interval": 2,  # 批处理时轮询各服务器队列深度的间隔（秒）
+    "server_retries": 2,  # 服务器故障时任务改派到其他服务器的最大次数
+    "cache_folder": ".comfyui_cache",  # 本地缓存文件夹
+    "object_info_ttl": 3600,  # 节点信息(/object_info)缓存有效期（秒）
+    "dedup_uploads": True,  # 按内容哈希去重上传，服务器已有相同图像时跳过上传
+    "websocket_output": False,  # 通过WebSocket直接接收输出图像（需要服务器支持SaveImageWebsocket节点）
+    "cache_affinity_scheduling": True,  # 按模型、提示词、输入图像排序批处理任务，提高服务器节点缓存命中率
+    "batch_journal": True,  # 记录批处理任务日志，中断后重新运行时跳过已完成的任务
+    "fixed_seed": None,  # 固定种子值，为空时每次使用随机种子；固定种子时才会使用结果缓存
+    "result_cache": True,  # 缓存固定种子的生成结果，相同输入、工作流和参数直接返回已保存的图像
+    "result_cache_max_mb": 1024,  # 结果缓存的磁盘空间上限（MB），超出时删除最久未使用的结果
+    "preprocess_inputs": False,  # 上传前预处理输入图像：缩小到目标分辨率、重新压缩并去除元数据
+    "preprocess_max_size": 1024,  # 预处理后图像最长边上限，工作流中有缩放节点时以节点尺寸为准
+    "preprocess_format": "PNG",  # 预处理后的图像格式 (PNG/JPEG/WEBP)
+    "preprocess_quality": 92,  # JPEG/WEBP 压缩质量
+    "preprocess_workers": 2,  # 批处理时预处理图像的线程数
+    "convert_memory_limit_mb": 32,  # 格式转换在内存中进行的大小上限（MB），超出时转存到私有临时目录
+    "variations_batched": True,  # 生成变体且未指定种子时使用latent批次一次采样，否则为每个种子复制采样分支
+    "metrics": True,  # 记录每个任务各阶段（连接/上传/排队/执行/历史记录/下载/保存）的耗时
+    "metrics_file": "",  # 阶段耗时JSONL文件路径，为空时写入缓存文件夹下的 metrics.jsonl
+    "queue_backpressure": True,  # 服务器队列（包括其他客户端的任务）达到 max_in_flight 时暂停提交，有空闲槽位后再继续
+    "metrics_port": 0,  # Prometheus 指标HTTP端口，0 表示不启用
+    "metrics_host": "127.0.0.1",  # 指标HTTP服务监听地址
+    "watch_poll_interval": 1,  # 监视模式检查文件夹的间隔（秒）
+    "watch_settle_seconds": 2  # 监视模式中文件大小和修改时间保持不变多久后视为写入完成（秒）
 }
 
 def load_config():
@@ -60,43 +116,401 @@ def save_config():
     except Exception as e:
         print(f"保存配置文件时出错: {e}")
 
-# 加载配置
-load_config()
-
 def print_debug(message):
     """打印调试信息"""
     if CONFIG.get("debug", False):
         print(f"[调试] {message}")
 
-def establish_connection():
-    """建立与ComfyUI服务器的WebSocket连接"""
-    server_address = CONFIG["server_address"]
-    client_id = str(uuid.uuid4())
-    print_debug(f"连接到服务器: {server_address}")
-    print_debug(f"客户端ID: {client_id}")
+def percentile(values, fraction):
+    """最近秩法计算分位数，values 为空时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    # 秩为 ceil(fraction * n)；先舍去浮点误差，避免 0.07 * 100 = 7.000000000000001 进位
+    rank = math.ceil(round(fraction * len(ordered), 9))
+    return ordered[max(0, min(len(ordered) - 1, rank - 1))]
+
+# 任务的各个阶段，按执行顺序排列
+TIMING_STAGES = ["connect", "upload", "queue_wait", "execution", "history", "download", "save"]
+
+_current_timer = threading.local()
+
+class JobTimer:
+    """记录一个任务各阶段的耗时（秒）
+
+    同一阶段多次计时（例如并行下载多张图像、失败后重试）时累加。
+    通过 use_timer() 设为当前线程的计时器后，底层函数用 add_span() 记录耗时。
+    """
+    
+    def __init__(self):
+        self.spans = {}
+        self.created_at = time.perf_counter()
+        self.submitted_at = None  # 调用 /prompt 的时间
+        self.started_at = None  # 收到第一个 executing 消息的时间
+        self.lock = threading.Lock()
+        
+    def add(self, stage, seconds):
+        with self.lock:
+            self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+            
+    @contextlib.contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+            
+    def record_execution(self, started_at, finished_at):
+        """由提交时间、开始执行时间和结束时间计算排队等待与执行耗时"""
+        if self.submitted_at is None:
+            return
+        if started_at is None:
+            started_at = finished_at
+        self.add("queue_wait", max(0.0, started_at - self.submitted_at))
+        self.add("execution", max(0.0, finished_at - started_at))
+
+@contextlib.contextmanager
+def use_timer(timer):
+    """在当前线程中把 timer 设为当前计时器"""
+    previous = getattr(_current_timer, "timer", None)
+    _current_timer.timer = timer
+    try:
+        yield timer
+    finally:
+        _current_timer.timer = previous
+
+def get_current_timer():
+    return getattr(_current_timer, "timer", None)
+
+def add_span(stage, seconds):
+    """向当前线程的计时器记录一段耗时，没有计时器时忽略"""
+    timer = get_current_timer()
+    if timer:
+        timer.add(stage, seconds)
+
+class MetricsRecorder:
+    """把每个任务的阶段耗时以JSONL格式追加写入指标文件"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        
+    def path(self):
+        return CONFIG.get("metrics_file") or os.path.join(CONFIG.get("cache_folder", ".comfyui_cache"), "metrics.jsonl")
+        
+    def record(self, timer, **fields):
+        """写入一条记录并返回，耗时单位为毫秒"""
+        record = dict(fields, time=time.time(),
+                      total_ms=round((time.perf_counter() - timer.created_at) * 1000, 2),
+                      spans_ms={stage: round(seconds * 1000, 2) for stage, seconds in timer.spans.items()})
+        if CONFIG.get("metrics", True):
+            with self.lock:
+                try:
+                    path = self.path()
+                    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                    with open(path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                except Exception as e:
+                    print_debug(f"写入阶段耗时失败: {e}")
+        live_metrics.observe_job(record)
+        return record
+
+metrics_recorder = MetricsRecorder()
+
+class LiveMetrics:
+    """进程内的实时指标，以 Prometheus 文本格式通过HTTP提供
+
+    包括任务数（排队/执行中/完成/失败）、每分钟图像数、各阶段耗时直方图、
+    上传字节数、缓存命中情况和各服务器的队列深度。
+    """
+    
+    # 阶段耗时直方图的桶上限（秒）
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
     
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {"done": 0, "failed": 0}
+        self.images_total = 0
+        self.recent_images = collections.deque()  # (时间, 图像数)，用于计算每分钟图像数
+        self.histograms = {}  # 阶段 -> [各桶计数..., 总和, 总数]
+        self.upload_bytes = 0
+        self.cache = {}  # (缓存名, 结果) -> 次数
+        self.engines = set()  # 正在运行的批处理引擎，提供排队/执行中任务数和服务器队列深度
+        
+    def observe_job(self, record):
+        with self.lock:
+            for stage, milliseconds in record.get("spans_ms", {}).items():
+                histogram = self.histograms.setdefault(stage, [0] * len(self.BUCKETS) + [0.0, 0])
+                seconds = milliseconds / 1000
+                for index, bound in enumerate(self.BUCKETS):
+                    if seconds <= bound:
+                        histogram[index] += 1
+                histogram[-2] += seconds
+                histogram[-1] += 1
+            if record.get("kind") in ["single", "batch"]:
+                self.jobs["done" if record.get("success") else "failed"] += 1
+                images = record.get("images", 0)
+                if images:
+                    self.images_total += images
+                    self.recent_images.append((time.time(), images))
+                    
+    def add_upload_bytes(self, size):
+        with self.lock:
+            self.upload_bytes += size
+            
+    def count_cache(self, cache_name, result, count=1):
+        with self.lock:
+            key = (cache_name, result)
+            self.cache[key] = self.cache.get(key, 0) + count
+            
+    def images_per_minute(self):
+        cutoff = time.time() - 60
+        while self.recent_images and self.recent_images[0][0] < cutoff:
+            self.recent_images.popleft()
+        return sum(count for _, count in self.recent_images)
+        
+    def render(self):
+        """生成 Prometheus 文本格式的指标"""
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            
+        queued = running = 0
+        queue_depths = {}
+        for engine in list(self.engines):
+            snapshot = engine.metrics_snapshot()
+            queued += snapshot["queued"]
+            running += snapshot["running"]
+            queue_depths.update(snapshot["queue_depths"])
+            
+        lines = []
+        with self.lock:
+            lines += ["# HELP comfyui_jobs 当前排队中和执行中的任务数", "# TYPE comfyui_jobs gauge",
+                      f'comfyui_jobs{{state="queued"}} {queued}', f'comfyui_jobs{{state="running"}} {running}']
+            lines += ["# HELP comfyui_jobs_total 已结束的任务数", "# TYPE comfyui_jobs_total counter"]
+            lines += [f'comfyui_jobs_total{{state="{state}"}} {count}' for state, count in self.jobs.items()]
+            lines += ["# HELP comfyui_images_total 已保存的输出图像数", "# TYPE comfyui_images_total counter",
+                      f"comfyui_images_total {self.images_total}"]
+            lines += ["# HELP comfyui_images_per_minute 最近一分钟保存的输出图像数", "# TYPE comfyui_images_per_minute gauge",
+                      f"comfyui_images_per_minute {self.images_per_minute()}"]
+            lines += ["# HELP comfyui_upload_bytes_total 上传到服务器的字节数", "# TYPE comfyui_upload_bytes_total counter",
+                      f"comfyui_upload_bytes_total {self.upload_bytes}"]
+            lines += ["# HELP comfyui_cache_total 各缓存的命中/未命中次数", "# TYPE comfyui_cache_total counter"]
+            lines += [f'comfyui_cache_total{{cache="{cache_name}",result="{result}"}} {count}'
+                      for (cache_name, result), count in sorted(self.cache.items())]
+            lines += ["# HELP comfyui_stage_seconds 任务各阶段耗时", "# TYPE comfyui_stage_seconds histogram"]
+            for stage, histogram in self.histograms.items():
+                for index, bound in enumerate(self.BUCKETS):
+                    lines.append(f'comfyui_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {histogram[index]}')
+                lines.append(f'comfyui_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram[-1]}')
+                lines.append(f'comfyui_stage_seconds_sum{{stage="{stage}"}} {histogram[-2]:.6f}')
+                lines.append(f'comfyui_stage_seconds_count{{stage="{stage}"}} {histogram[-1]}')
+        lines += ["# HELP comfyui_server_queue_depth 服务器队列中执行中和等待中的任务数（包括其他客户端）",
+                  "# TYPE comfyui_server_queue_depth gauge"]
+        lines += [f'comfyui_server_queue_depth{{server="{label(server_address)}"}} {depth}'
+                  for server_address, depth in sorted(queue_depths.items())]
+        return "\n".join(lines) + "\n"
+
+live_metrics = LiveMetrics()
+
+_metrics_server = None
+
+def start_metrics_server(port=None, host=None):
+    """在后台线程中启动 Prometheus 指标HTTP服务（/metrics），返回是否成功"""
+    global _metrics_server
+    port = int(port if port is not None else CONFIG.get("metrics_port", 0) or 0)
+    if not port or _metrics_server:
+        return bool(_metrics_server)
+    host = host or CONFIG.get("metrics_host", "127.0.0.1")
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/metrics", "/"]:
+                self.send_error(404)
+                return
+            body = live_metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            
+        def log_message(self, format, *args):
+            pass
+            
     try:
-        # 先检查服务器是否运行
+        _metrics_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"启动指标服务失败: {e}")
+        return False
+    _metrics_server.daemon_threads = True
+    threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    print(f"指标服务已启动: http://{host}:{port}/metrics")
+    return True
+
+def summarize_spans(records):
+    """按阶段汇总多条耗时记录，返回 {阶段: {"count", "p50_ms", "p95_ms", "p99_ms"}}"""
+    samples = {}
+    for record in records:
+        for stage, milliseconds in record.get("spans_ms", {}).items():
+            samples.setdefault(stage, []).append(milliseconds)
+    stages = [stage for stage in TIMING_STAGES if stage in samples]
+    stages += sorted(stage for stage in samples if stage not in TIMING_STAGES)
+    return {stage: {
+        "count": len(samples[stage]),
+        "p50_ms": percentile(samples[stage], 0.50),
+        "p95_ms": percentile(samples[stage], 0.95),
+        "p99_ms": percentile(samples[stage], 0.99)
+    } for stage in stages}
+
+def print_stage_summary(records):
+    """打印各阶段耗时的 p50/p95/p99"""
+    summary = summarize_spans(records)
+    if not summary:
+        return
+    print(f"各阶段耗时 (毫秒):")
+    print(f"  {'阶段':<12}{'次数':>6}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, stats in summary.items():
+        print(f"  {stage:<12}{stats['count']:>6}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+
+class ComfyUIClient:
+    """ComfyUI客户端会话
+
+    持有一个带连接池的 requests.Session 和一条使用固定 client_id 的 WebSocket，
+    断线后自动重连。generate_image、batch_process 和交互模式共用同一个会话。
+    """
+    
+    def __init__(self, server_address=None):
+        self.server_address = server_address or CONFIG["server_address"]
+        self.client_id = str(uuid.uuid4())
+        self.session = requests.Session()
+        pool_size = max(10, int(CONFIG.get("io_workers", 4)) * 2)
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        self.ws = None
+        self.ws_timeout = None
+        self.server_checked = False
+        self.reconnect_count = 0  # 重连次数，调用方据此判断是否可能丢失了消息
+        self.lock = threading.Lock()
+        
+    def url(self, path):
+        return f"http://{self.server_address}{path}"
+        
+    def get(self, path, **kwargs):
+        kwargs.setdefault("timeout", CONFIG.get("timeout", 60))
+        return self.session.get(self.url(path), **kwargs)
+        
+    def post(self, path, **kwargs):
+        kwargs.setdefault("timeout", CONFIG.get("timeout", 60))
+        return self.session.post(self.url(path), **kwargs)
+        
+    def head(self, path, **kwargs):
+        kwargs.setdefault("timeout", CONFIG.get("timeout", 60))
+        return self.session.head(self.url(path), **kwargs)
+        
+    def check_server(self):
+        """检查服务器是否运行"""
         print("检查ComfyUI服务器是否运行...")
-        response = requests.get(f"http://{server_address}/system_stats")
-        if response.status_code != 200:
-            print(f"错误: 无法连接到ComfyUI服务器 ({server_address})，请确保服务器正在运行")
-            return None, server_address, client_id
+        try:
+            response = self.get("/system_stats")
+            if response.status_code != 200:
+                print(f"错误: 无法连接到ComfyUI服务器 ({self.server_address})，请确保服务器正在运行")
+                return False
+        except requests.exceptions.ConnectionError:
+            print(f"错误: 无法连接到ComfyUI服务器 ({self.server_address})，请确保服务器正在运行")
+            return False
+        except Exception as e:
+            print(f"建立连接时出错: {e}")
+            return False
             
         print("ComfyUI服务器已连接!")
+        self.server_checked = True
+        return True
         
-        # 建立WebSocket连接
-        ws = websocket.WebSocket()
-        ws.connect(f"ws://{server_address}/ws?clientId={client_id}")
-        print_debug("WebSocket连接已建立")
-        return ws, server_address, client_id
+    def connect(self):
+        """确保WebSocket已连接，已连接时直接返回"""
+        with self.lock:
+            if self.ws is not None and self.ws.connected:
+                return True
+            if not self.server_checked and not self.check_server():
+                return False
+                
+            print_debug(f"连接到服务器: {self.server_address}")
+            print_debug(f"客户端ID: {self.client_id}")
+            try:
+                ws = websocket.WebSocket()
+                ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
+                ws.settimeout(self.ws_timeout)
+                self.ws = ws
+                print_debug("WebSocket连接已建立")
+                return True
+            except Exception as e:
+                print(f"建立WebSocket连接时出错: {e}")
+                self.ws = None
+                return False
+                
+    def reconnect(self, retries=5):
+        """断线重连，使用相同的 client_id 以便服务器继续推送消息"""
+        self.close_ws()
+        for attempt in range(retries):
+            time.sleep(min(2 ** attempt, 10))
+            print(f"尝试重新连接WebSocket ({attempt + 1}/{retries})...")
+            if self.connect():
+                self.reconnect_count += 1
+                return True
+        return False
         
-    except requests.exceptions.ConnectionError:
-        print(f"错误: 无法连接到ComfyUI服务器 ({server_address})，请确保服务器正在运行")
-        return None, server_address, client_id
-    except Exception as e:
-        print(f"建立连接时出错: {e}")
-        return None, server_address, client_id
+    def settimeout(self, timeout):
+        """设置WebSocket读取超时"""
+        self.ws_timeout = timeout
+        if self.ws is not None:
+            self.ws.settimeout(timeout)
+            
+    def recv(self):
+        """读取一条WebSocket消息；超时或断线重连后返回 None"""
+        if not self.connect():
+            raise ConnectionError(f"无法连接到ComfyUI服务器 ({self.server_address})")
+        try:
+            return self.ws.recv()
+        except websocket.WebSocketTimeoutException:
+            return None
+        except (websocket.WebSocketConnectionClosedException, OSError) as e:
+            print(f"WebSocket连接断开: {e}")
+            if not self.reconnect():
+                raise ConnectionError("WebSocket重连失败")
+            return None
+            
+    def close_ws(self):
+        with self.lock:
+            if self.ws is not None:
+                try:
+                    self.ws.close()
+                except Exception:
+                    pass
+                self.ws = None
+                
+    def close(self):
+        self.close_ws()
+        self.session.close()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(server_address=None):
+    """获取指定服务器的共享客户端会话"""
+    server_address = server_address or CONFIG["server_address"]
+    with _clients_lock:
+        client = _clients.get(server_address)
+        if client is None:
+            client = ComfyUIClient(server_address)
+            _clients[server_address] = client
+        return client
+
+def close_clients():
+    """关闭所有客户端会话"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
 
 def queue_prompt(prompt, client_id, server_address):
     """将工作流提交到队列中执行"""
@@ -113,7 +527,7 @@ def queue_prompt(prompt, client_id, server_address):
     
     print_debug(f"提交工作流到队列")
     try:
-        response = requests.post(f"http://{server_address}/prompt", json=data, headers=headers)
+        response = get_client(server_address).post("/prompt", json=data, headers=headers)
         
         if response.status_code != 200:
             print(f"错误: API返回{response.status_code} - {response.text}")
@@ -129,7 +543,9 @@ def queue_prompt(prompt, client_id, server_address):
 def get_history(prompt_id, server_address):
     """获取已完成工作流的输出数据"""
     print_debug(f"获取历史记录: {prompt_id}")
-    response = requests.get(f"http://{server_address}/history/{prompt_id}")
+    start = time.perf_counter()
+    response = get_client(server_address).get(f"/history/{prompt_id}")
+    add_span("history", time.perf_counter() - start)
     
     if response.status_code != 200:
         print(f"错误: 获取历史记录失败 - {response.status_code}")
@@ -137,80 +553,416 @@ def get_history(prompt_id, server_address):
         
     return response.json()
 
-def get_image(filename, subfolder, folder_type, server_address):
-    """获取生成的图像"""
+def download_image(filename, subfolder, folder_type, server_address, output_name):
+    """以流式方式下载生成的图像并保存到本地，返回保存路径"""
     params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
     print_debug(f"获取图像: {filename}")
     
-    response = requests.get(f"http://{server_address}/view", params=params)
+    start = time.perf_counter()
+    write_seconds = 0.0
+    try:
+        with get_client(server_address).get("/view", params=params, stream=True) as response:
+            if response.status_code != 200:
+                print(f"错误: 获取图像失败 - {response.status_code}")
+                return None
+                
+            extension = os.path.splitext(filename)[1] or ".png"
+            filepath = make_output_path(output_name, extension)
+            write_seconds = write_file_atomic(filepath, response.iter_content(chunk_size=256 * 1024))
+            
+        print(f"图像已保存: {filepath}")
+        return filepath
+    except Exception as e:
+        print(f"下载图像失败: {e}")
+        return None
+    finally:
+        # 写入磁盘的时间计入保存阶段，其余计入下载阶段
+        add_span("download", time.perf_counter() - start - write_seconds)
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """计算文件内容的SHA-256哈希"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+def get_file_hash(path):
+    """获取文件内容哈希，文件未修改时复用之前的计算结果"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _file_hashes_lock:
+        if key in _file_hashes:
+            return _file_hashes[key]
+    digest = hash_file(path)
+    with _file_hashes_lock:
+        _file_hashes[key] = digest
+    return digest
+
+def forget_file_hash(path):
+    """丢弃文件的哈希缓存，监视模式下任务结束后调用，避免长时间运行时持续增长"""
+    path = os.path.abspath(path)
+    with _file_hashes_lock:
+        for key in [key for key in _file_hashes if key[0] == path]:
+            del _file_hashes[key]
+
+def remote_file_exists(server_address, filename, folder_type="input"):
+    """检查服务器上是否存在指定文件，无法确定时返回 None"""
+    subfolder, name = os.path.split(filename)
+    params = {"filename": name, "subfolder": subfolder, "type": folder_type}
+    client = get_client(server_address)
+    try:
+        response = client.head("/view", params=params)
+        if response.status_code == 405:
+            response = client.get("/view", params=params, stream=True)
+            response.close()
+        if response.status_code == 200:
+            return True
+        if response.status_code == 404:
+            return False
+        return None
+    except Exception as e:
+        print_debug(f"检查远程文件失败: {e}")
+        return None
+
+class UploadRegistry:
+    """已上传图像登记表
+
+    记录每个服务器上已存在的图像（内容哈希 -> 服务器文件名），以追加方式写入磁盘。
+    复用前用 /view 确认远程文件仍然存在，每个进程对同一文件只确认一次；
+    服务器拒绝使用该文件的工作流时调用 forget，下次重新确认或上传。
+    """
     
-    if response.status_code != 200:
-        print(f"错误: 获取图像失败 - {response.status_code}")
+    def __init__(self):
+        self.entries = None  # server_address -> {content_hash: remote_name}
+        self.verified = set()  # 本进程中已确认存在的 (server_address, remote_name)
+        self.lock = threading.Lock()
+        
+    def path(self):
+        return os.path.join(CONFIG.get("cache_folder", ".comfyui_cache"), "upload_registry.jsonl")
+        
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        path = self.path()
+        if not os.path.exists(path):
+            return
+        line_count = 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    line_count += 1
+                    record = json.loads(line)
+                    server_entries = self.entries.setdefault(record["server"], {})
+                    if record.get("name"):
+                        server_entries[record["hash"]] = record["name"]
+                    else:
+                        server_entries.pop(record["hash"], None)
+        except Exception as e:
+            print_debug(f"读取上传登记表失败: {e}")
+            return
+            
+        # 过期记录过多时压缩登记表
+        live_count = sum(len(server_entries) for server_entries in self.entries.values())
+        if line_count > 2 * live_count + 100:
+            self.compact()
+            
+    def compact(self):
+        temp_path = f"{self.path()}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for server_address, server_entries in self.entries.items():
+                    for content_hash, remote_name in server_entries.items():
+                        record = {"server": server_address, "hash": content_hash, "name": remote_name}
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(temp_path, self.path())
+        except Exception as e:
+            print_debug(f"压缩上传登记表失败: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            
+    def append(self, record):
+        try:
+            os.makedirs(os.path.dirname(self.path()) or ".", exist_ok=True)
+            with open(self.path(), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            print_debug(f"写入上传登记表失败: {e}")
+            
+    def lookup(self, server_address, content_hash):
+        """返回服务器上已有的文件名，未登记或远程文件已丢失时返回 None"""
+        with self.lock:
+            self.load()
+            remote_name = self.entries.get(server_address, {}).get(content_hash)
+            if not remote_name:
+                return None
+            if (server_address, remote_name) in self.verified:
+                return remote_name
+                
+        exists = remote_file_exists(server_address, remote_name)
+        with self.lock:
+            if exists:
+                self.verified.add((server_address, remote_name))
+                return remote_name
+            if exists is False:
+                print_debug(f"服务器上的文件已丢失，将重新上传: {remote_name}")
+                self.entries.get(server_address, {}).pop(content_hash, None)
+                self.append({"server": server_address, "hash": content_hash, "name": None})
+        return None
+        
+    def record(self, server_address, content_hash, remote_name):
+        with self.lock:
+            self.load()
+            self.entries.setdefault(server_address, {})[content_hash] = remote_name
+            self.verified.add((server_address, remote_name))
+            self.append({"server": server_address, "hash": content_hash, "name": remote_name})
+            
+    def forget(self, server_address, remote_name):
+        """删除指向 remote_name 的登记和确认标记（服务器的输入目录可能已被清理）"""
+        with self.lock:
+            self.load()
+            self.verified.discard((server_address, remote_name))
+            server_entries = self.entries.get(server_address, {})
+            for content_hash in [h for h, name in server_entries.items() if name == remote_name]:
+                del server_entries[content_hash]
+                self.append({"server": server_address, "hash": content_hash, "name": None})
+
+upload_registry = UploadRegistry()
+
+# 预处理输出格式 -> 扩展名
+PREPROCESS_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+
+def get_preprocess_options(template=None):
+    """返回上传前预处理的选项，未启用预处理时返回 None"""
+    if not CONFIG.get("preprocess_inputs", False) or not PIL_AVAILABLE:
         return None
+    image_format = str(CONFIG.get("preprocess_format", "PNG")).upper()
+    if image_format == "JPG":
+        image_format = "JPEG"
+    if image_format not in PREPROCESS_EXTENSIONS:
+        print(f"警告: 不支持的预处理格式 '{image_format}'，使用PNG")
+        image_format = "PNG"
+    max_size = (template.target_size() if template else None) or CONFIG.get("preprocess_max_size", 1024)
+    return {
+        "max_size": int(max_size),
+        "format": image_format,
+        "quality": int(CONFIG.get("preprocess_quality", 92)) if image_format != "PNG" else None
+    }
+
+def preprocess_image(input_path, options):
+    """缩小图像到目标分辨率并重新压缩，同时去除EXIF等元数据
+
+    返回 (图像数据, 扩展名)，失败时返回 False（上传原图，不再重复预处理）。
+    """
+    try:
+        with Image.open(input_path) as source:
+            # 先按EXIF方向旋转，元数据去除后方向信息也会丢失
+            img = ImageOps.exif_transpose(source)
+            max_size = options.get("max_size")
+            if max_size and max(img.size) > max_size:
+                if img is source:
+                    img = img.copy()
+                img.thumbnail((max_size, max_size), Image.LANCZOS)
+                
+            image_format = options["format"]
+            if image_format == "JPEG" and img.mode not in ["RGB", "L"]:
+                img = img.convert("RGB")
+            elif img.mode not in ["RGB", "RGBA", "L", "LA"]:
+                img = img.convert("RGBA")
+                
+            buffer = io.BytesIO()
+            if image_format == "PNG":
+                img.save(buffer, image_format, compress_level=6)
+            else:
+                img.save(buffer, image_format, quality=options.get("quality") or 92)
+                
+        print_debug(f"图像已预处理: {os.path.basename(input_path)} "
+                    f"{os.path.getsize(input_path)} -> {buffer.tell()} 字节")
+        return buffer.getvalue(), PREPROCESS_EXTENSIONS[image_format]
+    except Exception as e:
+        print(f"图像预处理失败，上传原图: {e}")
+        return False
+
+_private_temp_dir = None
+_private_temp_dir_lock = threading.Lock()
+
+def get_private_temp_dir():
+    """获取本进程专用的临时目录（仅当前用户可访问），进程退出时删除"""
+    global _private_temp_dir
+    with _private_temp_dir_lock:
+        if _private_temp_dir is None:
+            _private_temp_dir = tempfile.mkdtemp(prefix="comfyui_upload_")
+            atexit.register(shutil.rmtree, _private_temp_dir, True)
+        return _private_temp_dir
+
+def convert_to_png(input_path):
+    """把图像转换为PNG，返回位于开头的文件对象
+
+    转换结果先写入内存，超过 convert_memory_limit_mb 时自动转存到私有临时目录中
+    的匿名临时文件，不会在输入文件夹中留下任何文件。
+    """
+    max_size = int(CONFIG.get("convert_memory_limit_mb", 32) * 1024 * 1024)
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_size, dir=get_private_temp_dir())
+    try:
+        with Image.open(input_path) as img:
+            img.save(buffer, "PNG")
+        buffer.seek(0)
+        return buffer
+    except Exception:
+        buffer.close()
+        raise
+
+def get_upload_key(input_path, preprocess=None):
+    """上传去重键：原图内容哈希，启用预处理时同时包含预处理选项"""
+    content_hash = get_file_hash(input_path)
+    if not preprocess:
+        return content_hash
+    raw = json.dumps([content_hash, preprocess], sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class MultipartStream:
+    """流式 multipart/form-data 请求体
+
+    requests 的 files 参数会把整个文件读入内存后再拼接请求体；这里按块读取文件，
+    上传时的内存占用与图像大小无关（大图转换结果转存到临时文件时才有意义）。
+    """
+    
+    def __init__(self, fields, name, filename, fileobj, content_type):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = "".join(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+                       for key, value in fields.items())
+        safe_filename = filename.replace('"', "%22").replace("\r", "").replace("\n", "")
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{safe_filename}"\r\n'
+                 f'Content-Type: {content_type}\r\n\r\n')
+        head = head.encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        
+        start = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        file_size = fileobj.tell() - start
+        fileobj.seek(start)
+        self.parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+        self.length = len(head) + file_size + len(tail)
+        
+    def __len__(self):
+        # requests 据此设置 Content-Length，不使用分块传输
+        return self.length
+        
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and size != 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
         
-    return response.content
+    def __iter__(self):
+        while True:
+            chunk = self.read(64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+def upload_image(input_path, server_address, folder_type="input", image_type="image", overwrite=True,
+                 preprocess=None, preprocessed=None):
+    """上传图像到ComfyUI服务器，返回服务器上的文件名
 
-def upload_image(input_path, server_address, folder_type="input", image_type="image", overwrite=True):
-    """上传图像到ComfyUI服务器"""
+    preprocess 为预处理选项（见 get_preprocess_options），preprocessed 为提前完成的
+    预处理结果 (图像数据, 扩展名) 或其 Future，为 None 时在本线程中预处理，
+    为 False 表示预处理已经失败，直接上传原图。
+    """
     filename = os.path.basename(input_path)
     print_debug(f"上传图像: {filename}")
     
+    # 服务器上已有相同内容的图像时直接复用
+    content_hash = None
+    if CONFIG.get("dedup_uploads", True) and folder_type == "input":
+        try:
+            content_hash = get_upload_key(input_path, preprocess)
+            remote_name = upload_registry.lookup(server_address, content_hash)
+            live_metrics.count_cache("upload", "hit" if remote_name else "miss")
+            if remote_name:
+                print_debug(f"服务器已有相同图像，跳过上传: {filename} -> {remote_name}")
+                return remote_name
+        except Exception as e:
+            print_debug(f"计算图像哈希失败: {e}")
+            content_hash = None
+    
+    upload_file = None
     try:
-        # 如果启用了自动格式转换，确保图像是PNG格式
-        temp_file = None
-        if CONFIG.get("auto_convert_format", True) and PIL_AVAILABLE:
-            _, ext = os.path.splitext(input_path)
+        if preprocess:
+            if preprocessed is not None and hasattr(preprocessed, "result"):
+                preprocessed = preprocessed.result()
+            if preprocessed is None:
+                preprocessed = preprocess_image(input_path, preprocess)
+            if preprocessed:
+                upload_data, ext = preprocessed
+                upload_file = io.BytesIO(upload_data)
+                filename = f"{os.path.splitext(filename)[0]}{ext}"
+                
+        # 如果启用了自动格式转换，确保图像是PNG格式（在内存中转换）
+        if upload_file is None and CONFIG.get("auto_convert_format", True) and PIL_AVAILABLE:
+            stem, ext = os.path.splitext(filename)
             if ext.lower() not in ['.png', '.jpg', '.jpeg', '.webp']:
                 try:
-                    temp_filename = f"temp_{uuid.uuid4().hex}.png"
-                    temp_file = os.path.join(os.path.dirname(input_path), temp_filename)
-                    img = Image.open(input_path)
-                    img.save(temp_file, "PNG")
-                    print(f"图像已转换为PNG格式: {temp_file}")
-                    input_path = temp_file
-                    filename = temp_filename
+                    upload_file = convert_to_png(input_path)
+                    filename = f"{stem}.png"
+                    print(f"图像已转换为PNG格式: {filename}")
                 except Exception as e:
                     print(f"图像格式转换失败: {e}")
         
-        with open(input_path, 'rb') as file:
-            files = {
-                "image": (filename, file, 'image/png')
-            }
+        # 去重上传时以内容哈希命名，不同目录下的同名文件也不会互相覆盖
+        if content_hash:
+            filename = f"{content_hash[:32]}{os.path.splitext(filename)[1].lower()}"
+        
+        if upload_file is None:
+            upload_file = open(input_path, 'rb')
+        with upload_file:
             data = {
                 "type": folder_type,
                 "overwrite": str(overwrite).lower()
             }
-            url = f"http://{server_address}/upload/{image_type}"
-            
+            body = MultipartStream(data, "image", filename, upload_file,
+                                   mimetypes.guess_type(filename)[0] or 'image/png')
             # 设置超时参数
             timeout = CONFIG.get("timeout", 60)
-            response = requests.post(url, files=files, data=data, timeout=timeout)
+            response = get_client(server_address).post(f"/upload/{image_type}", data=body, timeout=timeout,
+                                                       headers={"Content-Type": body.content_type})
             
             if response.status_code != 200:
                 print(f"错误: 上传图像失败 - {response.status_code}")
                 return None
+            live_metrics.add_upload_bytes(upload_file.tell())
+                
+            # 以服务器返回的文件名为准
+            try:
+                upload_info = response.json()
+                if upload_info.get("name"):
+                    filename = upload_info["name"]
+                    if upload_info.get("subfolder"):
+                        filename = f"{upload_info['subfolder']}/{filename}"
+            except ValueError:
+                pass
                 
             print_debug(f"图像上传成功: {filename}")
-            
-            # 如果创建了临时文件，删除它
-            if temp_file and os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                    print_debug(f"临时文件已删除: {temp_file}")
-                except Exception as e:
-                    print_debug(f"无法删除临时文件: {e}")
-                    
+            if content_hash:
+                upload_registry.record(server_address, content_hash, filename)
             return filename
     except Exception as e:
         print(f"上传图像失败: {e}")
-        
-        # 如果创建了临时文件，删除它
-        if temp_file and os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
-                
+        if upload_file is not None:
+            upload_file.close()
         return None
 
 def load_workflow(path):
@@ -248,132 +1000,509 @@ def load_workflow(path):
         print(traceback.format_exc())
         return None
 
-def get_available_models(server_address):
-    """获取服务器上可用的模型列表"""
+class NodeSchemaCache:
+    """节点信息(/object_info)缓存
+
+    按服务器地址保存在内存中并持久化到磁盘，超过有效期后重新获取，
+    也可以显式失效。一次批处理只需请求一次 /object_info。
+    """
+    
+    def __init__(self):
+        self.entries = {}  # server_address -> (获取时间, object_info)
+        self.lock = threading.Lock()
+        
+    def cache_path(self, server_address):
+        safe_name = server_address.replace(":", "_").replace("/", "_")
+        return os.path.join(CONFIG.get("cache_folder", ".comfyui_cache"), f"object_info_{safe_name}.json")
+        
+    def is_fresh(self, fetched_at):
+        return time.time() - fetched_at < CONFIG.get("object_info_ttl", 3600)
+        
+    def get(self, server_address=None, refresh=False):
+        """获取节点信息，优先使用内存和磁盘缓存，失败时返回 None"""
+        server_address = server_address or CONFIG["server_address"]
+        with self.lock:
+            entry = self.entries.get(server_address)
+            if not refresh and entry and self.is_fresh(entry[0]):
+                return entry[1]
+                
+            if not refresh and not entry:
+                entry = self.load_from_disk(server_address)
+                if entry:
+                    self.entries[server_address] = entry
+                    if self.is_fresh(entry[0]):
+                        print_debug(f"使用磁盘缓存的节点信息: {server_address}")
+                        return entry[1]
+                        
+            object_info = self.fetch(server_address)
+            if object_info is None:
+                # 获取失败时退回到过期的缓存
+                if entry:
+                    print("警告: 获取节点信息失败，使用过期的缓存")
+                    return entry[1]
+                return None
+                
+            entry = (time.time(), object_info)
+            self.entries[server_address] = entry
+            try:
+                write_json_atomic(self.cache_path(server_address),
+                                  {"fetched_at": entry[0], "object_info": object_info})
+            except Exception as e:
+                print_debug(f"保存节点信息缓存失败: {e}")
+            return object_info
+            
+    def fetch(self, server_address):
+        print_debug(f"获取节点信息: {server_address}")
+        try:
+            response = get_client(server_address).get("/object_info")
+            if response.status_code != 200:
+                print(f"错误: 获取节点信息失败 - {response.status_code}")
+                return None
+            return response.json()
+        except Exception as e:
+            print(f"获取节点信息失败: {e}")
+            return None
+            
+    def load_from_disk(self, server_address):
+        path = self.cache_path(server_address)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data["fetched_at"], data["object_info"]
+        except Exception as e:
+            print_debug(f"读取节点信息缓存失败: {e}")
+            return None
+            
+    def invalidate(self, server_address=None):
+        """使缓存失效，未指定服务器时清空全部"""
+        with self.lock:
+            if server_address:
+                self.entries.pop(server_address, None)
+                paths = [self.cache_path(server_address)]
+            else:
+                self.entries.clear()
+                paths = glob.glob(os.path.join(CONFIG.get("cache_folder", ".comfyui_cache"), "object_info_*.json"))
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        print_debug(f"节点信息缓存已失效: {server_address or '全部'}")
+
+node_schema_cache = NodeSchemaCache()
+
+def extract_checkpoints(object_info):
+    """从节点信息中提取可用的模型列表"""
+    checkpoints = []
+    if "CheckpointLoaderSimple" in object_info:
+        for input_name, input_info in object_info["CheckpointLoaderSimple"]["input"]["required"].items():
+            if input_name == "ckpt_name" and isinstance(input_info, list) and len(input_info) > 0:
+                checkpoints = input_info[0]
+    return checkpoints
+
+def get_available_models(server_address, refresh=False):
+    """获取服务器上可用的模型列表，refresh=True 时忽略节点信息缓存重新获取"""
     try:
-        response = requests.get(f"http://{server_address}/object_info")
-        if response.status_code != 200:
-            print(f"错误: 获取模型信息失败 - {response.status_code}")
+        object_info = node_schema_cache.get(server_address, refresh=refresh)
+        if object_info is None:
+            print(f"错误: 获取模型信息失败")
             return None
             
-        object_info = response.json()
-        
-        # 提取可用的模型
-        checkpoints = []
-        if "CheckpointLoaderSimple" in object_info:
-            for input_name, input_info in object_info["CheckpointLoaderSimple"]["input"]["required"].items():
-                if input_name == "ckpt_name" and isinstance(input_info, list) and len(input_info) > 0:
-                    checkpoints = input_info[0]
-                    print(f"可用模型: {', '.join(checkpoints[:5])}...")
-        
+        checkpoints = extract_checkpoints(object_info)
+        print_debug(f"可用模型: {', '.join(checkpoints[:5])}...")
         return checkpoints
     except Exception as e:
         print(f"获取可用模型失败: {e}")
         return None
         
-def update_workflow(workflow, input_image, positive_prompt):
-    """更新工作流参数"""
-    try:
-        if not workflow or not isinstance(workflow, dict):
-            print("错误: 无效的工作流数据")
-            return workflow
+def get_linked_node_id(value):
+    """从节点连接 [节点ID, 输出序号] 中取出节点ID"""
+    if isinstance(value, list) and len(value) > 0:
+        return str(value[0])
+    return None
+
+class WorkflowTemplate:
+    """编译后的工作流模板
+
+    工作流只解析一次，预先找出输入图像、提示词、种子和采样参数等所在的
+    节点/输入位置（补丁计划）。每个任务只需复制被修改的节点并写入参数，
+    其余节点与模板共享，不要直接修改渲染结果中的未修改节点。
+    """
+    
+    # 采样器节点上可直接设置的参数：参数名 -> 输入名
+    SAMPLER_INPUTS = {
+        "steps": "steps",
+        "cfg": "cfg",
+        "denoise": "denoise",
+        "sampler_name": "sampler_name",
+        "scheduler": "scheduler"
+    }
+    
+    # 每个任务渲染时都会覆盖的参数，其在模板中的值不影响结果，不计入指纹
+    PER_JOB_SLOTS = ["image", "positive_prompt", "seed"]
+    
+    def __init__(self, workflow, slots=None):
+        self.workflow = workflow
+        self.plan = {}  # 参数名 -> [(节点ID, 输入名), ...]
+        self.warned_models = set()
+        self.refreshed_models = set()  # 已为确认模型是否可用而重新获取过节点信息的 (服务器, 模型)
+        self.compile(slots if slots is not None else CONFIG.get("workflow_slots", {}))
+        
+        self.fingerprint = self.compute_fingerprint()
+        
+        # 在每个 SaveImage 节点旁增加 SaveImageWebsocket 节点的工作流变体，输出图像通过WebSocket返回；
+        # 保留原 SaveImage 节点，没有收到图像帧时仍可以从历史记录下载
+        self.save_nodes = [node_id for node_id, node in workflow.items()
+                           if isinstance(node, dict) and node.get("class_type") == "SaveImage"]
+        self.websocket_nodes = [f"{node_id}_ws" for node_id in self.save_nodes]
+        self.websocket_workflow = dict(workflow)
+        for node_id, websocket_node_id in zip(self.save_nodes, self.websocket_nodes):
+            self.websocket_workflow[websocket_node_id] = {
+                "class_type": "SaveImageWebsocket",
+                "inputs": {"images": workflow[node_id]["inputs"]["images"]}
+            }
+        
+    def add_path(self, name, node_id, input_name):
+        node = self.workflow.get(node_id)
+        if not isinstance(node, dict) or not isinstance(node.get("inputs"), dict):
+            print(f"警告: 参数 '{name}' 指向的节点 {node_id} 不存在")
+            return
+        if input_name not in node["inputs"]:
+            print(f"警告: 参数 '{name}' 指向的输入 {node_id}.{input_name} 不存在")
+            return
+        paths = self.plan.setdefault(name, [])
+        if (node_id, input_name) not in paths:
+            paths.append((node_id, input_name))
             
-        # 创建节点ID到类型的映射
+    def compile(self, slots):
+        """扫描工作流并生成补丁计划"""
         id_to_class_type = {}
-        for node_id, node_data in workflow.items():
-            if isinstance(node_data, dict) and "class_type" in node_data:
+        for node_id, node_data in self.workflow.items():
+            if isinstance(node_data, dict) and "class_type" in node_data and isinstance(node_data.get("inputs"), dict):
                 id_to_class_type[node_id] = node_data["class_type"]
-        
+                
         print_debug(f"工作流节点类型: {id_to_class_type}")
-        
-        # 如果没有找到任何节点，可能是工作流格式不对
         if not id_to_class_type:
             print("警告: 工作流中未找到任何有效节点")
-            return workflow
             
-        # 获取可用的模型
-        models = get_available_models(CONFIG["server_address"])
+        for node_id, class_type in id_to_class_type.items():
+            inputs = self.workflow[node_id]["inputs"]
+            
+            if class_type in ["CheckpointLoaderSimple", "CheckpointLoader"] and "ckpt_name" in inputs:
+                self.add_path("checkpoint", node_id, "ckpt_name")
+                
+            elif class_type in ["LoadImage", "LoadImageMask"] and "image" in inputs:
+                self.add_path("image", node_id, "image")
+                
+            elif "KSampler" in class_type:
+                for seed_input in ["seed", "noise_seed"]:
+                    if seed_input in inputs:
+                        self.add_path("seed", node_id, seed_input)
+                for name, input_name in self.SAMPLER_INPUTS.items():
+                    if input_name in inputs:
+                        self.add_path(name, node_id, input_name)
+                        
+                # 沿 positive/negative 连接找到提示词节点
+                for link_name, param_name in [("positive", "positive_prompt"), ("negative", "negative_prompt")]:
+                    text_node_id = get_linked_node_id(inputs.get(link_name))
+                    text_node = self.workflow.get(text_node_id) if text_node_id else None
+                    if (isinstance(text_node, dict) and isinstance(text_node.get("inputs"), dict) and
+                        isinstance(text_node["inputs"].get("text"), str)):
+                        self.add_path(param_name, text_node_id, "text")
+                        
+        # 用户声明的命名参数: {"名称": ["节点ID", "输入名"]} 或 {"名称": [["节点ID", "输入名"], ...]}
+        for name, spec in (slots or {}).items():
+            paths = spec if spec and isinstance(spec[0], list) else [spec]
+            self.plan.pop(name, None)
+            for node_id, input_name in paths:
+                self.add_path(name, str(node_id), input_name)
+                
+        print_debug(f"工作流补丁计划: {self.plan}")
+        
+    def compute_fingerprint(self):
+        """工作流指纹：屏蔽每个任务都会覆盖的输入后的哈希
+
+        重新生成默认工作流时随机写入的种子、上次的输入图像和提示词不会改变指纹，
+        任务日志在不同会话之间仍然可以匹配。
+        """
+        masked = dict(self.workflow)
+        for name in self.PER_JOB_SLOTS:
+            for node_id, input_name in self.plan.get(name, []):
+                node = masked[node_id]
+                masked[node_id] = dict(node, inputs=dict(node["inputs"], **{input_name: None}))
+        return hashlib.sha256(json.dumps(masked, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
         
-        # 检查并更新模型名称
-        checkpoint_nodes = [key for key, value in id_to_class_type.items() 
-                          if value in ["CheckpointLoaderSimple", "CheckpointLoader"]]
+    def current_value(self, name):
+        """返回模板中某个参数的当前值（取第一个位置）"""
+        paths = self.plan.get(name)
+        if not paths:
+            return None
+        node_id, input_name = paths[0]
+        return self.workflow[node_id]["inputs"][input_name]
         
-        if models and checkpoint_nodes:
-            for checkpoint_node in checkpoint_nodes:
-                if ("inputs" in workflow[checkpoint_node] and 
-                    "ckpt_name" in workflow[checkpoint_node]["inputs"]):
-                    current_model = workflow[checkpoint_node]["inputs"]["ckpt_name"]
-                    
-                    # 如果当前模型不在可用列表中，则更换为第一个可用模型
-                    if current_model not in models and models:
-                        print(f"注意: 模型 '{current_model}' 不可用，已切换到 '{models[0]}'")
-                        workflow[checkpoint_node]["inputs"]["ckpt_name"] = models[0]
-        
-        # 更新随机种子
-        k_sampler_nodes = [key for key, value in id_to_class_type.items() if 'KSampler' in value]
-        for k_sampler in k_sampler_nodes:
-            if ("inputs" in workflow[k_sampler] and 
-                isinstance(workflow[k_sampler]["inputs"], dict) and 
-                "seed" in workflow[k_sampler]["inputs"]):
-                workflow[k_sampler]["inputs"]["seed"] = random.randint(1, 2**32 - 1)
-                print_debug(f"更新种子值: {workflow[k_sampler]['inputs']['seed']}")
+    def target_size(self):
+        """工作流中缩放节点或空latent节点的目标尺寸（最长边），没有时返回 None"""
+        sizes = []
+        for node in self.workflow.values():
+            inputs = node.get("inputs") if isinstance(node, dict) else None
+            if (isinstance(inputs, dict) and isinstance(inputs.get("width"), int) and
+                isinstance(inputs.get("height"), int)):
+                sizes.append(max(inputs["width"], inputs["height"]))
+        return max(sizes) if sizes else None
+        
+    def resolve_checkpoint(self, server_address):
+        """模板中的模型在服务器上不可用时，返回替代的模型名"""
+        current_model = self.current_value("checkpoint")
+        if current_model is None:
+            return None
+        server_address = server_address or CONFIG["server_address"]
+        models = get_available_models(server_address)
+        if models and current_model not in models and (server_address, current_model) not in self.refreshed_models:
+            # 缓存的节点信息可能早于新安装的模型，替换之前重新获取一次
+            self.refreshed_models.add((server_address, current_model))
+            models = get_available_models(server_address, refresh=True) or models
+        if not models or current_model in models:
+            return None
+        if (server_address, current_model) not in self.warned_models:
+            self.warned_models.add((server_address, current_model))
+            print(f"注意: 模型 '{current_model}' 不可用，已切换到 '{models[0]}'")
+        return models[0]
+        
+    def render(self, params, server_address=None, websocket_output=False):
+        """按补丁计划生成一个任务的工作流；未指定 seed 时每个采样器使用随机种子"""
+        params = dict(params)
+        if "checkpoint" not in params:
+            replacement = self.resolve_checkpoint(server_address)
+            if replacement:
+                params["checkpoint"] = replacement
                 
-                # 更新正向提示词
-                if "positive" in workflow[k_sampler]["inputs"]:
-                    positive_node_id = workflow[k_sampler]["inputs"]["positive"]
-                    if isinstance(positive_node_id, list) and len(positive_node_id) > 0:
-                        positive_node_id = positive_node_id[0]
-                    
-                    if (positive_node_id in workflow and 
-                        isinstance(workflow[positive_node_id], dict) and
-                        "inputs" in workflow[positive_node_id] and 
-                        isinstance(workflow[positive_node_id]["inputs"], dict) and
-                        "text" in workflow[positive_node_id]["inputs"]):
-                        workflow[positive_node_id]["inputs"]["text"] = positive_prompt
-                        print_debug(f"更新正向提示词: {positive_prompt[:30]}...")
-        
-        # 更新输入图像
-        load_image_nodes = [key for key, value in id_to_class_type.items() if value in ["LoadImage", "LoadImageMask"]]
-        for load_image in load_image_nodes:
-            if ("inputs" in workflow[load_image] and 
-                isinstance(workflow[load_image]["inputs"], dict) and
-                "image" in workflow[load_image]["inputs"]):
-                workflow[load_image]["inputs"]["image"] = input_image
-                print_debug(f"更新输入图像: {input_image}")
+        workflow = dict(self.websocket_workflow if websocket_output else self.workflow)
+        copied = set()
         
-        return workflow
-    except Exception as e:
-        print(f"更新工作流失败: {e}")
-        import traceback
-        print(traceback.format_exc())
+        def patch(node_id, input_name, value):
+            if input_name not in workflow[node_id]["inputs"]:
+                return
+            if node_id not in copied:
+                node = workflow[node_id]
+                workflow[node_id] = dict(node, inputs=dict(node["inputs"]))
+                copied.add(node_id)
+            workflow[node_id]["inputs"][input_name] = value
+            
+        for name, value in params.items():
+            if value is None:
+                continue
+            paths = self.plan.get(name)
+            if not paths:
+                print_debug(f"工作流中没有参数 '{name}'，已忽略")
+                continue
+            for node_id, input_name in paths:
+                patch(node_id, input_name, value)
+                
+        if params.get("seed") is None:
+            for node_id, input_name in self.plan.get("seed", []):
+                patch(node_id, input_name, random.randint(1, 2**32 - 1))
+                print_debug(f"更新种子值: {workflow[node_id]['inputs'][input_name]}")
+                
         return workflow
 
-def track_progress(ws, prompt_id):
-    """跟踪图像生成进度"""
+    def downstream_nodes(self, node_ids):
+        """返回指定节点及其所有下游节点的ID集合"""
+        children = {}
+        for node_id, node in self.workflow.items():
+            if not isinstance(node, dict) or not isinstance(node.get("inputs"), dict):
+                continue
+            for value in node["inputs"].values():
+                linked_id = get_linked_node_id(value)
+                if linked_id:
+                    children.setdefault(linked_id, []).append(node_id)
+        result = set()
+        stack = list(node_ids)
+        while stack:
+            node_id = stack.pop()
+            if node_id not in result:
+                result.add(node_id)
+                stack.extend(children.get(node_id, []))
+        return result
+        
+    def render_variations(self, params, seeds, server_address=None, batched=False):
+        """生成一次产出多个变体的工作流，返回 (工作流, {输出节点ID: 种子})
+
+        batched=True 时在采样器前插入 RepeatLatentBatch，用 seeds[0] 一次采样 len(seeds) 个latent；
+        否则为每个种子复制采样器及其下游节点，模型加载、提示词编码和VAE编码只执行一次。
+        """
+        workflow = self.render(dict(params, seed=seeds[0]), server_address)
+        seed_paths = self.plan.get("seed", [])
+        samplers = {node_id for node_id, _ in seed_paths}
+        next_id = max([int(node_id) for node_id in workflow if str(node_id).isdigit()] + [0]) + 1
+        
+        if batched:
+            for node_id in samplers:
+                node = workflow[node_id]
+                latent = node["inputs"].get("latent_image")
+                # 级联采样器只在第一级前扩展批次
+                if not get_linked_node_id(latent) or get_linked_node_id(latent) in samplers:
+                    continue
+                repeat_id = str(next_id)
+                next_id += 1
+                workflow[repeat_id] = {
+                    "class_type": "RepeatLatentBatch",
+                    "inputs": {"samples": latent, "amount": len(seeds)}
+                }
+                workflow[node_id] = dict(node, inputs=dict(node["inputs"], latent_image=[repeat_id, 0]))
+            return workflow, {node_id: seeds[0] for node_id in self.save_nodes}
+            
+        branch = self.downstream_nodes(samplers)
+        output_seeds = {node_id: seeds[0] for node_id in self.save_nodes if node_id in branch}
+        for seed in seeds[1:]:
+            id_map = {}
+            for node_id in sorted(branch):
+                id_map[node_id] = str(next_id)
+                next_id += 1
+            for node_id, new_id in id_map.items():
+                node = workflow[node_id]
+                inputs = {}
+                for input_name, value in node["inputs"].items():
+                    linked_id = get_linked_node_id(value)
+                    if linked_id in id_map:
+                        value = [id_map[linked_id]] + list(value[1:])
+                    inputs[input_name] = value
+                for seed_node_id, input_name in seed_paths:
+                    if seed_node_id == node_id:
+                        inputs[input_name] = seed
+                workflow[new_id] = dict(node, inputs=inputs)
+                if node_id in output_seeds:
+                    output_seeds[new_id] = seed
+        return workflow, output_seeds
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+def load_template(path):
+    """加载并编译工作流模板，文件未修改时复用已编译的模板"""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    slots_key = json.dumps(CONFIG.get("workflow_slots", {}), sort_keys=True)
+    with _templates_lock:
+        cached = _templates.get(path)
+        if cached and cached[0] == (mtime, slots_key):
+            return cached[1]
+            
+    workflow = load_workflow(path)
+    if not workflow:
+        return None
+    template = WorkflowTemplate(workflow)
+    with _templates_lock:
+        _templates[path] = ((mtime, slots_key), template)
+    return template
+
+def parse_finish_message(message):
+    """解析WebSocket消息，若表示某个工作流结束则返回 (prompt_id, 是否成功)，否则返回 None"""
+    msg_type = message.get("type")
+    data = message.get("data") or {}
+    prompt_id = data.get("prompt_id")
+    if not prompt_id:
+        return None
+        
+    if msg_type == "executing" and data.get("node") is None:
+        return prompt_id, True
+    if msg_type == "execution_success":
+        return prompt_id, True
+    if msg_type in ["execution_error", "execution_interrupted"]:
+        return prompt_id, False
+    return None
+
+_websocket_output_warned = set()
+
+def websocket_output_enabled(template, server_address):
+    """判断本次任务是否通过WebSocket接收输出图像，服务器不支持时退回到历史记录方式"""
+    if not CONFIG.get("websocket_output", False) or not template.save_nodes:
+        return False
+    object_info = node_schema_cache.get(server_address)
+    if object_info and "SaveImageWebsocket" in object_info:
+        return True
+    if server_address not in _websocket_output_warned:
+        _websocket_output_warned.add(server_address)
+        print(f"注意: 服务器 {server_address} 不支持 SaveImageWebsocket 节点，使用历史记录获取输出图像")
+    return False
+
+def parse_image_frame(raw):
+    """解析WebSocket二进制消息，是图像帧时返回图像数据，否则返回 None"""
+    # 格式: 4字节事件类型(1=预览图像) + 4字节图像格式 + 图像数据
+    if len(raw) < 8 or int.from_bytes(raw[:4], "big") != 1:
+        return None
+    return raw[8:]
+
+def save_captured_images(images, output_name):
+    """保存通过WebSocket接收的输出图像，返回保存路径列表"""
+    saved_images = []
+    for image_data in images:
+        saved_path = save_output_image(image_data, output_name)
+        if saved_path:
+            saved_images.append(saved_path)
+    return saved_images
+
+def track_progress(client, prompt_id, capture_nodes=None, captured_images=None, timer=None):
+    """跟踪图像生成进度
+
+    指定 capture_nodes 时，这些节点执行期间收到的图像帧会追加到 captured_images。
+    指定 timer 时记录收到第一个 executing 消息的时间（开始执行）。
+    """
     print("正在生成图像，请稍候...")
+    reconnect_count = client.reconnect_count
+    current_node = None
     
     try:
         while True:
-            message = json.loads(ws.recv())
+            raw = client.recv()
+            if raw is None:
+                # 断线重连后可能错过了结束消息，通过历史记录确认
+                if client.reconnect_count != reconnect_count:
+                    reconnect_count = client.reconnect_count
+                    history = get_history(prompt_id, client.server_address)
+                    if history and prompt_id in history:
+                        print("生成完成")
+                        return history[prompt_id].get("status", {}).get("status_str", "success") != "error"
+                continue
+                
+            # 二进制消息：输出节点执行期间为输出图像，其余为预览图
+            if not isinstance(raw, str):
+                if capture_nodes and current_node in capture_nodes and captured_images is not None:
+                    image_data = parse_image_frame(raw)
+                    if image_data:
+                        captured_images.append(image_data)
+                continue
+                
+            message = json.loads(raw)
+            data = message.get("data") or {}
+            
+            # 忽略其他工作流的消息
+            if data.get("prompt_id") not in [None, prompt_id]:
+                continue
             
             if message["type"] == "progress":
-                progress = message["data"]["value"]
-                max_progress = message["data"]["max"]
+                progress = data["value"]
+                max_progress = data["max"]
                 print(f"进度: {progress}/{max_progress}")
                 
             elif message["type"] == "executing":
-                node_name = message["data"].get("node", "未知节点")
-                print_debug(f"正在执行节点: {node_name}")
+                current_node = data.get("node")
+                if timer and timer.started_at is None and current_node is not None:
+                    timer.started_at = time.perf_counter()
+                print_debug(f"正在执行节点: {current_node}")
                 
             elif message["type"] == "execution_cached":
-                print_debug(f"缓存执行: {message['data']}")
+                print_debug(f"缓存执行: {data}")
                 
             # 检查完成状态
-            if (message["type"] == "executed" and
-                "prompt_id" in message["data"] and
-                message["data"]["prompt_id"] == prompt_id):
-                print("生成完成")
-                return True
+            finished = parse_finish_message(message)
+            if finished:
+                if finished[1]:
+                    print("生成完成")
+                    return True
+                print("服务器执行工作流失败")
+                return False
                 
     except Exception as e:
         print(f"跟踪进度时出错: {e}")
@@ -381,17 +1510,43 @@ def track_progress(ws, prompt_id):
         print(traceback.format_exc())
         return False
 
+def make_output_path(output_name, extension=".png"):
+    """生成不会与并发输出冲突的输出文件路径"""
+    os.makedirs(CONFIG["output_folder"], exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"{output_name}_{timestamp}_{uuid.uuid4().hex[:8]}{extension}"
+    return os.path.join(CONFIG["output_folder"], filename)
+
+def write_file_atomic(filepath, chunks):
+    """把数据块写入同目录下的临时文件，完成后原子地重命名为目标文件
+
+    返回写入磁盘所用的时间（秒，不含等待数据块的时间），并计入当前任务的保存阶段。
+    """
+    folder, filename = os.path.split(filepath)
+    temp_path = os.path.join(folder, f".{filename}.{uuid.uuid4().hex}.part")
+    write_seconds = 0.0
+    try:
+        with open(temp_path, "wb") as f:
+            for chunk in chunks:
+                if chunk:
+                    start = time.perf_counter()
+                    f.write(chunk)
+                    write_seconds += time.perf_counter() - start
+            # 关闭文件时的刷新和重命名也计入写入时间
+            start = time.perf_counter()
+        os.replace(temp_path, filepath)
+        write_seconds += time.perf_counter() - start
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    add_span("save", write_seconds)
+    return write_seconds
+
 def save_output_image(image_data, output_name):
     """保存输出图像到本地"""
     try:
-        os.makedirs(CONFIG["output_folder"], exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        filename = f"{output_name}_{timestamp}.png"
-        filepath = os.path.join(CONFIG["output_folder"], filename)
-        
-        with open(filepath, "wb") as img_file:
-            img_file.write(image_data)
+        filepath = make_output_path(output_name)
+        write_file_atomic(filepath, [image_data])
             
         print(f"图像已保存: {filepath}")
         return filepath
@@ -399,83 +1554,263 @@ def save_output_image(image_data, output_name):
         print(f"保存图像失败: {e}")
         return None
 
-def generate_image(input_image_path, positive_prompt, output_name=None):
-    """主函数：执行图生图过程"""
-    if not os.path.exists(input_image_path):
-        print(f"错误: 输入图像不存在 - {input_image_path}")
-        return False
+def with_fixed_seed(params):
+    """未指定种子时使用配置中的固定种子"""
+    params = dict(params or {})
+    if params.get("seed") is None and CONFIG.get("fixed_seed") is not None:
+        params["seed"] = CONFIG["fixed_seed"]
+    return params
+
+def make_result_key(template, input_path, params, server_address):
+    """生成结果缓存键，随机种子的任务不缓存，返回 None
+
+    键由输入图像内容哈希、预处理选项和按参数渲染出的完整工作流共同决定，
+    因此模型替换、工作流修改或任何参数变化都会产生新的键。
+    """
+    if not CONFIG.get("result_cache", True) or params.get("seed") is None:
+        return None
+    workflow = template.render(dict(params, image=get_file_hash(input_path)), server_address)
+    raw = json.dumps([workflow, get_preprocess_options(template)], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """本地生成结果缓存
+
+    每个缓存键对应缓存文件夹下的一个目录，保存该任务的全部输出图像。
+    命中时更新目录的修改时间，总大小超过磁盘上限时按修改时间淘汰最久未使用的结果。
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        
+    def folder(self):
+        return os.path.join(CONFIG.get("cache_folder", ".comfyui_cache"), "results")
+        
+    def get(self, key):
+        """返回缓存的输出图像路径列表，未命中时返回 None"""
+        entry_path = os.path.join(self.folder(), key)
+        with self.lock:
+            try:
+                paths = sorted(os.path.join(entry_path, name) for name in os.listdir(entry_path))
+                os.utime(entry_path)
+            except OSError:
+                return None
+        return paths or None
+        
+    def restore(self, key, output_name):
+        """把缓存的输出图像复制到输出文件夹，返回保存路径列表"""
+        cached_paths = self.get(key)
+        live_metrics.count_cache("result", "hit" if cached_paths else "miss")
+        if not cached_paths:
+            return []
+        saved_images = []
+        try:
+            for cached_path in cached_paths:
+                filepath = make_output_path(output_name, os.path.splitext(cached_path)[1])
+                with open(cached_path, "rb") as f:
+                    write_file_atomic(filepath, iter(lambda: f.read(1024 * 1024), b""))
+                saved_images.append(filepath)
+        except OSError as e:
+            print(f"读取结果缓存失败: {e}")
+            return []
+        for filepath in saved_images:
+            print(f"图像已保存: {filepath} (结果缓存)")
+        return saved_images
+        
+    def put(self, key, saved_images):
+        """保存一个任务的输出图像"""
+        folder = self.folder()
+        entry_path = os.path.join(folder, key)
+        temp_path = os.path.join(folder, f".{key}.{uuid.uuid4().hex}.part")
+        try:
+            os.makedirs(temp_path)
+            for index, image_path in enumerate(saved_images):
+                shutil.copyfile(image_path, os.path.join(temp_path, f"{index:04d}{os.path.splitext(image_path)[1]}"))
+            with self.lock:
+                if not os.path.exists(entry_path):
+                    os.replace(temp_path, entry_path)
+        except OSError as e:
+            print_debug(f"写入结果缓存失败: {e}")
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self.evict()
         
-    # 首先确保有一个可用的工作流
+    def evict(self):
+        """删除最久未使用的结果，直到总大小不超过磁盘上限"""
+        budget = CONFIG.get("result_cache_max_mb", 1024) * 1024 * 1024
+        folder = self.folder()
+        with self.lock:
+            entries = []
+            total_size = 0
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                return
+            for name in names:
+                entry_path = os.path.join(folder, name)
+                if name.startswith(".") or not os.path.isdir(entry_path):
+                    continue
+                try:
+                    size = sum(entry.stat().st_size for entry in os.scandir(entry_path))
+                    entries.append((os.path.getmtime(entry_path), size, entry_path))
+                except OSError:
+                    continue
+                total_size += size
+            entries.sort()
+            for _, size, entry_path in entries:
+                if total_size <= budget:
+                    break
+                shutil.rmtree(entry_path, ignore_errors=True)
+                total_size -= size
+                print_debug(f"结果缓存已淘汰: {os.path.basename(entry_path)}")
+
+result_cache = ResultCache()
+
+def load_active_template():
+    """加载当前配置的工作流模板，不存在或无效时创建默认工作流"""
     if not os.path.exists(CONFIG["workflow_path"]):
         print(f"工作流文件不存在，创建默认工作流")
         create_default_workflow()
         
+    template = load_template(CONFIG["workflow_path"])
+    if not template:
+        print("创建并使用默认工作流")
+        create_default_workflow()
+        template = load_template(CONFIG["workflow_path"])
+        if not template:
+            print("无法创建工作流，程序退出")
+            return None
+    return template
+
+_download_pool = None
+_download_pool_lock = threading.Lock()
+
+def get_download_pool():
+    """获取用于并行下载输出图像的共享线程池"""
+    global _download_pool
+    with _download_pool_lock:
+        if _download_pool is None:
+            _download_pool = ThreadPoolExecutor(max_workers=max(1, int(CONFIG.get("io_workers", 4))))
+        return _download_pool
+
+def collect_output_images(prompt_id, server_address, output_name):
+    """从历史记录中获取工作流的输出图像并保存到本地，返回保存路径列表"""
+    history = get_history(prompt_id, server_address)
+    if not history or prompt_id not in history:
+        return []
+        
+    outputs = history[prompt_id].get("outputs", {})
+    image_infos = [image_info for node_output in outputs.values()
+                   for image_info in node_output.get("images", [])]
+    
+    timer = get_current_timer()
+    
+    def download(image_info):
+        with use_timer(timer):
+            return download_image(
+                image_info["filename"],
+                image_info["subfolder"],
+                image_info["type"],
+                server_address,
+                output_name
+            )
+        
+    # 多张输出图像时并行下载
+    if len(image_infos) > 1:
+        saved_paths = list(get_download_pool().map(download, image_infos))
+    else:
+        saved_paths = [download(image_info) for image_info in image_infos]
+    return [path for path in saved_paths if path]
+
+def generate_image(input_image_path, positive_prompt, output_name=None, params=None):
+    """主函数：执行图生图过程，params 为额外的工作流参数（命名参数）
+
+    各阶段耗时写入指标文件（见 MetricsRecorder）。
+    """
+    timer = JobTimer()
+    job_info = {}
+    with use_timer(timer):
+        success = run_generation(input_image_path, positive_prompt, output_name, params, timer, job_info)
+    record = metrics_recorder.record(timer, kind="single", input_path=input_image_path, success=success, **job_info)
+    print_debug(f"阶段耗时(ms): {record['spans_ms']}")
+    return success
+
+def run_generation(input_image_path, positive_prompt, output_name, params, timer, job_info):
+    """执行单个图生图任务，job_info 中记录服务器地址和 prompt_id"""
+    if not os.path.exists(input_image_path):
+        print(f"错误: 输入图像不存在 - {input_image_path}")
+        return False
+        
     if not output_name:
         output_name = f"img2img_{os.path.basename(input_image_path).split('.')[0]}"
     
-    # 建立连接
-    ws, server_address, client_id = establish_connection()
-    if not ws:
+    # 建立连接（复用共享会话）
+    client = get_client()
+    with timer.span("connect"):
+        connected = client.connect()
+    if not connected:
         return False
+    server_address = client.server_address
+    job_info["server_address"] = server_address
     
     try:
-        # 加载工作流
-        workflow = load_workflow(CONFIG["workflow_path"])
-        if not workflow:
-            print("创建并使用默认工作流")
-            create_default_workflow()
-            workflow = load_workflow(CONFIG["workflow_path"])
-            if not workflow:
-                print("无法创建工作流，程序退出")
-                return False
+        # 加载工作流模板
+        template = load_active_template()
+        if not template:
+            return False
+            
+        # 固定种子时先查找结果缓存
+        job_params = with_fixed_seed(dict(params or {}, positive_prompt=positive_prompt))
+        result_key = make_result_key(template, input_image_path, job_params, server_address)
+        if result_key:
+            saved_images = result_cache.restore(result_key, output_name)
+            if saved_images:
+                job_info["result_cache"] = True
+                job_info["images"] = len(saved_images)
+                print(f"命中结果缓存，已保存 {len(saved_images)} 张图像")
+                return True
             
         # 上传输入图像
-        uploaded_filename = upload_image(input_image_path, server_address)
+        with timer.span("upload"):
+            uploaded_filename = upload_image(input_image_path, server_address,
+                                             preprocess=get_preprocess_options(template))
         if not uploaded_filename:
             return False
             
-        # 更新工作流
-        updated_workflow = update_workflow(workflow, uploaded_filename, positive_prompt)
+        # 按模板生成本次任务的工作流
+        job_params["image"] = uploaded_filename
+        websocket_output = websocket_output_enabled(template, server_address)
+        updated_workflow = template.render(job_params, server_address, websocket_output)
         
         # 提交工作流到队列
-        queue_result = queue_prompt(updated_workflow, client_id, server_address)
+        timer.submitted_at = time.perf_counter()
+        queue_result = queue_prompt(updated_workflow, client.client_id, server_address)
         if not queue_result:
+            upload_registry.forget(server_address, uploaded_filename)
             return False
             
         prompt_id = queue_result["prompt_id"]
+        job_info["prompt_id"] = prompt_id
         print(f"工作流已提交，ID: {prompt_id}")
         
         # 跟踪进度
-        if not track_progress(ws, prompt_id):
+        captured_images = []
+        capture_nodes = template.websocket_nodes if websocket_output else None
+        finished = track_progress(client, prompt_id, capture_nodes, captured_images, timer)
+        timer.record_execution(timer.started_at, time.perf_counter())
+        if not finished:
             print("生成失败或中断")
             return False
             
-        # 获取结果
-        history = get_history(prompt_id, server_address)
-        if not history:
-            return False
-            
-        outputs = history[prompt_id]["outputs"]
-        
-        # 获取并保存输出图像
-        saved_images = []
-        for node_id in outputs:
-            node_output = outputs[node_id]
-            if "images" in node_output:
-                for image_info in node_output["images"]:
-                    image_data = get_image(
-                        image_info["filename"],
-                        image_info["subfolder"],
-                        image_info["type"],
-                        server_address
-                    )
-                    
-                    if image_data:
-                        saved_path = save_output_image(image_data, output_name)
-                        if saved_path:
-                            saved_images.append(saved_path)
+        # 获取并保存输出图像，没有收到WebSocket图像时通过历史记录获取
+        saved_images = save_captured_images(captured_images, output_name)
+        if not saved_images:
+            saved_images = collect_output_images(prompt_id, server_address, output_name)
         
         if saved_images:
+            job_info["images"] = len(saved_images)
+            if result_key:
+                result_cache.put(result_key, saved_images)
             print(f"成功生成 {len(saved_images)} 张图像")
             return True
         else:
@@ -487,10 +1822,136 @@ def generate_image(input_image_path, positive_prompt, output_name=None):
         import traceback
         print(traceback.format_exc())
         return False
+
+def collect_variation_images(prompt_id, server_address, output_name, output_seeds, batched=False):
+    """按输出节点下载变体图像，返回 [{"seed", "batch_index", "path"}, ...]"""
+    history = get_history(prompt_id, server_address)
+    if not history or prompt_id not in history:
+        return []
         
-    finally:
-        ws.close()
-        print("连接已关闭")
+    tasks = []
+    for node_id, node_output in history[prompt_id].get("outputs", {}).items():
+        seed = output_seeds.get(node_id)
+        if seed is None:
+            continue
+        for batch_index, image_info in enumerate(node_output.get("images", [])):
+            tasks.append((seed, batch_index if batched else None, image_info))
+            
+    timer = get_current_timer()
+    
+    def download(task):
+        seed, batch_index, image_info = task
+        name = f"{output_name}_seed{seed}" + (f"_b{batch_index}" if batched else "")
+        with use_timer(timer):
+            path = download_image(image_info["filename"], image_info["subfolder"], image_info["type"],
+                                  server_address, name)
+        return {"seed": seed, "batch_index": batch_index, "path": path}
+        
+    return [variation for variation in get_download_pool().map(download, tasks) if variation["path"]]
+
+def generate_variations(input_image_path, positive_prompt, count=4, seeds=None, output_name=None, params=None):
+    """在一次工作流中生成同一输入的多个变体，并把种子与输出图像的对应关系保存为JSON
+
+    指定 seeds 时为每个种子复制采样分支；否则按 variations_batched 配置使用latent批次
+    （一个种子，批次序号区分变体）或随机生成 count 个种子。各阶段耗时写入指标文件。
+    """
+    timer = JobTimer()
+    job_info = {}
+    with use_timer(timer):
+        success = run_variations(input_image_path, positive_prompt, count, seeds, output_name, params,
+                                 timer, job_info)
+    record = metrics_recorder.record(timer, kind="variations", input_path=input_image_path, success=success,
+                                     **job_info)
+    print_debug(f"阶段耗时(ms): {record['spans_ms']}")
+    return success
+
+def run_variations(input_image_path, positive_prompt, count, seeds, output_name, params, timer, job_info):
+    """执行变体生成任务，job_info 中记录服务器地址、prompt_id 和图像数"""
+    if not os.path.exists(input_image_path):
+        print(f"错误: 输入图像不存在 - {input_image_path}")
+        return False
+        
+    if not output_name:
+        output_name = f"var_{os.path.basename(input_image_path).split('.')[0]}"
+        
+    client = get_client()
+    with timer.span("connect"):
+        connected = client.connect()
+    if not connected:
+        return False
+    server_address = client.server_address
+    job_info["server_address"] = server_address
+    
+    try:
+        template = load_active_template()
+        if not template:
+            return False
+        if not template.plan.get("seed") or not template.save_nodes:
+            print("错误: 工作流中没有采样器或 SaveImage 节点，无法生成变体")
+            return False
+            
+        job_params = with_fixed_seed(dict(params or {}, positive_prompt=positive_prompt))
+        batched = False
+        if not seeds:
+            base_seed = job_params.get("seed")
+            object_info = node_schema_cache.get(server_address)
+            batched = CONFIG.get("variations_batched", True) and bool(object_info and "RepeatLatentBatch" in object_info)
+            if batched:
+                seeds = [base_seed if base_seed is not None else random.randint(1, 2**32 - 1)] * count
+            else:
+                seeds = [random.randint(1, 2**32 - 1) for _ in range(count)]
+                
+        with timer.span("upload"):
+            uploaded_filename = upload_image(input_image_path, server_address,
+                                             preprocess=get_preprocess_options(template))
+        if not uploaded_filename:
+            return False
+        job_params["image"] = uploaded_filename
+        
+        workflow, output_seeds = template.render_variations(job_params, seeds, server_address, batched)
+        print_debug(f"变体工作流节点数: {len(workflow)}")
+        timer.submitted_at = time.perf_counter()
+        queue_result = queue_prompt(workflow, client.client_id, server_address)
+        if not queue_result:
+            upload_registry.forget(server_address, uploaded_filename)
+            return False
+            
+        prompt_id = queue_result["prompt_id"]
+        job_info["prompt_id"] = prompt_id
+        print(f"工作流已提交，ID: {prompt_id}，变体数: {len(seeds)}")
+        finished = track_progress(client, prompt_id, timer=timer)
+        timer.record_execution(timer.started_at, time.perf_counter())
+        if not finished:
+            print("生成失败或中断")
+            return False
+            
+        variations = collect_variation_images(prompt_id, server_address, output_name, output_seeds, batched)
+        job_info["images"] = len(variations)
+        if not variations:
+            print("没有生成任何图像")
+            return False
+            
+        # 记录种子与输出图像的对应关系，便于复现单个变体
+        mapping = {
+            "input_image": input_image_path,
+            "positive_prompt": positive_prompt,
+            "params": dict(params or {}),
+            "prompt_id": prompt_id,
+            "server_address": server_address,
+            "batched": batched,
+            "batch_size": len(seeds) if batched else 1,
+            "variations": variations
+        }
+        mapping_path = make_output_path(f"{output_name}_variations", ".json")
+        write_json_atomic(mapping_path, mapping)
+        print(f"成功生成 {len(variations)} 个变体，种子记录: {mapping_path}")
+        return True
+        
+    except Exception as e:
+        print(f"生成变体时出错: {e}")
+        import traceback
+        print(traceback.format_exc())
+        return False
 
 def list_input_images():
     """列出输入文件夹中的图像"""
@@ -511,16 +1972,14 @@ def get_comfyui_info(server_address):
     print("获取ComfyUI服务器详细信息...")
     
     try:
-        # 获取对象信息
-        response = requests.get(f"http://{server_address}/object_info")
-        if response.status_code != 200:
-            print(f"错误: 获取对象信息失败 - {response.status_code}")
+        # 获取对象信息（使用缓存）
+        object_info = node_schema_cache.get(server_address)
+        if object_info is None:
+            print(f"错误: 获取对象信息失败")
             return None
-            
-        object_info = response.json()
         
         # 获取系统信息
-        response = requests.get(f"http://{server_address}/system_stats")
+        response = get_client(server_address).get("/system_stats")
         if response.status_code != 200:
             print(f"错误: 获取系统信息失败 - {response.status_code}")
             return None
@@ -528,7 +1987,7 @@ def get_comfyui_info(server_address):
         system_stats = response.json()
         
         # 获取当前队列和历史记录
-        response = requests.get(f"http://{server_address}/queue")
+        response = get_client(server_address).get("/queue")
         queue_info = response.json() if response.status_code == 200 else {}
         
         # 提取有用信息
@@ -539,13 +1998,10 @@ def get_comfyui_info(server_address):
         }
         
         # 提取可用模型
-        checkpoints = []
-        if "CheckpointLoaderSimple" in object_info:
-            for input_name, input_info in object_info["CheckpointLoaderSimple"]["input"]["required"].items():
-                if input_name == "ckpt_name" and isinstance(input_info, list) and len(input_info) > 0:
-                    checkpoints = input_info[0]
-                    print(f"可用模型: {', '.join(checkpoints[:5])}...")
-                    info["checkpoints"] = checkpoints
+        checkpoints = extract_checkpoints(object_info)
+        if checkpoints:
+            print(f"可用模型: {', '.join(checkpoints[:5])}...")
+            info["checkpoints"] = checkpoints
         
         # 提取可用的CLIP模型
         clip_models = []
@@ -684,30 +2140,24 @@ def create_default_workflow(server_info=None):
     print("已创建默认工作流: default_workflow.json")
     return default_workflow
 
-def interactive_mode():
-    """交互模式"""
-    print("\n=== ComfyUI 图生图 API 客户端 ===")
-    print(f"输入图片文件夹: {CONFIG['input_folder']}")
-    print(f"输出文件夹: {CONFIG['output_folder']}")
-    print(f"ComfyUI服务器: {CONFIG['server_address']}")
-    
-    # 检查服务器连接
-    ws, server_address, client_id = establish_connection()
-    if not ws:
+_prepared_servers = set()
+
+def prepare_server():
+    """交互模式中第一次需要服务器时检查连接、获取服务器信息并创建默认工作流，每个地址只执行一次"""
+    if CONFIG["server_address"] in _prepared_servers:
+        return True
+        
+    # 检查服务器连接，连接会在后续生成中复用
+    if not get_client().connect():
         # 尝试更新服务器地址
         new_address = input("请输入ComfyUI服务器地址 (例如: 127.0.0.1:8188): ").strip()
-        if new_address:
-            CONFIG["server_address"] = new_address
-            ws, server_address, client_id = establish_connection()
-            if not ws:
-                print("无法连接到ComfyUI服务器，程序退出")
-                return
-        else:
-            print("未提供服务器地址，程序退出")
-            return
-    
-    if ws:
-        ws.close()  # 关闭测试连接
+        if not new_address:
+            print("未提供服务器地址")
+            return False
+        CONFIG["server_address"] = new_address
+        if not get_client().connect():
+            print("无法连接到ComfyUI服务器")
+            return False
     
     # 获取ComfyUI服务器信息并创建工作流
     server_info = get_comfyui_info(CONFIG["server_address"])
@@ -716,6 +2166,16 @@ def interactive_mode():
     if not os.path.exists(CONFIG["workflow_path"]) or server_info:
         print("创建默认工作流")
         create_default_workflow(server_info)
+        
+    _prepared_servers.add(CONFIG["server_address"])
+    return True
+
+def interactive_mode():
+    """交互模式，连接服务器推迟到第一次生成图像时"""
+    print("\n=== ComfyUI 图生图 API 客户端 ===")
+    print(f"输入图片文件夹: {CONFIG['input_folder']}")
+    print(f"输出文件夹: {CONFIG['output_folder']}")
+    print(f"ComfyUI服务器: {CONFIG['server_address']}")
     
     while True:
         print("\n=== 主菜单 ===")
@@ -729,6 +2189,9 @@ def interactive_mode():
         choice = input("请选择: ").strip()
         
         if choice == "1":
+            if not prepare_server():
+                continue
+                
             # 列出可用的输入图像
             input_images = list_input_images()
             if not input_images:
@@ -786,6 +2249,9 @@ def interactive_mode():
                     print(traceback.format_exc())
         
         elif choice == "2":  # 批量处理
+            if not prepare_server():
+                continue
+                
             # 列出可用的输入图像
             input_images = list_input_images()
             if not input_images:
@@ -861,7 +2327,8 @@ def interactive_mode():
             print("4. 采样参数 (步数/CFG/去噪)")
             print("5. 默认负面提示词")
             print("6. 其他设置")
-            print("7. 返回")
+            print("7. 刷新服务器节点信息缓存")
+            print("8. 返回")
             
             config_choice = input("请选择要修改的配置: ").strip()
             
@@ -957,9 +2424,24 @@ def interactive_mode():
                     CONFIG["save_workflow"] = True
                 elif save_workflow in ['n', 'no', '否']:
                     CONFIG["save_workflow"] = False
-                
+
+                current_seed = CONFIG.get("fixed_seed")
+                fixed_seed = input(f"固定种子 (输入数字，'r' 表示随机, 当前: {current_seed if current_seed is not None else '随机'}): ").strip().lower()
+                if fixed_seed == "r":
+                    CONFIG["fixed_seed"] = None
+                elif fixed_seed:
+                    try:
+                        CONFIG["fixed_seed"] = int(fixed_seed)
+                    except ValueError:
+                        print("无效的种子值，保持不变")
+
                 save_config()
                 print("设置已更新")
+            
+            elif config_choice == "7":
+                node_schema_cache.invalidate(CONFIG["server_address"])
+                if node_schema_cache.get(CONFIG["server_address"]) is not None:
+                    print("节点信息已刷新")
         
         elif choice == "4":  # 查看当前配置
             print("\n=== 当前配置 ===")
@@ -977,16 +2459,33 @@ def interactive_mode():
         else:
             print("无效的选择，请重试")
 
-def check_queue_status(server_address):
-    """检查ComfyUI队列状态"""
+def get_queue(server_address):
+    """获取ComfyUI队列数据，失败时返回 None"""
     try:
-        response = requests.get(f"http://{server_address}/queue")
-        
+        response = get_client(server_address).get("/queue")
         if response.status_code != 200:
             print(f"错误: 获取队列信息失败 - {response.status_code}")
             return None
-            
-        queue_data = response.json()
+        return response.json()
+    except Exception as e:
+        print_debug(f"获取队列信息失败: {e}")
+        return None
+
+def get_queued_prompt_ids(server_address):
+    """获取队列中（执行中和等待中）的所有 prompt_id，失败时返回 None"""
+    queue_data = get_queue(server_address)
+    if queue_data is None:
+        return None
+    # 队列项格式: [序号, prompt_id, prompt, extra_data, outputs]
+    return {item[1] for key in ["queue_running", "queue_pending"]
+            for item in queue_data.get(key, []) if len(item) > 1}
+
+def check_queue_status(server_address):
+    """检查ComfyUI队列状态"""
+    try:
+        queue_data = get_queue(server_address)
+        if queue_data is None:
+            return None
         
         # 检查当前队列中的任务数量
         queue_running = queue_data.get("queue_running", [])
@@ -998,7 +2497,7 @@ def check_queue_status(server_address):
         # 如果有正在执行的任务，打印详细信息
         if queue_running:
             for i, task in enumerate(queue_running):
-                task_id = task.get("prompt_id", "未知")
+                task_id = task[1] if len(task) > 1 else "未知"
                 print(f"  运行中 #{i+1}: ID {task_id}")
                 
         # 如果有等待的任务，打印数量
@@ -1013,36 +2512,865 @@ def check_queue_status(server_address):
         print(f"检查队列状态失败: {e}")
         return None
 
-def batch_process(input_images, positive_prompt):
-    """批量处理多个图像"""
-    if not input_images:
-        print("没有输入图像，无法批处理")
-        return False
+def get_affinity_key(job, template):
+    """任务的缓存亲和键：(模型, 正向提示词, 负面提示词, 输入图像路径)
+
+    ComfyUI 会跳过输入未变化的节点，相邻任务的键前缀越长，可复用的节点越多
+    （模型加载、CLIP编码、图像加载与VAE编码）。输入图像只比较路径，
+    排序时不需要读取文件内容，第一个任务可以立即提交。
+    """
+    params = job.get("params") or {}
+    checkpoint = params.get("checkpoint", template.current_value("checkpoint"))
+    negative_prompt = params.get("negative_prompt", template.current_value("negative_prompt"))
+    image_key = os.path.abspath(job["input_path"])
+    return (str(checkpoint), str(job["positive_prompt"]), str(negative_prompt), image_key)
+
+def affinity_score(key, other_key):
+    """两个亲和键相同前缀的长度"""
+    if not key or not other_key:
+        return 0
+    score = 0
+    for part, other_part in zip(key, other_key):
+        if part != other_part:
+            break
+        score += 1
+    return score
+
+def schedule_jobs(jobs, template):
+    """按缓存亲和键排序任务，使模型、提示词和输入图像相同的任务相邻执行"""
+    for job in jobs:
+        job["affinity_key"] = get_affinity_key(job, template)
+    return sorted(jobs, key=lambda job: job["affinity_key"])
+
+def make_job_key(job, template):
+    """任务键：输入图像内容哈希、提示词、工作流哈希和参数共同决定"""
+    raw = json.dumps([
+        get_file_hash(job["input_path"]),
+        job["positive_prompt"],
+        template.fingerprint,
+        job.get("params") or {}
+    ], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def make_batch_id(input_images, positive_prompt, params=None):
+    """批处理标识：同一组输入文件夹、提示词、参数和工作流的批处理共用一个任务日志"""
+    folders = sorted({os.path.dirname(os.path.abspath(path)) for path in input_images})
+    raw = json.dumps([folders, positive_prompt, params or {}, CONFIG["workflow_path"]],
+                     sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+class BatchJournal:
+    """批处理任务日志
+
+    以追加方式记录每个任务的状态（queued/running/done/failed）、prompt_id、
+    服务器和输出路径。重新运行同一批处理时跳过已完成的任务，
+    并重新关联仍在服务器上执行的工作流。
+    """
+    
+    def __init__(self, batch_id):
+        self.path = os.path.join(CONFIG.get("cache_folder", ".comfyui_cache"), "journals", f"{batch_id}.jsonl")
+        self.entries = {}  # job_key -> 最新记录
+        self.lock = threading.Lock()
+        self.load()
         
-    successful = 0
-    failed = 0
-    start_time = time.time()
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 崩溃时可能留下不完整的最后一行
+                        continue
+                    self.entries[record["key"]] = record
+        except Exception as e:
+            print(f"读取任务日志失败: {e}")
+            
+    def get(self, job_key):
+        with self.lock:
+            return self.entries.get(job_key)
+            
+    def record(self, job_key, state, **fields):
+        record = dict(fields, key=job_key, state=state, time=time.time())
+        with self.lock:
+            self.entries[job_key] = record
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print_debug(f"写入任务日志失败: {e}")
+                
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+def get_server_pool():
+    """获取批处理使用的服务器地址列表"""
+    server_addresses = [address for address in CONFIG.get("server_addresses") or [] if address]
+    return server_addresses or [CONFIG["server_address"]]
+
+class ServerLane:
+    """批处理引擎中单个服务器的状态"""
     
-    print(f"开始批量处理 {len(input_images)} 张图像")
-    print(f"使用正向提示词: {positive_prompt}")
+    failure_limit = 3  # 连续失败次数达到该值后暂停向该服务器派发任务
+    cooldown = 30  # 暂停派发的时长（秒）
+    completed_limit = 1000  # 保留的最近结束的工作流ID数
     
-    for i, image_path in enumerate(input_images):
-        print(f"\n处理图像 {i+1}/{len(input_images)}: {os.path.basename(image_path)}")
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.client = get_client(server_address)
+        self.pending = {}  # prompt_id -> 任务
+        self.early_finished = {}  # 任务登记前就收到的结束消息 prompt_id -> (是否成功, 可否重试)
+        self.completed_ids = {}  # 最近结束的工作流ID（按结束顺序），用于忽略重复的结束消息
+        self.in_flight = 0  # 本批次在该服务器上占用的槽位数
+        self.queue_depth = 0  # 服务器上执行中+等待中的任务数（包括其他客户端），来自WebSocket status 消息或 /queue
+        self.submitted_since_poll = 0  # 上次更新队列深度后派发、尚未计入的任务数
+        self.submitting = 0  # 已派发但 /prompt 尚未返回的任务数
+        self.status_seen = False  # 当前连接是否收到过 status 消息，收到后不再轮询 /queue
+        self.failures = 0
+        self.disabled_until = 0
+        self.dead = False
+        self.previous_timeout = None
+        self.thread = None
+        self.current_node = None  # 当前正在执行的 (prompt_id, 节点ID)
+        self.captured = {}  # prompt_id -> 通过WebSocket收到的输出图像
+        self.cached_nodes = {}  # prompt_id -> 服务器缓存命中（跳过执行）的节点数
+        self.started_at = {}  # prompt_id -> 收到第一个 executing 消息的时间
+        self.last_affinity_key = None  # 最近派发到该服务器的任务的缓存亲和键
         
-        try:
-            # 使用图像文件名作为输出文件名前缀
-            output_name = f"batch_{os.path.basename(image_path).split('.')[0]}"
+    def load(self):
+        """当前负载：服务器队列深度加上上次轮询后新提交的任务"""
+        return max(self.queue_depth + self.submitted_since_poll, self.in_flight)
+        
+    def usable(self):
+        # 正在重连的服务器暂不派发新任务
+        return not self.dead and self.client.ws is not None and time.time() >= self.disabled_until
+        
+    def set_queue_depth(self, queue_depth):
+        # 尚未提交完成的任务不在服务器队列中，继续计入负载
+        self.queue_depth = queue_depth
+        self.submitted_since_poll = self.submitting
+        
+    def note_finished(self):
+        # 本批次的工作流结束后先估算新的队列深度，下一条 status 消息或 /queue 轮询会给出准确值
+        if self.queue_depth > 0:
+            self.queue_depth -= 1
+        elif self.submitted_since_poll > self.submitting:
+            self.submitted_since_poll -= 1
             
-            success = generate_image(image_path, positive_prompt, output_name)
+    def mark_completed(self, prompt_id):
+        """记录结束的工作流，已记录过时返回 False"""
+        if prompt_id in self.completed_ids:
+            return False
+        self.completed_ids[prompt_id] = True
+        if len(self.completed_ids) > self.completed_limit:
+            del self.completed_ids[next(iter(self.completed_ids))]
+        return True
+        
+    def refresh_queue_depth(self):
+        queue_data = get_queue(self.server_address)
+        if queue_data is None:
+            return False
+        self.set_queue_depth(len(queue_data.get("queue_running", [])) + len(queue_data.get("queue_pending", [])))
+        return True
+
+class PipelinedBatchEngine:
+    """流水线批处理引擎
+
+    每个服务器使用一条长连接WebSocket，并在服务器上同时保持多个排队中的工作流；
+    上传/提交和下载/保存在线程池中完成，与GPU执行相互重叠。
+    有多个服务器时，每个任务派发给负载最低的服务器，服务器故障时改派到其他服务器。
+    """
+    
+    recv_timeout = 0.25  # WebSocket读取超时（秒），用于及时检查任务是否全部结束
+    reconnect_max_delay = 60  # 流式模式下重连失效服务器的最长间隔（秒）
+    streaming_timings = 1000  # 流式模式下保留的最近阶段耗时记录数
+    lookahead = 64  # 派发时在等待队列前部查找亲和任务的范围
+    
+    def __init__(self, server_addresses=None, max_in_flight=None, io_workers=None, journal=None):
+        self.server_addresses = server_addresses or get_server_pool()
+        self.journal = journal
+        self.max_in_flight = max(1, int(max_in_flight or CONFIG.get("max_in_flight", 2)))
+        self.io_workers = max(1, int(io_workers or CONFIG.get("io_workers", 4)))
+        self.poll_interval = CONFIG.get("history_poll_interval", 10)
+        self.queue_poll_interval = CONFIG.get("queue_poll_interval", 2)
+        self.max_retries = CONFIG.get("server_retries", 2)
+        self.backpressure = CONFIG.get("queue_backpressure", True)
+        
+        self.cond = threading.Condition()
+        self.queue = collections.deque()  # 等待派发的任务（包括改派的任务）
+        self.lanes = []
+        self.results = []  # 流式模式下不保留，结果只交给 on_result
+        self.finished = 0  # 已结束的任务数
+        self.succeeded = 0  # 其中成功的任务数
+        self.total = 0
+        self.stopped = False
+        self.cache_stats = {"cached": 0, "total": 0}  # 已完成工作流的缓存命中节点数/节点总数
+        self.resumed = {"skipped": 0, "reattached": 0}  # 从任务日志恢复的任务数
+        self.result_cache_hits = 0
+        self.preprocess = None  # 上传前预处理选项
+        self.timings = []  # 本次批处理的阶段耗时记录
+        self.preprocess_pool = None
+        self.streaming = False  # 流式模式下任务全部完成后继续等待新任务，直到调用 close()
+        self.on_result = None  # 每个任务结束时调用 on_result(job, result)
+        
+        self.template = None
+        self.io_pool = None
+        
+    def run(self, jobs):
+        """执行任务列表，每个任务为包含 input_path、positive_prompt、output_name 的字典，返回结果列表"""
+        self.total = len(jobs)
+        if not jobs:
+            return []
             
-            if success:
-                successful += 1
+        error = self.start()
+        if error:
+            return [self._make_result(job, False, error) for job in jobs]
+        self._enqueue(jobs)
+        
+        try:
+            with self.cond:
+                while self.finished < self.total:
+                    self.cond.wait(0.5)
+        except KeyboardInterrupt:
+            print("\n批处理已中断，正在停止...")
+            self.stopped = True
+        finally:
+            self.close()
+                
+        return list(self.results)
+        
+    def add_jobs(self, jobs):
+        """流式模式下追加任务，可在其他线程运行期间调用"""
+        with self.cond:
+            self.total += len(jobs)
+        self._enqueue(jobs)
+        
+    def start(self):
+        """连接服务器并启动接收、派发线程，失败时返回错误信息"""
+        for server_address in self.server_addresses:
+            lane = ServerLane(server_address)
+            lane_timer = JobTimer()
+            with lane_timer.span("connect"):
+                connected = lane.client.connect()
+            self.timings.append(metrics_recorder.record(lane_timer, kind="connect", server_address=server_address,
+                                                        success=connected))
+            if connected:
+                lane.refresh_queue_depth()
+                self.lanes.append(lane)
             else:
-                failed += 1
+                print(f"警告: 服务器 {server_address} 不可用，已从本次批处理中移除")
+        if not self.lanes:
+            return "无法连接服务器"
+            
+        self.template = load_active_template()
+        if not self.template:
+            return "无法加载工作流"
+            
+        print_debug(f"流水线参数: 服务器 {len(self.lanes)} 台，每台同时排队 {self.max_in_flight}，IO线程 {self.io_workers}")
+        self.io_pool = ThreadPoolExecutor(max_workers=self.io_workers)
+        self.preprocess = get_preprocess_options(self.template)
+        if self.preprocess:
+            self.preprocess_pool = ThreadPoolExecutor(max_workers=max(1, int(CONFIG.get("preprocess_workers", 2))))
+        for lane in self.lanes:
+            lane.previous_timeout = lane.client.ws_timeout
+            lane.client.settimeout(self.recv_timeout)
+            lane.thread = threading.Thread(target=self._receive_loop, args=(lane,), daemon=True)
+            lane.thread.start()
+        dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        dispatcher.start()
+        live_metrics.engines.add(self)
+        return None
+        
+    def close(self):
+        """停止派发和接收线程，未完成的任务不再等待"""
+        live_metrics.engines.discard(self)
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.io_pool.shutdown(wait=self.finished >= self.total, cancel_futures=True)
+        if self.preprocess_pool:
+            self.preprocess_pool.shutdown(wait=False, cancel_futures=True)
+        for lane in self.lanes:
+            lane.thread.join(timeout=2)
+            lane.client.settimeout(lane.previous_timeout)
+            
+    def _enqueue(self, jobs):
+        if CONFIG.get("cache_affinity_scheduling", True):
+            jobs = schedule_jobs(jobs, self.template)
+        with self.cond:
+            self.queue.extend(jobs)
+            self._prefetch_preprocess()
+            self.cond.notify_all()
+        
+    def metrics_snapshot(self):
+        """供实时指标使用的当前状态"""
+        with self.cond:
+            return {
+                "queued": len(self.queue),
+                "running": sum(lane.in_flight for lane in self.lanes),
+                "queue_depths": {lane.server_address: lane.queue_depth for lane in self.lanes if not lane.dead}
+            }
+            
+    def _make_result(self, job, success, error=None, saved_images=None):
+        return {
+            "input_path": job["input_path"],
+            "output_name": job["output_name"],
+            "prompt_id": job.get("prompt_id"),
+            "server_address": job.get("server_address"),
+            "success": success,
+            "error": error,
+            "saved_images": saved_images or []
+        }
+        
+    def _resume_job(self, lane, job):
+        """根据任务日志跳过已完成的任务、重新关联仍在执行的工作流，已处理时返回 True
+
+        在派发后的IO线程中执行：任务键需要读取整个输入文件计算哈希，
+        不在提交第一个任务之前依次计算所有任务的键。
+        """
+        try:
+            job["job_key"] = make_job_key(job, self.template)
+        except OSError as e:
+            self._release_slot(lane)
+            self._finish_job(job, False, str(e))
+            return True
+        entry = self.journal.get(job["job_key"]) or {}
+        state = entry.get("state")
+        
+        saved_images = entry.get("saved_images") or []
+        if state == "done" and saved_images and all(os.path.exists(path) for path in saved_images):
+            job["prompt_id"] = entry.get("prompt_id")
+            job["server_address"] = entry.get("server_address")
+            job.pop("preprocessed", None)
+            self._release_slot(lane)
+            with self.cond:
+                self._add_result(self._make_result(job, True, saved_images=saved_images))
+                self.resumed["skipped"] += 1
+                self.cond.notify_all()
+            return True
+            
+        entry_lane = next((other for other in self.lanes
+                           if other.server_address == entry.get("server_address") and not other.dead), None)
+        if state == "running" and entry_lane:
+            if self._reattach(entry_lane, job, entry.get("prompt_id")):
+                job.pop("preprocessed", None)
+                self._release_slot(lane)
+                with self.cond:
+                    self.resumed["reattached"] += 1
+                return True
+            job.pop("prompt_id", None)
+            job["server_address"] = lane.server_address
+            
+        self.journal.record(job["job_key"], "queued", input_path=job["input_path"])
+        return False
+        
+    def _reattach(self, lane, job, prompt_id):
+        """重新关联上次运行时提交、可能仍在服务器上的工作流"""
+        if not prompt_id:
+            return False
+        job["prompt_id"] = prompt_id
+        job["server_address"] = lane.server_address
+        
+        history = get_history(prompt_id, lane.server_address)
+        if history and prompt_id in history:
+            entry = history[prompt_id]
+            has_images = any(node_output.get("images") for node_output in entry.get("outputs", {}).values())
+            if entry.get("status", {}).get("status_str") == "error" or not has_images:
+                return False
+            with self.cond:
+                lane.in_flight += 1
+            self._on_prompt_finished(lane, job, True)
+            return True
+            
+        queued_ids = get_queued_prompt_ids(lane.server_address)
+        if queued_ids and prompt_id in queued_ids:
+            # 上次运行的 client_id 已失效，收不到该工作流的WebSocket消息，依靠历史记录轮询获取结果
+            with self.cond:
+                lane.pending[prompt_id] = job
+                lane.in_flight += 1
+            return True
+        return False
+        
+    def _select_lane(self):
+        """选择有空闲槽位且负载最低的服务器
+
+        启用队列背压时，服务器队列（包括其他客户端的任务）已满的服务器也不派发。
+        """
+        candidates = [lane for lane in self.lanes if lane.usable() and lane.in_flight < self.max_in_flight and
+                      not (self.backpressure and lane.load() >= self.max_in_flight)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda lane: (lane.load(), lane.in_flight))
+        
+    def _pick_job(self, lane):
+        """从等待队列前部选出与该服务器上一个任务缓存亲和度最高的任务
+
+        该任务已在这台服务器上失败过且还有其他可用服务器时跳过。
+        """
+        other_usable = any(other.usable() for other in self.lanes if other is not lane)
+        best_index = None
+        best_score = -1
+        for index, job in enumerate(itertools.islice(self.queue, self.lookahead)):
+            if other_usable and lane.server_address in job.get("failed_servers", []):
+                continue
+            score = affinity_score(job.get("affinity_key"), lane.last_affinity_key)
+            if score > best_score:
+                best_index, best_score = index, score
+        if best_index is None:
+            return None
+        job = self.queue[best_index]
+        del self.queue[best_index]
+        return job
+        
+    def _dispatch_loop(self):
+        """按服务器空闲槽位依次派发任务"""
+        while True:
+            with self.cond:
+                lane = job = None
+                while not self.stopped:
+                    if self.finished >= self.total and not self.streaming:
+                        return
+                    # 流式模式下等待失效的服务器恢复连接
+                    if self.queue and all(lane.dead for lane in self.lanes) and not self.streaming:
+                        break
+                    if self.queue:
+                        lane = self._select_lane()
+                        job = self._pick_job(lane) if lane else None
+                        if job:
+                            break
+                    self.cond.wait(0.5)
+                if self.stopped:
+                    return
+                if job is None:
+                    # 所有服务器都已失效
+                    failed_jobs = list(self.queue)
+                    self.queue.clear()
+                else:
+                    job["server_address"] = lane.server_address
+                    lane.in_flight += 1
+                    lane.submitted_since_poll += 1
+                    lane.submitting += 1
+                    lane.last_affinity_key = job.get("affinity_key")
+                    self._prefetch_preprocess()
+                    
+            if job is None:
+                for failed_job in failed_jobs:
+                    self._finish_job(failed_job, False, "所有服务器均不可用")
+                continue
+            try:
+                self.io_pool.submit(self._submit_job, lane, job)
+            except RuntimeError:
+                return
+                
+    def _prefetch_preprocess(self):
+        """提前预处理队列前部即将派发的任务图像，与服务器上的生成过程重叠进行（需持有 cond）"""
+        if not self.preprocess_pool:
+            return
+        prefetch_count = len(self.lanes) * self.max_in_flight
+        for job in itertools.islice(self.queue, prefetch_count):
+            if "preprocessed" not in job:
+                try:
+                    job["preprocessed"] = self.preprocess_pool.submit(self._preprocess_job, job)
+                except RuntimeError:
+                    return
+                    
+    def _preprocess_job(self, job):
+        """预处理任务图像；所有服务器都已有该图像时跳过，返回 None"""
+        try:
+            upload_key = get_upload_key(job["input_path"], self.preprocess)
+        except OSError:
+            return None
+        with upload_registry.lock:
+            upload_registry.load()
+            if all(upload_key in upload_registry.entries.get(lane.server_address, {}) for lane in self.lanes):
+                return None
+        return preprocess_image(job["input_path"], self.preprocess)
+        
+    def _submit_job(self, lane, job):
+        """上传图像、更新工作流并提交到队列（在IO线程中执行），命中结果缓存时直接完成"""
+        timer = job.setdefault("timer", JobTimer())
+        queued = False
+        try:
+            with use_timer(timer):
+                queued = self._submit_job_timed(lane, job, timer)
+        finally:
+            self._end_submit(lane, queued)
+            
+    def _end_submit(self, lane, queued):
+        with self.cond:
+            lane.submitting -= 1
+            if not queued and lane.submitted_since_poll > 0:
+                # 命中结果缓存或上传失败的任务没有进入服务器队列，不再计入负载
+                lane.submitted_since_poll -= 1
+            self.cond.notify_all()
+            
+    def _submit_job_timed(self, lane, job, timer):
+        """执行提交过程，工作流已提交到服务器队列时返回 True"""
+        try:
+            if self.journal and "job_key" not in job and self._resume_job(lane, job):
+                return False
+            job_params = with_fixed_seed(dict(job.get("params") or {}, positive_prompt=job["positive_prompt"]))
+            job["result_key"] = make_result_key(self.template, job["input_path"], job_params, lane.server_address)
+            if job["result_key"]:
+                saved_images = result_cache.restore(job["result_key"], job["output_name"])
+                if saved_images:
+                    job.pop("preprocessed", None)
+                    self._release_slot(lane)
+                    with self.cond:
+                        self.result_cache_hits += 1
+                    self._finish_job(job, True, saved_images=saved_images)
+                    return False
+                    
+            with timer.span("upload"):
+                uploaded_filename = upload_image(job["input_path"], lane.server_address,
+                                                 preprocess=self.preprocess, preprocessed=job.get("preprocessed"))
+            if not uploaded_filename:
+                raise RuntimeError("上传图像失败")
+                
+            job_params["image"] = uploaded_filename
+            job["websocket_output"] = websocket_output_enabled(self.template, lane.server_address)
+            workflow = self.template.render(job_params, lane.server_address, job["websocket_output"])
+            job["node_count"] = len(workflow)
+            timer.submitted_at = time.perf_counter()
+            queue_result = queue_prompt(workflow, lane.client.client_id, lane.server_address)
+            if not queue_result or "prompt_id" not in queue_result:
+                # 输入图像可能已从服务器上删除，重试时重新上传
+                upload_registry.forget(lane.server_address, uploaded_filename)
+                raise RuntimeError("提交工作流失败")
+        except Exception as e:
+            self._release_slot(lane)
+            self._handle_failure(lane, job, str(e), retryable=True)
+            return False
+            
+        prompt_id = queue_result["prompt_id"]
+        job["prompt_id"] = prompt_id
+        job.pop("preprocessed", None)
+        print_debug(f"工作流已提交: {os.path.basename(job['input_path'])} -> {lane.server_address} {prompt_id}")
+        if self.journal and job.get("job_key"):
+            self.journal.record(job["job_key"], "running", input_path=job["input_path"],
+                                prompt_id=prompt_id, server_address=lane.server_address)
+        
+        with self.cond:
+            # 提交期间服务器可能已被放弃，不能再登记到它的等待列表中，否则任务永远不会结束
+            lane_dead = lane.dead
+            early = lane.early_finished.pop(prompt_id, None)
+            if early is None and not lane_dead:
+                lane.pending[prompt_id] = job
+        if lane_dead and early is None:
+            self._release_slot(lane)
+            self._handle_failure(lane, job, "服务器连接失败", retryable=True)
+        elif early is not None:
+            self._on_prompt_finished(lane, job, *early)
+        return True
+            
+    def _receive_loop(self, lane):
+        """读取单个服务器的WebSocket消息（在该服务器的读取线程中执行）"""
+        last_poll = last_queue_poll = time.time()
+        reconnect_count = lane.client.reconnect_count
+        while not self.stopped:
+            try:
+                raw = lane.client.recv()
+            except ConnectionError as e:
+                print(f"服务器 {lane.server_address} 连接失败: {e}")
+                self._abandon_lane(lane)
+                if not self.streaming or not self._revive_lane(lane):
+                    return
+                continue
+                
+            if isinstance(raw, str):
+                self._handle_message(lane, json.loads(raw))
+            elif raw:
+                self._handle_binary(lane, raw)
+                
+            if lane.client.reconnect_count != reconnect_count:
+                # 重连期间可能错过 status 消息，收到新的消息之前改为轮询 /queue
+                lane.status_seen = False
+                
+            # 没有 status 消息，或因其他客户端的任务而被背压阻塞（可能错过了消息）时轮询 /queue
+            now = time.time()
+            blocked = (self.backpressure and lane.in_flight < self.max_in_flight and
+                       lane.load() >= self.max_in_flight)
+            if now - last_queue_poll >= self.queue_poll_interval and (not lane.status_seen or blocked):
+                if lane.refresh_queue_depth():
+                    with self.cond:
+                        self.cond.notify_all()
+                last_queue_poll = now
+                
+            # 定期或重连后轮询历史记录，补偿可能丢失的消息
+            if now - last_poll >= self.poll_interval or lane.client.reconnect_count != reconnect_count:
+                reconnect_count = lane.client.reconnect_count
+                self._poll_history(lane)
+                last_poll = time.time()
+                
+    def _handle_message(self, lane, message):
+        data = message.get("data") or {}
+        if message.get("type") == "progress":
+            print_debug(f"进度: {data.get('value')}/{data.get('max')} ({data.get('prompt_id')})")
+            return
+        if message.get("type") == "status":
+            # 服务器队列变化时向所有客户端广播 queue_remaining
+            exec_info = (data.get("status") or {}).get("exec_info") or {}
+            if "queue_remaining" in exec_info:
+                with self.cond:
+                    lane.set_queue_depth(exec_info["queue_remaining"])
+                    lane.status_seen = True
+                    self.cond.notify_all()
+            return
+        if message.get("type") == "executing":
+            lane.current_node = (data.get("prompt_id"), data.get("node"))
+            if data.get("prompt_id") and data.get("node") is not None:
+                with self.cond:
+                    lane.started_at.setdefault(data["prompt_id"], time.perf_counter())
+        elif message.get("type") == "execution_cached" and data.get("prompt_id"):
+            with self.cond:
+                lane.cached_nodes[data["prompt_id"]] = len(data.get("nodes") or [])
+            
+        finished = parse_finish_message(message)
+        if finished:
+            self._dispatch_finished(lane, *finished)
+            
+    def _handle_binary(self, lane, raw):
+        """输出节点执行期间收到的图像帧为输出图像，其余为预览图"""
+        prompt_id, node_id = lane.current_node or (None, None)
+        if not prompt_id or node_id not in self.template.websocket_nodes:
+            return
+        image_data = parse_image_frame(raw)
+        if image_data:
+            with self.cond:
+                lane.captured.setdefault(prompt_id, []).append(image_data)
+                
+    def _dispatch_finished(self, lane, prompt_id, success, retryable=False):
+        with self.cond:
+            if not lane.mark_completed(prompt_id):
+                return
+            job = lane.pending.pop(prompt_id, None)
+            if job is None:
+                lane.early_finished[prompt_id] = (success, retryable)
+                return
+        self._on_prompt_finished(lane, job, success, retryable)
+        
+    def _poll_history(self, lane):
+        """轮询仍在等待的工作流的历史记录"""
+        with self.cond:
+            prompt_ids = list(lane.pending.keys())
+        if not prompt_ids:
+            return
+            
+        queued_ids = None
+        for prompt_id in prompt_ids:
+            if self._dispatch_from_history(lane, prompt_id):
+                continue
+                
+            # 既不在历史记录也不在队列中（例如服务器重启），改派到其他服务器。
+            # 工作流可能恰好在两次请求之间执行完毕，读取队列后再确认一次历史记录
+            if queued_ids is None:
+                queued_ids = get_queued_prompt_ids(lane.server_address)
+            if queued_ids is not None and prompt_id not in queued_ids:
+                if self._dispatch_from_history(lane, prompt_id):
+                    continue
+                print(f"工作流 {prompt_id} 已不在服务器 {lane.server_address} 的队列中")
+                self._dispatch_finished(lane, prompt_id, False, retryable=True)
                 
+    def _dispatch_from_history(self, lane, prompt_id):
+        """历史记录中已有该工作流时按其状态结束任务，返回是否找到"""
+        history = get_history(prompt_id, lane.server_address)
+        if not history or prompt_id not in history:
+            return False
+        status = history[prompt_id].get("status", {})
+        self._dispatch_finished(lane, prompt_id, status.get("status_str", "success") != "error")
+        return True
+                
+    def _abandon_lane(self, lane):
+        """服务器失效后，把其上未完成的任务改派到其他服务器"""
+        with self.cond:
+            lane.dead = True
+            jobs = list(lane.pending.values())
+            lane.pending.clear()
+            lane.in_flight -= len(jobs)
+            for job in jobs:
+                lane.captured.pop(job.get("prompt_id"), None)
+                lane.started_at.pop(job.get("prompt_id"), None)
+                lane.cached_nodes.pop(job.get("prompt_id"), None)
+            self.cond.notify_all()
+        for job in jobs:
+            self._handle_failure(lane, job, "服务器连接失败", retryable=True)
+            
+    def _revive_lane(self, lane):
+        """流式模式下持续重连失效的服务器，恢复后重新参与派发；引擎停止时返回 False"""
+        attempt = 0
+        while True:
+            delay = min(2 ** attempt, self.reconnect_max_delay)
+            with self.cond:
+                if self.cond.wait_for(lambda: self.stopped, timeout=delay):
+                    return False
+            attempt += 1
+            print(f"尝试重新连接服务器 {lane.server_address} (第 {attempt} 次)...")
+            if lane.client.connect():
+                break
+        lane.refresh_queue_depth()
+        with self.cond:
+            lane.dead = False
+            lane.failures = 0
+            lane.status_seen = False
+            lane.current_node = None
+            self.cond.notify_all()
+        print(f"服务器 {lane.server_address} 已恢复连接，继续派发任务")
+        return True
+            
+    def _release_slot(self, lane):
+        with self.cond:
+            lane.in_flight -= 1
+            self.cond.notify_all()
+            
+    def _on_prompt_finished(self, lane, job, success, retryable=False):
+        # 服务器端执行结束即释放槽位，下载与下一个任务的执行重叠进行
+        self._release_slot(lane)
+        finished_at = time.perf_counter()
+        with self.cond:
+            lane.note_finished()
+            started_at = lane.started_at.pop(job.get("prompt_id"), None)
+            cached_count = lane.cached_nodes.pop(job.get("prompt_id"), 0)
+            if success:
+                self.cache_stats["cached"] += cached_count
+                self.cache_stats["total"] += job.get("node_count", 0)
+        if job.get("timer"):
+            job["timer"].record_execution(started_at, finished_at)
+        if success:
+            live_metrics.count_cache("node", "hit", cached_count)
+            live_metrics.count_cache("node", "miss", max(0, job.get("node_count", 0) - cached_count))
+        if not success:
+            with self.cond:
+                lane.captured.pop(job.get("prompt_id"), None)
+            self._handle_failure(lane, job, "服务器执行失败", retryable)
+            return
+        try:
+            self.io_pool.submit(self._collect_job, lane, job)
+        except RuntimeError:
+            self._finish_job(job, False, "批处理已停止")
+            
+    def _collect_job(self, lane, job):
+        """保存输出图像（在IO线程中执行），没有收到WebSocket图像时通过历史记录下载"""
+        with self.cond:
+            captured_images = lane.captured.pop(job["prompt_id"], [])
+        try:
+            with use_timer(job.get("timer")):
+                saved_images = save_captured_images(captured_images, job["output_name"])
+                if not saved_images:
+                    saved_images = collect_output_images(job["prompt_id"], lane.server_address, job["output_name"])
         except Exception as e:
-            print(f"处理图像 {os.path.basename(image_path)} 时出错: {e}")
-            failed += 1
+            self._handle_failure(lane, job, str(e), retryable=True)
+            return
+        if saved_images:
+            with self.cond:
+                lane.failures = 0
+            if job.get("result_key"):
+                result_cache.put(job["result_key"], saved_images)
+            self._finish_job(job, True, saved_images=saved_images)
+        else:
+            self._finish_job(job, False, "没有生成任何图像")
+            
+    def _handle_failure(self, lane, job, error, retryable):
+        """记录失败；服务器级故障时把任务改派到其他服务器"""
+        with self.cond:
+            if retryable:
+                lane.failures += 1
+                if lane.failures >= lane.failure_limit and not lane.dead:
+                    print(f"服务器 {lane.server_address} 连续失败 {lane.failures} 次，暂停派发 {lane.cooldown} 秒")
+                    lane.disabled_until = time.time() + lane.cooldown
+                    lane.failures = 0
+                    
+            failed_servers = job.setdefault("failed_servers", [])
+            failed_servers.append(lane.server_address)
+            other_lanes = [other for other in self.lanes if not other.dead and other is not lane]
+            if (retryable and not self.stopped and len(failed_servers) <= self.max_retries and
+                (other_lanes or not lane.dead or self.streaming)):
+                job.pop("prompt_id", None)
+                self.queue.append(job)
+                self.cond.notify_all()
+                print(f"{os.path.basename(job['input_path'])} 在 {lane.server_address} 失败 ({error})，重新派发")
+                return
+        self._finish_job(job, False, error)
+        
+    def _finish_job(self, job, success, error=None, saved_images=None):
+        result = self._make_result(job, success, error, saved_images)
+        if job.get("timer"):
+            record = metrics_recorder.record(job["timer"], kind="batch", input_path=job["input_path"],
+                                             server_address=job.get("server_address"),
+                                             prompt_id=job.get("prompt_id"), success=success,
+                                             images=len(result["saved_images"]))
+            with self.cond:
+                self.timings.append(record)
+                if self.streaming and len(self.timings) > self.streaming_timings:
+                    del self.timings[:len(self.timings) - self.streaming_timings]
+        if self.journal and job.get("job_key"):
+            self.journal.record(job["job_key"], "done" if success else "failed",
+                                input_path=job["input_path"], prompt_id=job.get("prompt_id"),
+                                server_address=job.get("server_address"), error=error,
+                                saved_images=result["saved_images"])
+        with self.cond:
+            self._add_result(result)
+            done = self.finished
+            self.cond.notify_all()
+        name = os.path.basename(job["input_path"])
+        server_note = f" ({job.get('server_address')})" if len(self.lanes) > 1 else ""
+        if success:
+            print(f"[{done}/{self.total}] 完成: {name}{server_note}，保存 {len(result['saved_images'])} 张图像")
+        else:
+            print(f"[{done}/{self.total}] 失败: {name}{server_note} - {error}")
+        if self.on_result:
+            self.on_result(job, result)
+        if self.streaming:
+            forget_file_hash(job["input_path"])
+            
+    def _add_result(self, result):
+        # 需持有 cond
+        self.finished += 1
+        if result["success"]:
+            self.succeeded += 1
+        if not self.streaming:
+            self.results.append(result)
+
+def batch_process(input_images, positive_prompt, server_addresses=None, params=None, resume=True):
+    """批量处理多个图像，params 为所有任务共用的额外工作流参数
+
+    启用任务日志时，中断后重新运行同一批处理会跳过已完成的任务；resume=False 时重新开始。
+    """
+    if not input_images:
+        print("没有输入图像，无法批处理")
+        return False
+        
+    start_time = time.time()
+    
+    print(f"开始批量处理 {len(input_images)} 张图像")
+    print(f"使用正向提示词: {positive_prompt}")
+    
+    # 使用图像文件名作为输出文件名前缀
+    jobs = [{
+        "input_path": image_path,
+        "positive_prompt": positive_prompt,
+        "output_name": f"batch_{os.path.basename(image_path).split('.')[0]}",
+        "params": params or {}
+    } for image_path in input_images]
+    
+    journal = None
+    if CONFIG.get("batch_journal", True):
+        journal = BatchJournal(make_batch_id(input_images, positive_prompt, params))
+        if not resume:
+            journal.clear()
+    
+    engine = PipelinedBatchEngine(server_addresses, journal=journal)
+    results = engine.run(jobs)
+    
+    successful = sum(1 for result in results if result["success"])
+    failed = len(input_images) - successful
             
     end_time = time.time()
     total_time = end_time - start_time
@@ -1051,28 +3379,194 @@ def batch_process(input_images, positive_prompt):
     print(f"\n批处理完成!")
     print(f"总共处理: {len(input_images)} 张图像")
     print(f"成功: {successful}，失败: {failed}")
+    if engine.resumed["skipped"]:
+        print(f"其中从任务日志跳过: {engine.resumed['skipped']}")
+    if engine.resumed["reattached"]:
+        print(f"其中重新关联上次执行中的任务: {engine.resumed['reattached']}")
+    if engine.result_cache_hits:
+        print(f"其中命中结果缓存: {engine.result_cache_hits}")
+    if engine.cache_stats["total"]:
+        cache_ratio = engine.cache_stats["cached"] / engine.cache_stats["total"]
+        print(f"节点缓存命中率: {cache_ratio:.1%} ({engine.cache_stats['cached']}/{engine.cache_stats['total']})")
+    if len(engine.lanes) > 1:
+        for lane in engine.lanes:
+            count = sum(1 for result in results if result["success"] and result["server_address"] == lane.server_address)
+            print(f"  {lane.server_address}: {count} 张")
     print(f"总耗时: {total_time:.2f}秒，平均每张: {avg_time:.2f}秒")
+    print_stage_summary(engine.timings)
     
     return successful > 0
 
+class FolderWatcher:
+    """监视文件夹中新出现或被修改的图像
+
+    安装了 watchdog 时使用系统文件事件（Linux 上为 inotify），只检查发生变化的文件；
+    否则每次完整扫描文件夹。文件大小和修改时间在 settle_seconds 内保持不变才视为写入完成。
+    """
+    
+    def __init__(self, folder, poll_interval=None, settle_seconds=None):
+        self.folder = folder
+        self.poll_interval = float(poll_interval or CONFIG.get("watch_poll_interval", 1))
+        self.settle_seconds = float(settle_seconds if settle_seconds is not None else CONFIG.get("watch_settle_seconds", 2))
+        self.candidates = {}  # path -> (文件签名, 该签名首次出现的时间)
+        self.seen = {}  # path -> 已交给调用方的文件签名
+        self.changed = set()  # 文件事件报告的路径
+        self.full_scan = True  # 启动时完整扫描一次，处理停机期间放入的文件
+        self.observer = None
+        self.lock = threading.Lock()
+        
+    def start(self):
+        """启动文件事件监听，未安装 watchdog 时返回 False 并改用轮询"""
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return False
+            
+        watcher = self
+        
+        class ChangeHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory:
+                    return
+                with watcher.lock:
+                    watcher.changed.add(os.path.abspath(event.src_path))
+                    if getattr(event, "dest_path", None):
+                        watcher.changed.add(os.path.abspath(event.dest_path))
+                        
+        self.observer = Observer()
+        self.observer.schedule(ChangeHandler(), self.folder, recursive=False)
+        self.observer.start()
+        return True
+        
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join(timeout=2)
+            
+    def poll(self):
+        """返回已写入完成且内容有变化的图像路径"""
+        if self.observer is None or self.full_scan:
+            self.full_scan = False
+            paths = [os.path.abspath(os.path.join(self.folder, name)) for name in os.listdir(self.folder)]
+        else:
+            with self.lock:
+                paths = list(self.changed)
+                self.changed.clear()
+        paths = set(paths) | set(self.candidates)
+        
+        now = time.time()
+        ready = []
+        for path in sorted(paths):
+            if not path.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # 文件已被删除或移走
+                self.candidates.pop(path, None)
+                self.seen.pop(path, None)
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self.seen.get(path) == signature:
+                self.candidates.pop(path, None)
+                continue
+            previous = self.candidates.get(path)
+            if previous is None or previous[0] != signature or stat.st_size == 0:
+                self.candidates[path] = (signature, previous[1] if previous and previous[0] == signature else now)
+                continue
+            if now - previous[1] < self.settle_seconds:
+                continue
+            del self.candidates[path]
+            self.seen[path] = signature
+            ready.append(path)
+        return ready
+
+def watch_folder(folder, positive_prompt, server_addresses=None, params=None):
+    """监视模式：持续把文件夹中新出现或被修改的图像送入批处理流水线，按 Ctrl+C 退出
+
+    按内容哈希去重，已成功处理的内容记录在任务日志中，重启后也不会再次处理；
+    失败的内容在本次运行中不再重试，重启后重新处理。服务器断开时持续重连，恢复后继续派发。
+    """
+    if not os.path.isdir(folder):
+        print(f"错误: {folder} 不是有效的文件夹")
+        return False
+        
+    # 同一文件夹、提示词和参数的监视共用一个任务日志，以内容哈希为键
+    journal = BatchJournal("watch_" + make_batch_id([os.path.join(folder, "*")], positive_prompt, params))
+    handled = set()  # 本次运行中已交给流水线的内容哈希
+    
+    engine = PipelinedBatchEngine(server_addresses)
+    engine.streaming = True
+    
+    def on_result(job, result):
+        journal.record(job["content_hash"], "done" if result["success"] else "failed",
+                       input_path=job["input_path"], prompt_id=result["prompt_id"],
+                       server_address=result["server_address"], error=result["error"],
+                       saved_images=result["saved_images"])
+        if result["success"]:
+            print(f"{os.path.basename(job['input_path'])} 写入完成后 {time.time() - job['detected_at']:.1f}秒生成完毕")
+            
+    engine.on_result = on_result
+    error = engine.start()
+    if error:
+        print(f"无法启动监视模式: {error}")
+        return False
+        
+    watcher = FolderWatcher(folder)
+    using_events = watcher.start()
+    print(f"正在监视文件夹: {folder} ({'文件系统事件' if using_events else '定期扫描'})，按 Ctrl+C 退出")
+    print(f"使用正向提示词: {positive_prompt}")
+    
+    try:
+        while True:
+            jobs = []
+            for path in watcher.poll():
+                try:
+                    content_hash = get_file_hash(path)
+                except OSError as e:
+                    print_debug(f"读取文件失败，跳过: {path} ({e})")
+                    continue
+                entry = journal.get(content_hash) or {}
+                if content_hash in handled or entry.get("state") == "done":
+                    print_debug(f"相同内容已处理过，跳过: {path}")
+                    continue
+                handled.add(content_hash)
+                jobs.append({
+                    "input_path": path,
+                    "positive_prompt": positive_prompt,
+                    "output_name": f"watch_{os.path.basename(path).split('.')[0]}",
+                    "params": params or {},
+                    "content_hash": content_hash,
+                    "detected_at": time.time()
+                })
+            if jobs:
+                print(f"发现 {len(jobs)} 张新图像: {', '.join(os.path.basename(job['input_path']) for job in jobs)}")
+                engine.add_jobs(jobs)
+            time.sleep(watcher.poll_interval)
+    except KeyboardInterrupt:
+        print("\n已停止监视")
+    finally:
+        watcher.stop()
+        engine.close()
+        
+    print(f"本次共处理 {engine.finished} 张图像，成功 {engine.succeeded} 张")
+    print_stage_summary(engine.timings)
+    return True
+
 def check_environment():
     """检查运行环境"""
     # 检查必要的依赖
     required_packages = {
         "websocket-client": "websocket",
         "requests": "requests",
-        "pillow": "PIL"  # 如果PIL不可用，上面已经有检查
+        "pillow": "PIL"
     }
     
+    # 只检查是否已安装，真正的导入推迟到第一次使用时
     missing_packages = []
     for package_name, import_name in required_packages.items():
-        if import_name == "PIL" and not PIL_AVAILABLE:
-            missing_packages.append(package_name)
-            continue
-            
-        try:
-            __import__(import_name)
-        except ImportError:
+        if importlib.util.find_spec(import_name) is None:
             missing_packages.append(package_name)
     
     if missing_packages:
@@ -1112,11 +3606,65 @@ def check_environment():
     
     return True
 
+def print_usage():
+    """打印命令行用法"""
+    print("ComfyUI 图生图 API 客户端")
+    print("用法:")
+    print("  python comfyui_img2img_api.py                   - 进入交互模式")
+    print("  python comfyui_img2img_api.py --debug           - 以调试模式进入交互模式")
+    print("  python comfyui_img2img_api.py 图片路径 提示词     - 处理单个图像")
+    print("  python comfyui_img2img_api.py --batch 文件夹 提示词 - 批量处理文件夹中的所有图像")
+    print("  python comfyui_img2img_api.py --watch 提示词       - 持续处理输入文件夹中新放入的图像")
+    print("  python comfyui_img2img_api.py --config          - 修改配置后进入交互模式")
+    print("可选参数:")
+    print("  --servers 地址1,地址2    - 批处理时在多个服务器间分配任务")
+    print("  --folder 文件夹          - 监视模式下要监视的文件夹 (默认为输入文件夹)")
+    print("  --param 名称=值          - 设置工作流参数，可重复使用 (例如 --param steps=30)")
+    print("  --no-resume              - 忽略任务日志，重新处理所有图像")
+    print("  --refresh-nodes          - 清除节点信息缓存，重新获取服务器上的模型和节点列表")
+    print("  --variations 数量        - 单个图像模式下在一次工作流中生成多个变体")
+    print("  --seeds 种子1,种子2      - 单个图像模式下按指定种子生成变体")
+    print("  --metrics-port 端口      - 在该端口提供 Prometheus 指标 (http://127.0.0.1:端口/metrics)")
+
+def get_cli_option(args, name, default=None):
+    """从命令行参数中读取 "--名称 值" 形式的可选参数"""
+    if name in args:
+        index = args.index(name)
+        if index + 1 < len(args):
+            return args[index + 1]
+    return default
+
+def get_cli_params(args):
+    """读取所有 "--param 名称=值" 形式的工作流参数，值按JSON解析，失败时作为字符串"""
+    params = {}
+    for index, arg in enumerate(args[:-1]):
+        if arg == "--param" and "=" in args[index + 1]:
+            name, value = args[index + 1].split("=", 1)
+            try:
+                params[name.strip()] = json.loads(value)
+            except ValueError:
+                params[name.strip()] = value
+    return params
+
 def main():
     """主函数"""
+    # 导入模块时不读写配置文件，由入口显式加载
+    load_config()
+    
+    # --refresh-nodes: 丢弃所有服务器的节点信息缓存（例如安装了新模型或自定义节点之后）
+    if "--refresh-nodes" in sys.argv:
+        sys.argv.remove("--refresh-nodes")
+        node_schema_cache.invalidate()
+        print("节点信息缓存已清除")
+    
     # 检查环境
     check_environment()
     
+    # 可选的实时指标服务: --metrics-port 端口
+    metrics_port = get_cli_option(sys.argv[1:], "--metrics-port")
+    if metrics_port or CONFIG.get("metrics_port"):
+        start_metrics_server(metrics_port)
+    
     # 解析命令行参数
     if len(sys.argv) > 1:
         if sys.argv[1] == "--debug":
@@ -1125,19 +3673,11 @@ def main():
             # 进入交互模式
             interactive_mode()
         elif sys.argv[1] == "--help" or sys.argv[1] == "-h":
-            print("ComfyUI 图生图 API 客户端")
-            print("用法:")
-            print("  python comfyui_img2img_api.py                   - 进入交互模式")
-            print("  python comfyui_img2img_api.py --debug           - 以调试模式进入交互模式")
-            print("  python comfyui_img2img_api.py 图片路径 提示词     - 处理单个图像")
-            print("  python comfyui_img2img_api.py --batch 文件夹 提示词 - 批量处理文件夹中的所有图像")
-            print("  python comfyui_img2img_api.py --config          - 修改配置后进入交互模式")
+            print_usage()
             return
         elif sys.argv[1] == "--config":
             # 修改配置后进入交互模式
             print("=== 配置模式 ===")
-            # 加载配置
-            load_config()
             # 修改服务器地址
             new_address = input(f"ComfyUI服务器地址 (当前: {CONFIG['server_address']}): ").strip()
             if new_address:
@@ -1158,7 +3698,7 @@ def main():
             # 批量处理模式
             if len(sys.argv) < 4:
                 print("错误: 批量处理需要提供文件夹路径和提示词")
-                print("用法: python comfyui_img2img_api.py --batch 文件夹 提示词")
+                print("用法: python comfyui_img2img_api.py --batch 文件夹 提示词 [--servers 地址1,地址2]")
                 return
                 
             batch_folder = sys.argv[2]
@@ -1178,27 +3718,56 @@ def main():
                 print(f"错误: {batch_folder} 中没有找到任何图像")
                 return
                 
+            # 可选的服务器池: --servers 地址1,地址2
+            server_addresses = None
+            servers_option = get_cli_option(sys.argv[4:], "--servers")
+            if servers_option:
+                server_addresses = [address.strip() for address in servers_option.split(",") if address.strip()]
+                
             print(f"找到 {len(batch_images)} 张图像，开始批量处理")
-            batch_process(batch_images, batch_prompt)
+            batch_process(batch_images, batch_prompt, server_addresses, get_cli_params(sys.argv[4:]),
+                          resume="--no-resume" not in sys.argv[4:])
+        elif sys.argv[1] == "--watch":
+            # 监视模式
+            if len(sys.argv) < 3:
+                print("错误: 监视模式需要提供提示词")
+                print("用法: python comfyui_img2img_api.py --watch 提示词 [--folder 文件夹] [--servers 地址1,地址2]")
+                return
+                
+            server_addresses = None
+            servers_option = get_cli_option(sys.argv[3:], "--servers")
+            if servers_option:
+                server_addresses = [address.strip() for address in servers_option.split(",") if address.strip()]
+                
+            watch_folder(get_cli_option(sys.argv[3:], "--folder", CONFIG["input_folder"]), sys.argv[2],
+                         server_addresses, get_cli_params(sys.argv[3:]))
         elif os.path.exists(sys.argv[1]):
             input_image = sys.argv[1]
             
             if len(sys.argv) > 2:
                 positive_prompt = sys.argv[2]
-                generate_image(input_image, positive_prompt)
+                variations_option = get_cli_option(sys.argv[3:], "--variations")
+                seeds_option = get_cli_option(sys.argv[3:], "--seeds")
+                if variations_option or seeds_option:
+                    try:
+                        seeds = [int(seed) for seed in seeds_option.split(",")] if seeds_option else None
+                        count = int(variations_option) if variations_option else len(seeds)
+                    except ValueError:
+                        print("错误: 变体数量和种子必须是整数")
+                        return
+                    generate_variations(input_image, positive_prompt, count, seeds, params=get_cli_params(sys.argv[3:]))
+                else:
+                    generate_image(input_image, positive_prompt, params=get_cli_params(sys.argv[3:]))
             else:
                 print("错误: 请提供正向提示词")
         else:
-            print("ComfyUI 图生图 API 客户端")
-            print("用法:")
-            print("  python comfyui_img2img_api.py                   - 进入交互模式")
-            print("  python comfyui_img2img_api.py --debug           - 以调试模式进入交互模式")
-            print("  python comfyui_img2img_api.py 图片路径 提示词     - 处理单个图像")
-            print("  python comfyui_img2img_api.py --batch 文件夹 提示词 - 批量处理文件夹中的所有图像")
-            print("  python comfyui_img2img_api.py --config          - 修改配置后进入交互模式")
+            print_usage()
     else:
         # 进入交互模式
         interactive_mode()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    try:
+        main()
+    finally:
+        close_clients() 
\ No newline at end of file
@@ -0,0 +1,22 @@
+"""文件读写公共工具
+
+comfyui_img2img_api.py 和 game_artifact_icon_generator.py 共用的原子写入函数。
+"""
+
+import os
+import json
+import uuid
+
+def write_json_atomic(path, data):
+    """先写入临时文件再替换，避免中途崩溃留下损坏的JSON文件"""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -1,10 +1,22 @@
 import os
+import io
+import re
+import csv
 import base64
-import requests
+import hashlib
+import mimetypes
 import json
+import goapi_client
+from file_utils import write_json_atomic
 import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import sys
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
 
 # 配置参数
 CONFIG = {
@@ -13,7 +25,18 @@ CONFIG = {
     "reference_folder": r"E:\M72",  # 参考图片文件夹
     "size": "1024x1024",  # 图片尺寸
     "debug": True,  # 调试模式
-    "print_response": True  # 是否打印API响应
+    "print_response": True,  # 是否打印API响应
+    "context_max_bytes": 512 * 1024,  # 对话上下文的最大字节数（JSON序列化后），超出时压缩较早的对话
+    "context_max_tokens": 16000,  # 对话上下文的最大估算token数
+    "context_keep_recent": 6,  # 压缩时至少保留的最近消息条数
+    "cache_folder": ".icon_cache",  # 本地缓存文件夹
+    "reference_max_size": 512,  # 参考图片发送前缩小到的最长边（像素），0 表示不缩小
+    "reference_quality": 85,  # 不透明参考图片转为JPEG时的压缩质量
+    "reference_workers": 4,  # 首次编码参考图片时的线程数
+    "bulk_workers": 4,  # 批量生成图标时同时进行的请求数
+    "connect_timeout": 10,  # GoAPI 建立连接的超时时间（秒）
+    "read_timeout": 300,  # GoAPI 等待响应的超时时间（秒）
+    "max_retries": 3  # 请求失败时的最大重试次数（生成请求只在确定未被执行时重试）
 }
 
 # API端点
@@ -21,12 +44,244 @@ TEXT_TO_IMAGE_URL = "https://api.goapi.ai/v1/images/generations"
 CHAT_COMPLETION_URL = "https://api.goapi.ai/v1/chat/completions"
 IMAGE_MODEL = "gpt-image-1"
 CHAT_MODEL = "gpt-4o"  # 使用GPT-4o模型进行对话
+IMAGE_TOKENS = 765  # 估算时每张图片按高细节模式 512x512 分块计算的token数
+SUMMARY_LINE_LENGTH = 60  # 压缩后每条旧消息在摘要中保留的字数
+SUMMARY_MAX_LINES = 30  # 摘要最多保留的旧消息条数
 
-class ArtifactIconGenerator:
+def estimate_tokens(text):
+    """粗略估算文本的token数：中文等非ASCII字符约1个token，ASCII字符约4个一个token"""
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+def message_text(content):
+    """消息内容中的文本部分"""
+    if isinstance(content, str):
+        return content
+    return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+def message_cost(message):
+    """单条消息的 (JSON序列化后的字节数, 估算token数)"""
+    content = message["content"]
+    tokens = 4 + estimate_tokens(message_text(content))
+    if not isinstance(content, str):
+        tokens += IMAGE_TOKENS * sum(1 for part in content if part.get("type") == "image_url")
+    return len(json.dumps(message, ensure_ascii=False).encode("utf-8")), tokens
+
+class ConversationContext:
+    """有上限的对话上下文
+
+    系统提示词和参考图风格分析固定保留，其余消息按时间顺序保存。序列化后的字节数或估算的
+    token数超出预算时，从最早的非固定消息开始移出，移出的消息压缩成一条摘要。
+    风格分析完成后调用 strip_images() 把参考图片的base64数据替换为文件名，之后不再重复发送。
+    """
+    
+    def __init__(self, max_bytes=None, max_tokens=None, keep_recent=None):
+        self.max_bytes = max_bytes or CONFIG.get("context_max_bytes", 512 * 1024)
+        self.max_tokens = max_tokens or CONFIG.get("context_max_tokens", 16000)
+        self.keep_recent = keep_recent if keep_recent is not None else CONFIG.get("context_keep_recent", 6)
+        self.entries = []  # [(消息, 是否固定, (字节数, 估算token数))]
+        self.summary_lines = []  # 已移出的旧消息摘要
+        self.summary_index = 0  # 摘要插入的位置，即最近一条移出的消息原来的位置
+        self.dropped = 0  # 已移出的消息总数
+        
+    def __len__(self):
+        return len(self.entries)
+        
+    def add(self, role, content, pinned=False):
+        """添加消息，超出预算时压缩较早的对话"""
+        message = {"role": role, "content": content}
+        self.entries.append((message, pinned, message_cost(message)))
+        self.compact()
+        
+    def summary_message(self):
+        if not self.summary_lines:
+            return None
+        summary_text = f"此前 {self.dropped} 条对话的摘要（已省略细节）:\n" + "\n".join(self.summary_lines)
+        return {"role": "system", "content": summary_text}
+        
+    def messages(self):
+        """发送给API的消息列表，按原有顺序排列，旧对话摘要位于被移出的消息原来的位置"""
+        messages = [message for message, _, _ in self.entries]
+        summary = self.summary_message()
+        if summary:
+            messages.insert(self.summary_index, summary)
+        return messages
+        
+    def size(self):
+        """当前上下文的 (字节数, 估算token数)，每条消息的大小在添加时计算一次"""
+        costs = [cost for _, _, cost in self.entries]
+        summary = self.summary_message()
+        if summary:
+            costs.append(message_cost(summary))
+        return sum(cost[0] for cost in costs), sum(cost[1] for cost in costs)
+        
+    def over_budget(self):
+        size_bytes, tokens = self.size()
+        return size_bytes > self.max_bytes or tokens > self.max_tokens
+        
+    def strip_images(self):
+        """把所有图片数据替换为占位文本，返回替换的图片数量"""
+        stripped = 0
+        for index, (message, pinned, _) in enumerate(self.entries):
+            content = message["content"]
+            if isinstance(content, str):
+                continue
+            image_count = sum(1 for part in content if part.get("type") == "image_url")
+            if not image_count:
+                continue
+            message = {"role": message["role"], "content": f"{message_text(content)} [图片已省略]"}
+            self.entries[index] = (message, pinned, message_cost(message))
+            stripped += image_count
+        return stripped
+        
+    def compact(self):
+        """从最早的非固定消息开始移出并写入摘要，直到回到预算内
+
+        最近 keep_recent 条消息和仍带有图片的消息（风格分析完成前的参考图片）不会被移出。
+        """
+        while self.over_budget():
+            recent_start = len(self.entries) - self.keep_recent
+            index = next((index for index, (message, pinned, _) in enumerate(self.entries[:max(0, recent_start)])
+                          if not pinned and isinstance(message["content"], str)), None)
+            if index is None:
+                break
+            message, _, _ = self.entries.pop(index)
+            self.summary_index = index
+            text = " ".join(message["content"].split())
+            if len(text) > SUMMARY_LINE_LENGTH:
+                text = text[:SUMMARY_LINE_LENGTH] + "…"
+            self.summary_lines.append(f"- {message['role']}: {text}")
+            self.summary_lines = self.summary_lines[-SUMMARY_MAX_LINES:]
+            self.dropped += 1
+
+class ReferenceImageCache:
+    """参考图片编码缓存
+
+    把参考图片缩小到 reference_max_size 以内（带透明通道的保存为PNG，其余为JPEG），
+    base64编码后连同MIME类型保存到缓存文件夹。缓存键由文件路径、修改时间、大小和
+    编码参数组成，文件未变化时直接读取，不再重复读取和编码原图。
+    """
+    
     def __init__(self, config=None):
-        """初始化生成器"""
         self.config = config or CONFIG
-        self.context = []  # 保存对话上下文
+        self.folder = os.path.join(self.config.get("cache_folder", ".icon_cache"), "references")
+        self.max_size = int(self.config.get("reference_max_size", 512) or 0)
+        self.quality = int(self.config.get("reference_quality", 85))
+        
+    def cache_key(self, image_path):
+        stat = os.stat(image_path)
+        raw = json.dumps([os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size,
+                          self.max_size if PIL_AVAILABLE else 0, self.quality])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+        
+    def get(self, image_path):
+        """返回 (MIME类型, base64数据)，失败时返回 None"""
+        try:
+            cache_path = os.path.join(self.folder, f"{self.cache_key(image_path)}.json")
+        except OSError as e:
+            print(f"错误: 无法读取参考图片 - {image_path} ({e})")
+            return None
+            
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                return entry["mime"], entry["data"]
+            except Exception:
+                pass
+                
+        encoded = self.encode(image_path)
+        if encoded:
+            self.save(cache_path, encoded)
+        return encoded
+        
+    def encode(self, image_path):
+        """缩小并编码图片，未安装PIL或无法解析时按原文件编码"""
+        if PIL_AVAILABLE:
+            try:
+                with Image.open(image_path) as source:
+                    img = ImageOps.exif_transpose(source)
+                    if self.max_size:
+                        img.thumbnail((self.max_size, self.max_size), Image.LANCZOS)
+                    buffer = io.BytesIO()
+                    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                        img.save(buffer, format="PNG")
+                        mime = "image/png"
+                    else:
+                        img.convert("RGB").save(buffer, format="JPEG", quality=self.quality, optimize=True)
+                        mime = "image/jpeg"
+                return mime, base64.b64encode(buffer.getvalue()).decode("utf-8")
+            except Exception as e:
+                print(f"缩小参考图片失败，使用原图: {os.path.basename(image_path)} ({e})")
+                
+        try:
+            with open(image_path, "rb") as img_file:
+                data = base64.b64encode(img_file.read()).decode("utf-8")
+        except Exception as e:
+            print(f"图片编码失败: {e}")
+            return None
+        return mimetypes.guess_type(image_path)[0] or "image/png", data
+        
+    def save(self, cache_path, encoded):
+        try:
+            write_json_atomic(cache_path, {"mime": encoded[0], "data": encoded[1]})
+        except Exception as e:
+            print(f"写入参考图片缓存失败: {e}")
+
+# 清单中的字段名（支持中英文表头）-> 异宝信息字段
+MANIFEST_FIELDS = {
+    "name": "name", "异宝名称": "name", "名称": "name",
+    "quality": "quality", "品质": "quality",
+    "scene": "scene", "所属场景": "scene", "场景": "scene",
+    "description": "description", "异宝描述": "description", "描述": "description",
+    "creative_direction": "creative_direction", "direction": "creative_direction", "创意方向": "creative_direction"
+}
+
+def normalize_artifact_record(raw):
+    """把清单中的一行转换为异宝信息字典，缺少名称时返回 None"""
+    record = {}
+    for key, value in raw.items():
+        field = MANIFEST_FIELDS.get(str(key).strip().lower()) or MANIFEST_FIELDS.get(str(key).strip())
+        if field and value is not None and str(value).strip():
+            record[field] = str(value).strip()
+    return record if record.get("name") else None
+
+def read_artifact_manifest(path):
+    """逐行读取异宝清单（.jsonl 或 .csv），依次产出 (行号, 异宝信息或None, 错误信息)"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            # 第1行为表头
+            for index, row in enumerate(csv.DictReader(f), start=2):
+                record = normalize_artifact_record(row)
+                yield index, record, None if record else "缺少异宝名称"
+            return
+            
+        for index, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                raw = json.loads(line)
+            except ValueError as e:
+                yield index, None, f"JSON格式错误: {e}"
+                continue
+            record = normalize_artifact_record(raw) if isinstance(raw, dict) else None
+            yield index, record, None if record else "缺少异宝名称"
+
+def safe_file_name(name):
+    """去掉文件名中不允许的字符"""
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", name).strip("_") or "icon"
+
+class ArtifactIconGenerator:
+    def __init__(self, config=None, refresh_style=False):
+        """初始化生成器，refresh_style 为 True 时忽略已保存的风格分析，重新分析参考图片"""
+        self.config = config or CONFIG
+        self.refresh_style = refresh_style
+        self.context = ConversationContext(self.config.get("context_max_bytes"), self.config.get("context_max_tokens"),
+                                           self.config.get("context_keep_recent"))  # 保存对话上下文
+        self.reference_cache = ReferenceImageCache(self.config)
+        # 共用的GoAPI客户端，连接池大小足够批量生成的并发请求复用连接
+        self.api = goapi_client.GoAPIClient(self.config["api_key"], self.config,
+                                            pool_size=int(self.config.get("bulk_workers", 4)))
         self.print_debug(f"初始化完成，对话模型: {CHAT_MODEL}，图像模型: {IMAGE_MODEL}")
         self.print_debug(f"参考图片文件夹: {self.config['reference_folder']}")
         self.print_debug(f"输出文件夹: {self.config['output_folder']}")
@@ -36,10 +291,10 @@ class ArtifactIconGenerator:
         if self.config.get("debug", False):
             print(f"[调试] {message}")
 
-    def add_to_context(self, role, content):
-        """添加消息到上下文"""
-        self.context.append({"role": role, "content": content})
-        self.print_debug(f"添加到上下文: {role} - {content[:30]}...")
+    def add_to_context(self, role, content, pinned=False):
+        """添加消息到上下文，pinned 为 True 的消息在压缩时始终保留"""
+        self.context.add(role, content, pinned)
+        self.print_debug(f"添加到上下文: {role} - {message_text(content)[:30]}...")
         
     def get_reference_images(self):
         """获取参考图片列表"""
@@ -56,19 +311,6 @@ class ArtifactIconGenerator:
         self.print_debug(f"找到 {len(image_files)} 个参考图片")
         return image_files
         
-    def encode_image(self, image_path):
-        """将图片编码为base64格式"""
-        if not os.path.exists(image_path):
-            print(f"错误: 图片不存在 - {image_path}")
-            return None
-            
-        try:
-            with open(image_path, "rb") as img_file:
-                return base64.b64encode(img_file.read()).decode('utf-8')
-        except Exception as e:
-            print(f"图片编码失败: {e}")
-            return None
-            
     def upload_reference_images(self):
         """上传参考图片并初始化对话"""
         # 系统提示词，定义AI角色
@@ -76,7 +318,7 @@ class ArtifactIconGenerator:
 用户会提供异宝信息（异宝名称、品质、所属场景、异宝描述），可能附带参考画风图片。
 你的任务是：学习参考图的图标风格，等待用户提供"具体的图标文案或创意方向"。"""
 
-        self.add_to_context("system", system_prompt)
+        self.add_to_context("system", system_prompt, pinned=True)
         
         # 获取参考图片
         ref_images = self.get_reference_images()
@@ -84,62 +326,106 @@ class ArtifactIconGenerator:
             print("没有找到参考图片，将直接进行文本对话")
             return True
             
+        # 参考图片没有变化时直接使用已保存的风格分析
+        fingerprint = self.get_style_fingerprint(ref_images, system_prompt)
+        analysis = None if self.refresh_style else self.load_style_analysis(fingerprint)
+        if analysis:
+            names = "、".join(os.path.basename(path) for path in ref_images)
+            self.add_to_context("user", f"我之前上传了 {len(ref_images)} 张参考图片（{names}），"
+                                        "请分析这些参考图片的风格特点，我稍后会提供异宝信息和创意方向。", pinned=True)
+            self.add_to_context("assistant", analysis, pinned=True)
+            print(f"已使用保存的参考图片风格分析（{len(ref_images)} 张参考图片未变化）")
+            return True
+            
         # 构建带有图片的消息
         message_text = "我正在上传一些参考图片，请学习这些图片的风格，以便生成类似风格的异宝图标。"
-        self.add_to_context("user", message_text)
+        self.add_to_context("user", message_text, pinned=True)
+        
+        # 读取缩小后的编码（优先使用缓存），未缓存的图片并行编码
+        start_time = time.time()
+        workers = max(1, int(self.config.get("reference_workers", 4)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            encoded_images = list(pool.map(self.reference_cache.get, ref_images))
+        total_bytes = sum(len(encoded[1]) for encoded in encoded_images if encoded)
+        self.print_debug(f"参考图片编码完成，耗时 {time.time() - start_time:.2f}秒，共 {total_bytes / 1024:.0f} KB")
         
         # 上传图片，将每个图片作为单独的用户消息发送
-        for img_path in ref_images:
-            try:
-                img_data = self.encode_image(img_path)
-                if not img_data:
-                    continue
-                    
-                # 添加图片消息到上下文
-                img_message = {
-                    "role": "user", 
-                    "content": [
-                        {"type": "text", "text": f"这是一张参考图片，文件名: {os.path.basename(img_path)}"},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_data}"}}
-                    ]
-                }
+        for img_path, encoded in zip(ref_images, encoded_images):
+            if not encoded:
+                continue
+            mime, img_data = encoded
                 
-                self.context.append(img_message)
-                self.print_debug(f"已添加参考图片: {os.path.basename(img_path)}")
-                
-            except Exception as e:
-                self.print_debug(f"上传图片失败: {e}")
+            # 添加图片消息到上下文
+            self.context.add("user", [
+                {"type": "text", "text": f"这是一张参考图片，文件名: {os.path.basename(img_path)}"},
+                {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{img_data}"}}
+            ])
+            self.print_debug(f"已添加参考图片: {os.path.basename(img_path)}")
                 
         # 添加说明
-        self.add_to_context("user", "请分析这些参考图片的风格特点，我稍后会提供异宝信息和创意方向。")
+        self.add_to_context("user", "请分析这些参考图片的风格特点，我稍后会提供异宝信息和创意方向。", pinned=True)
         
         # 获取API响应
         response = self.get_api_response()
         if response:
             self.print_debug("收到API对参考图片的分析")
-            self.add_to_context("assistant", response)
+            # 风格分析固定保留，参考图片数据不再随后续请求重复发送
+            self.add_to_context("assistant", response, pinned=True)
+            self.save_style_analysis(fingerprint, response, ref_images)
+            stripped = self.context.strip_images()
+            self.context.compact()
+            self.print_debug(f"已从上下文中移除 {stripped} 张参考图片的数据")
             return True
         return False
             
+    def get_style_fingerprint(self, ref_images, system_prompt):
+        """参考图片集合的指纹：文件名、大小、修改时间，以及影响分析结果的提示词、模型和编码参数"""
+        files = []
+        for path in sorted(ref_images):
+            stat = os.stat(path)
+            files.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+        raw = json.dumps([os.path.abspath(self.config["reference_folder"]), files, system_prompt, CHAT_MODEL,
+                          self.reference_cache.max_size, self.reference_cache.quality], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+        
+    def style_analysis_path(self, fingerprint):
+        return os.path.join(self.config.get("cache_folder", ".icon_cache"), "style", f"{fingerprint}.json")
+        
+    def load_style_analysis(self, fingerprint):
+        """读取已保存的风格分析，不存在时返回 None"""
+        path = self.style_analysis_path(fingerprint)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f).get("analysis") or None
+        except Exception as e:
+            self.print_debug(f"读取风格分析失败: {e}")
+            return None
+            
+    def save_style_analysis(self, fingerprint, analysis, ref_images):
+        try:
+            write_json_atomic(self.style_analysis_path(fingerprint), {
+                "analysis": analysis,
+                "reference_folder": self.config["reference_folder"],
+                "images": [os.path.basename(path) for path in ref_images],
+                "created": datetime.now().isoformat(timespec="seconds")
+            })
+        except Exception as e:
+            print(f"保存风格分析失败: {e}")
+            
     def get_api_response(self):
         """向API发送请求获取响应"""
-        headers = {
-            "Content-Type": "application/json", 
-            "Authorization": f"Bearer {self.config['api_key']}"
-        }
-        
         data = {
             "model": CHAT_MODEL,  # 使用GPT-4o模型进行对话
-            "messages": self.context
+            "messages": self.context.messages()
         }
+        size_bytes, tokens = self.context.size()
+        self.print_debug(f"上下文: {len(data['messages'])} 条消息，{size_bytes / 1024:.1f} KB，约 {tokens} tokens")
         
         try:
             self.print_debug("发送API请求...")
-            response = requests.post(
-                CHAT_COMPLETION_URL, 
-                headers=headers, 
-                json=data
-            )
+            response = self.api.post_json(CHAT_COMPLETION_URL, data)
             
             if response.status_code != 200:
                 print(f"错误: API返回{response.status_code} - {response.text}")
@@ -202,28 +488,13 @@ class ArtifactIconGenerator:
     def text_to_image(self, creative_direction, artifact_info):
         """使用文生图功能生成图标"""
         # 构建提示词
-        prompt = f"""游戏异宝图标: {artifact_info.get('name', '未知异宝')}
-品质: {artifact_info.get('quality', '普通')}
-风格: 与参考图片一致的游戏图标风格，简洁明了，具有游戏感。
-内容: {creative_direction}"""
-
-        headers = {
-            "Content-Type": "application/json", 
-            "Authorization": f"Bearer {self.config['api_key']}"
-        }
-        
-        data = {
-            "model": IMAGE_MODEL, 
-            "prompt": prompt, 
-            "n": 1, 
-            "size": self.config["size"]
-        }
+        prompt = self.build_icon_prompt(artifact_info, creative_direction)
         
         print(f"生成图标中，提示词: {prompt}")
         
         try:
             # 发送请求
-            response = requests.post(TEXT_TO_IMAGE_URL, headers=headers, json=data)
+            response = self.request_image(prompt)
             
             if response.status_code != 200:
                 print(f"错误: API返回{response.status_code} - {response.text}")
@@ -267,21 +538,62 @@ class ArtifactIconGenerator:
             print(traceback.format_exc())
             return False
             
+    def build_icon_prompt(self, artifact_info, creative_direction):
+        """由异宝信息和创意方向构建文生图提示词，没有填写的字段不写入"""
+        lines = [f"游戏异宝图标: {artifact_info.get('name', '未知异宝')}",
+                 f"品质: {artifact_info.get('quality', '普通')}"]
+        if artifact_info.get("scene"):
+            lines.append(f"所属场景: {artifact_info['scene']}")
+        if artifact_info.get("description"):
+            lines.append(f"异宝描述: {artifact_info['description']}")
+        lines.append("风格: 与参考图片一致的游戏图标风格，简洁明了，具有游戏感。")
+        if creative_direction:
+            lines.append(f"内容: {creative_direction}")
+        return "\n".join(lines)
+        
+    def request_image(self, prompt):
+        """发送文生图请求，返回响应"""
+        data = {
+            "model": IMAGE_MODEL, 
+            "prompt": prompt, 
+            "n": 1, 
+            "size": self.config["size"]
+        }
+        return self.api.post_json(TEXT_TO_IMAGE_URL, data)
+        
+    def write_image(self, name, chunks):
+        """把图片数据写入输出文件夹，返回保存路径；写入失败时删除不完整的文件并抛出异常"""
+        os.makedirs(self.config["output_folder"], exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filepath = os.path.join(self.config["output_folder"], f"{name}_{timestamp}.png")
+        try:
+            with open(filepath, "wb") as img_file:
+                for chunk in chunks:
+                    img_file.write(chunk)
+        except BaseException:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            raise
+        return filepath
+        
+    def write_base64_image(self, b64_image, name):
+        """保存base64编码的图片，返回保存路径"""
+        return self.write_image(name, [base64.b64decode(b64_image)])
+        
+    def write_url_image(self, url, name):
+        """下载URL并保存为图片，返回保存路径"""
+        if not url or not url.startswith(('http://', 'https://')):
+            raise ValueError(f"无效的URL格式 - {url}")
+        response = self.api.get(url, stream=True)
+        with response:
+            response.raise_for_status()
+            return self.write_image(name, response.iter_content(chunk_size=8192))
+        
     def save_base64_image(self, result, name):
         """保存base64编码的图片"""
         try:
-            os.makedirs(self.config["output_folder"], exist_ok=True)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            
-            b64_image = result["data"][0]["b64_json"]
-            img_data = base64.b64decode(b64_image)
-            
-            filename = f"{name}_{timestamp}.png"
-            filepath = os.path.join(self.config["output_folder"], filename)
-            
-            with open(filepath, "wb") as img_file:
-                img_file.write(img_data)
-                
+            filepath = self.write_base64_image(result["data"][0]["b64_json"], name)
+            filename = os.path.basename(filepath)
             print(f"图标已保存: {filepath}")
             
             # 添加图像生成结果到上下文
@@ -302,24 +614,9 @@ class ArtifactIconGenerator:
     def download_url(self, url, name):
         """下载URL并保存为图片"""
         try:
-            if not url or not url.startswith(('http://', 'https://')):
-                print(f"错误: 无效的URL格式 - {url}")
-                return False
-                
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            os.makedirs(self.config["output_folder"], exist_ok=True)
-            
             print(f"下载图片: {url}")
-            response = requests.get(url, stream=True)
-            response.raise_for_status()
-            
-            filename = f"{name}_{timestamp}.png"
-            filepath = os.path.join(self.config["output_folder"], filename)
-            
-            with open(filepath, "wb") as img_file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    img_file.write(chunk)
-                    
+            filepath = self.write_url_image(url, name)
+            filename = os.path.basename(filepath)
             print(f"图标已保存: {filepath}")
             
             # 添加图像生成结果到上下文
@@ -376,18 +673,6 @@ class ArtifactIconGenerator:
         """直接使用文本生成图像"""
         # 构建提示词
         prompt = f"""游戏异宝图标，风格类似于参考图片: {prompt_text}"""
-
-        headers = {
-            "Content-Type": "application/json", 
-            "Authorization": f"Bearer {self.config['api_key']}"
-        }
-        
-        data = {
-            "model": IMAGE_MODEL, 
-            "prompt": prompt, 
-            "n": 1, 
-            "size": self.config["size"]
-        }
         
         # 开始计时
         start_time = time.time()
@@ -397,7 +682,7 @@ class ArtifactIconGenerator:
         
         try:
             # 发送请求
-            response = requests.post(TEXT_TO_IMAGE_URL, headers=headers, json=data)
+            response = self.request_image(prompt)
             
             if response.status_code != 200:
                 # 只显示简单错误信息
@@ -456,18 +741,7 @@ class ArtifactIconGenerator:
     def save_base64_image_direct(self, result, name):
         """保存base64编码的图片（直接方式）"""
         try:
-            os.makedirs(self.config["output_folder"], exist_ok=True)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            
-            b64_image = result["data"][0]["b64_json"]
-            img_data = base64.b64decode(b64_image)
-            
-            filename = f"{name}_{timestamp}.png"
-            filepath = os.path.join(self.config["output_folder"], filename)
-            
-            with open(filepath, "wb") as img_file:
-                img_file.write(img_data)
-                
+            filepath = self.write_base64_image(result["data"][0]["b64_json"], name)
             print(f"\n生成器> 图标已保存: {filepath}")
             return True
             
@@ -478,24 +752,8 @@ class ArtifactIconGenerator:
     def download_url_direct(self, url, name):
         """下载URL并保存为图片（直接方式）"""
         try:
-            if not url or not url.startswith(('http://', 'https://')):
-                self.print_debug(f"错误: 无效的URL格式 - {url}")
-                return False
-                
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            os.makedirs(self.config["output_folder"], exist_ok=True)
-            
             self.print_debug(f"下载图片: {url}")
-            response = requests.get(url, stream=True)
-            response.raise_for_status()
-            
-            filename = f"{name}_{timestamp}.png"
-            filepath = os.path.join(self.config["output_folder"], filename)
-            
-            with open(filepath, "wb") as img_file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    img_file.write(chunk)
-                    
+            filepath = self.write_url_image(url, name)
             print(f"\n生成器> 图标已保存: {filepath}")
             return True
             
@@ -503,20 +761,110 @@ class ArtifactIconGenerator:
             self.print_debug(f"下载图片失败: {e}")
             return False
 
+    def render_icon(self, prompt, file_name):
+        """请求文生图并保存结果，不读写对话上下文，可在多个线程中同时调用
+
+        返回 (保存路径, 错误信息)。
+        """
+        try:
+            response = self.request_image(prompt)
+            if response.status_code != 200:
+                return None, f"API返回{response.status_code} - {response.text[:200]}"
+            result = response.json()
+            if not result.get("data"):
+                return None, "响应中没有图像数据"
+            data_item = result["data"][0]
+            if "b64_json" in data_item:
+                return self.write_base64_image(data_item["b64_json"], file_name), None
+            if "url" in data_item:
+                return self.write_url_image(data_item["url"], file_name), None
+            return None, "API响应中的图像数据格式不符合预期"
+            
+        except Exception as e:
+            return None, str(e)
+            
+    def generate_record(self, index, artifact_info):
+        """生成清单中一条异宝记录的图标，返回写入结果清单的记录"""
+        start_time = time.time()
+        prompt = self.build_icon_prompt(artifact_info, artifact_info.get("creative_direction", ""))
+        path, error = self.render_icon(prompt, f"{index:04d}_{safe_file_name(artifact_info['name'])}")
+        return dict(artifact_info, line=index, success=path is not None, path=path, error=error,
+                    seconds=round(time.time() - start_time, 2))
+        
+    def bulk_generate(self, manifest_path, workers=None, output_manifest=None):
+        """按清单（.jsonl 或 .csv）批量生成异宝图标
+
+        清单逐行读取，最多 workers 个请求同时进行，所有请求共用一个HTTP会话。
+        每条记录完成后立即追加到结果清单（JSONL），不修改对话上下文。
+        """
+        if not os.path.exists(manifest_path):
+            print(f"错误: 清单文件不存在 - {manifest_path}")
+            return False
+        workers = max(1, int(workers or self.config.get("bulk_workers", 4)))
+        if not output_manifest:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_manifest = os.path.join(self.config["output_folder"], f"manifest_{timestamp}.jsonl")
+        os.makedirs(os.path.dirname(output_manifest) or ".", exist_ok=True)
+        
+        print(f"开始批量生成图标: {manifest_path}，并发数 {workers}")
+        start_time = time.time()
+        counts = {"success": 0, "failed": 0}
+        
+        def write_results(futures, out):
+            for future in futures:
+                result = future.result()
+                counts["success" if result["success"] else "failed"] += 1
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                done = counts["success"] + counts["failed"]
+                if result["success"]:
+                    print(f"[{done}] 完成: {result.get('name')} ({result['seconds']:.1f}秒) -> {result['path']}")
+                else:
+                    print(f"[{done}] 失败: 第{result['line']}行 {result.get('name', '')} - {result['error']}")
+                    
+        with ThreadPoolExecutor(max_workers=workers) as pool, open(output_manifest, "a", encoding="utf-8") as out:
+            pending = set()
+            for index, record, error in read_artifact_manifest(manifest_path):
+                if error:
+                    counts["failed"] += 1
+                    out.write(json.dumps({"line": index, "success": False, "error": error}, ensure_ascii=False) + "\n")
+                    print(f"跳过第{index}行: {error}")
+                    continue
+                # 只预读有限条记录，清单很大时也不会一次性全部排队
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    write_results(done, out)
+                pending.add(pool.submit(self.generate_record, index, record))
+            write_results(wait(pending).done, out)
+            
+        total_time = time.time() - start_time
+        print(f"\n批量生成完成! 成功: {counts['success']}，失败: {counts['failed']}，总耗时: {total_time:.2f}秒")
+        print(f"结果清单: {output_manifest}")
+        return counts["success"] > 0
+
 def main():
     """主函数"""
     start_time = time.time()  # 记录开始时间
     
     # 配置调试模式
-    if len(sys.argv) > 1 and sys.argv[1] == "--debug":
+    if "--debug" in sys.argv[1:]:
         print("调试模式已启用")
     else:
         # 非调试模式下关闭调试输出
         CONFIG["debug"] = False
         CONFIG["print_response"] = False
     
-    generator = ArtifactIconGenerator()
-    generator.interactive_session()
+    # --refresh-style: 忽略已保存的风格分析，重新分析参考图片
+    generator = ArtifactIconGenerator(refresh_style="--refresh-style" in sys.argv[1:])
+    
+    # --manifest 清单文件 [--workers 并发数] [--output 结果清单]: 按清单批量生成图标
+    args = sys.argv[1:]
+    if "--manifest" in args and args.index("--manifest") + 1 < len(args):
+        def option(name):
+            return args[args.index(name) + 1] if name in args and args.index(name) + 1 < len(args) else None
+        generator.bulk_generate(option("--manifest"), option("--workers"), option("--output"))
+    else:
+        generator.interactive_session()
     
     # 计算并输出总耗时
     end_time = time.time()
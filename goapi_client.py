@@ -0,0 +1,113 @@
+"""GoAPI 公共HTTP传输层
+
+gpt_image_generator.py 和 game_artifact_icon_generator.py 共用的请求客户端：
+带连接池的 requests.Session（复用TLS连接），统一的连接/读取超时，
+以及按带随机抖动的指数退避自动重试（规则见 GoAPIClient）。
+"""
+
+import time
+import random
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# 服务器拒绝处理（限流、暂时不可用）的状态码，请求没有被执行，POST 也可以重试
+REJECTED_STATUS_CODES = {429, 503}
+# 可能是暂时性的错误，但服务器可能已经开始处理请求，只对 GET 重试
+RETRY_STATUS_CODES = REJECTED_STATUS_CODES | {500, 502, 504}
+
+# 默认参数，可以在各脚本的 CONFIG 中覆盖
+DEFAULTS = {
+    "connect_timeout": 10,  # 建立连接的超时时间（秒）
+    "read_timeout": 300,  # 等待响应的超时时间（秒），图像生成通常需要几十秒
+    "max_retries": 3,  # 失败后的最大重试次数
+    "backoff_base": 1.0,  # 指数退避的基础等待时间（秒）
+    "backoff_max": 30.0  # 单次重试的最长等待时间（秒）
+}
+
+def is_connect_failure(error):
+    """连接错误是否发生在请求发出之前（连接超时、连接被拒绝、DNS失败）"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # requests 把 urllib3 的异常包装在 MaxRetryError.reason 中
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+class GoAPIClient:
+    """GoAPI 请求客户端
+
+    同一个实例可以在多个线程中共用。API密钥只随 post_json 发往GoAPI接口，
+    下载图片URL时不会携带。
+
+    重试规则：
+    - GET（下载图片）在 5xx/429、连接错误和读取超时时重试；
+    - POST（生成请求）只在 429/503 和请求发出之前的失败（连接超时、连接被拒绝、DNS失败）时重试。
+      其他情况下服务器可能已经收到请求并开始生成，重试会重复生成和计费，因此不重试。
+    """
+
+    def __init__(self, api_key, config=None, pool_size=10):
+        config = config or {}
+        self.api_key = api_key
+        self.timeout = (config.get("connect_timeout", DEFAULTS["connect_timeout"]),
+                        config.get("read_timeout", DEFAULTS["read_timeout"]))
+        self.max_retries = max(0, int(config.get("max_retries", DEFAULTS["max_retries"])))
+        self.backoff_base = float(config.get("backoff_base", DEFAULTS["backoff_base"]))
+        self.backoff_max = float(config.get("backoff_max", DEFAULTS["backoff_max"]))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, int(pool_size)))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post_json(self, url, data):
+        """向GoAPI接口发送JSON请求，返回最后一次的响应"""
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"}
+        return self.request("POST", url, idempotent=False, headers=headers, json=data)
+
+    def get(self, url, stream=False):
+        """下载URL（不携带API密钥），返回最后一次的响应"""
+        return self.request("GET", url, stream=stream)
+
+    def request(self, method, url, idempotent=True, **kwargs):
+        """发送请求并按重试规则重试，idempotent=False 时只重试确定没有被执行的请求
+
+        重试次数用完后返回最后一次响应，或抛出最后一次的异常，由调用方按原有方式处理。
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ReadTimeout:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                reason = "读取超时"
+                retry_after = None
+            except requests.exceptions.ConnectionError as e:
+                # 包括连接超时、DNS失败以及连接被重置
+                if (not idempotent and not is_connect_failure(e)) or attempt >= self.max_retries:
+                    raise
+                reason = f"连接错误: {e.__class__.__name__}"
+                retry_after = None
+            else:
+                retry_codes = RETRY_STATUS_CODES if idempotent else REJECTED_STATUS_CODES
+                if response.status_code not in retry_codes or attempt >= self.max_retries:
+                    return response
+                reason = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+
+            attempt += 1
+            delay = self.backoff_delay(attempt, retry_after)
+            print(f"请求失败 ({reason})，{delay:.1f}秒后重试 ({attempt}/{self.max_retries})")
+            time.sleep(delay)
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """第 attempt 次重试前的等待时间：服务器给出 Retry-After 时按其等待，否则使用全抖动指数退避"""
+        if retry_after:
+            try:
+                return min(self.backoff_max, max(0.0, float(retry_after)))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
@@ -1,9 +1,9 @@
 import os
 import base64
-import requests
 import json
 import time
 from datetime import datetime
+import goapi_client
 
 # 配置参数
 CONFIG = {
@@ -14,7 +14,10 @@ CONFIG = {
     "use_image": True,  # 是否使用图像变体模式
     "default_image": r"E:\img\test_cat.jpg",  # 默认测试图片路径
     "debug": True,  # 调试模式
-    "print_response": True  # 是否打印API响应
+    "print_response": True,  # 是否打印API响应
+    "connect_timeout": 10,  # GoAPI 建立连接的超时时间（秒）
+    "read_timeout": 300,  # GoAPI 等待响应的超时时间（秒）
+    "max_retries": 3  # 请求失败时的最大重试次数（生成请求只在确定未被执行时重试）
 }
 
 # API端点
@@ -22,21 +25,29 @@ TEXT_TO_IMAGE_URL = "https://api.goapi.ai/v1/images/generations"
 IMAGE_TO_IMAGE_URL = "https://api.goapi.ai/v1/images/variations"
 MODEL = "gpt-image-1"
 
+_api_client = None
+
 def print_debug(message):
     """打印调试信息"""
     if CONFIG.get("debug", False):
         print(f"[DEBUG] {message}")
 
+def get_api_client():
+    """获取共用的GoAPI客户端，第一次使用时按当前配置创建"""
+    global _api_client
+    if _api_client is None:
+        _api_client = goapi_client.GoAPIClient(CONFIG["api_key"], CONFIG)
+    return _api_client
+
 def generate_image_from_text():
     """纯文本到图像生成"""
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {CONFIG['api_key']}"}
     data = {"model": MODEL, "prompt": CONFIG["prompt"], "n": 1, "size": CONFIG["size"]}
     
     print(f"使用提示词生成图像: {CONFIG['prompt']}")
     
     try:
         # 发送请求
-        response = requests.post(TEXT_TO_IMAGE_URL, headers=headers, json=data)
+        response = get_api_client().post_json(TEXT_TO_IMAGE_URL, data)
         if response.status_code != 200:
             print(f"错误: API返回{response.status_code} - {response.text}")
             return False
@@ -89,8 +100,6 @@ def generate_image_with_image(image_path):
         with open(image_path, "rb") as img_file:
             img_data = base64.b64encode(img_file.read()).decode('utf-8')
         
-        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {CONFIG['api_key']}"}
-        
         # 使用文本到图像的API端点，而不是图像变体端点
         data = {
             "model": MODEL,
@@ -104,7 +113,7 @@ def generate_image_with_image(image_path):
         print(f"使用图片和提示词生成图像: {CONFIG['prompt']}")
         
         # 发送请求
-        response = requests.post(TEXT_TO_IMAGE_URL, headers=headers, json=data)
+        response = get_api_client().post_json(TEXT_TO_IMAGE_URL, data)
         print(f"API响应状态码: {response.status_code}")
         
         if response.status_code != 200:
@@ -185,7 +194,7 @@ def download_url(url, timestamp=None):
         os.makedirs(CONFIG["output_folder"], exist_ok=True)
         
         print(f"下载图片: {url}")
-        response = requests.get(url, stream=True)
+        response = get_api_client().get(url, stream=True)
         response.raise_for_status()
         
         filepath = os.path.join(CONFIG["output_folder"], f"{timestamp}_goapi.png")
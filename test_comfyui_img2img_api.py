@@ -0,0 +1,136 @@
+"""comfyui_img2img_api 的测试
+
+使用 benchmark_comfyui 中进程内模拟的 ComfyUI 服务器，不需要真实的服务器和GPU。
+运行: python -m pytest -q
+"""
+
+import os
+import json
+import time
+import contextlib
+
+import pytest
+
+import benchmark_comfyui
+import comfyui_img2img_api as api
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """临时工作目录和一台模拟服务器，测试结束后恢复配置"""
+    monkeypatch.chdir(tmp_path)
+    saved_config = dict(api.CONFIG)
+    images = benchmark_comfyui.prepare_workspace(api, str(tmp_path), 12, 32)
+    server = benchmark_comfyui.FakeComfyUI(latency=0.01).start()
+    api.CONFIG["server_address"] = server.address
+    api.CONFIG["server_addresses"] = [server.address]
+    api.CONFIG["metrics_file"] = str(tmp_path / "metrics.jsonl")
+    api.node_schema_cache.invalidate()
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        api.create_default_workflow()
+    try:
+        yield images, server
+    finally:
+        api.close_clients()
+        server.stop()
+        api.CONFIG.clear()
+        api.CONFIG.update(saved_config)
+
+def test_cached_rerun_does_not_wait_for_queue_poll(workspace):
+    """命中结果缓存的任务不进入服务器队列，启用背压时也不应等待 /queue 轮询"""
+    images, server = workspace
+    api.CONFIG.update(result_cache=True, fixed_seed=42, queue_backpressure=True, queue_poll_interval=2)
+    assert api.batch_process(images, "cached", [server.address])
+    prompts = server.request_counts["POST prompt"]
+
+    start = time.perf_counter()
+    assert api.batch_process(images, "cached", [server.address])
+    elapsed = time.perf_counter() - start
+
+    assert server.request_counts["POST prompt"] == prompts
+    assert elapsed < api.CONFIG["queue_poll_interval"]
+
+@pytest.mark.parametrize("values, fraction, expected", [
+    ([1, 2], 0.5, 1),
+    (list(range(1, 7)), 0.5, 3),
+    (list(range(1, 101)), 0.95, 95),
+    (list(range(1, 101)), 0.99, 99),
+    (list(range(1, 101)), 0.07, 7),
+    ([5, 1, 3], 0.5, 3),
+    ([7], 0.99, 7),
+    ([1, 2, 3, 4], 0.0, 1),
+    ([1, 2, 3, 4], 1.0, 4),
+])
+def test_percentile_nearest_rank(values, fraction, expected):
+    assert api.percentile(values, fraction) == expected
+
+def test_percentile_empty():
+    assert api.percentile([], 0.5) is None
+
+def test_variations_record_stage_timings(workspace):
+    images, server = workspace
+    # 模拟服务器不展开latent批次，每个种子复制一个采样分支
+    api.CONFIG["variations_batched"] = False
+    assert api.generate_variations(images[0], "variations", count=3)
+    with open(api.CONFIG["metrics_file"], "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    record = records[-1]
+    assert record["kind"] == "variations" and record["success"]
+    assert record["images"] == 3 and record["prompt_id"]
+    assert {"upload", "queue_wait", "execution", "download"} <= set(record["spans_ms"])
+
+def test_fingerprint_ignores_per_job_inputs(workspace):
+    """重新生成默认工作流只改变随机种子，指纹（以及任务日志的键）保持不变"""
+    path = api.CONFIG["workflow_path"]
+    first = api.load_workflow(path)
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        api.create_default_workflow()
+    second = api.load_workflow(path)
+    assert first != second
+    assert api.WorkflowTemplate(first).fingerprint == api.WorkflowTemplate(second).fingerprint
+
+    changed = api.WorkflowTemplate(second)
+    node_id, input_name = changed.plan["steps"][0]
+    second[node_id]["inputs"][input_name] += 1
+    assert api.WorkflowTemplate(second).fingerprint != changed.fingerprint
+
+def test_journal_rerun_skips_finished_jobs(workspace, monkeypatch):
+    images, server = workspace
+    api.CONFIG.update(batch_journal=True, result_cache=False)
+    assert api.batch_process(images, "journal", [server.address])
+    prompts = server.request_counts["POST prompt"]
+    assert prompts == len(images)
+
+    engines = []
+    original_run = api.PipelinedBatchEngine.run
+    monkeypatch.setattr(api.PipelinedBatchEngine, "run",
+                        lambda engine, jobs: engines.append(engine) or original_run(engine, jobs))
+    assert api.batch_process(images, "journal", [server.address])
+    assert server.request_counts["POST prompt"] == prompts
+    assert engines[0].resumed["skipped"] == len(images)
+
+def test_newly_installed_checkpoint_is_not_replaced(workspace):
+    """节点信息缓存中没有的模型先重新获取一次，确认确实不可用才替换"""
+    images, server = workspace
+    assert api.get_available_models(server.address) == ["bench.safetensors"]
+    server.OBJECT_INFO = dict(server.OBJECT_INFO, CheckpointLoaderSimple={
+        "input": {"required": {"ckpt_name": [["bench.safetensors", "new.safetensors"]]}}})
+
+    workflow = api.load_workflow(api.CONFIG["workflow_path"])
+    node_id, input_name = api.WorkflowTemplate(workflow).plan["checkpoint"][0]
+    workflow[node_id]["inputs"][input_name] = "new.safetensors"
+    assert api.WorkflowTemplate(workflow).resolve_checkpoint(server.address) is None
+    workflow[node_id]["inputs"][input_name] = "missing.safetensors"
+    assert api.WorkflowTemplate(workflow).resolve_checkpoint(server.address) == "bench.safetensors"
+
+def test_stale_upload_is_uploaded_again(workspace):
+    """服务器输入目录被清理后，登记表中的文件名在提交失败时作废，重试时重新上传"""
+    images, server = workspace
+    api.CONFIG.update(result_cache=False)
+    assert api.batch_process(images[:2], "stale", [server.address])
+    uploads = server.request_counts["POST upload"]
+    assert uploads == 2
+
+    with server.lock:
+        server.inputs.clear()
+    assert api.batch_process(images[:2], "stale", [server.address])
+    assert server.request_counts["POST upload"] == uploads + 2